@@ -1,47 +1,19 @@
 import asyncio
-from asyncio import create_task
+import signal
 
-import audio
-import bus
-import mqtt
-import tracking
-import web
-import wifi
-from log import LOG
+from registry import ModuleRegistry
 
 
 async def main():
     shutdown_signal = asyncio.Event()
-    modules = []
-
-    # start main bus
-    LOG.info('Starting message bus')
-    modules.append(create_task(bus.main(shutdown_signal)))
-
-    # start user tracking
-    LOG.info('Starting user tracking')
-    modules.append(create_task(tracking.main(shutdown_signal)))
-
-    # start wifi tracker
-    LOG.info('Starting Wifi tracking')
-    modules.append(create_task(wifi.main(shutdown_signal)))
-
-    # start volumio control
-    LOG.info('Starting volumio control')
-    modules.append(create_task(audio.main(shutdown_signal)))
-
-    # start web interface
-    LOG.info('Starting web interface')
-    modules.append(create_task(web.main(shutdown_signal)))
-
-    # start mqtt
-    LOG.info('Starting MQTT')
-    modules.append(create_task(mqtt.main(shutdown_signal)))
-
-    LOG.info('Done starting up')
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, shutdown_signal.set)
 
+    # only the modules enabled in the 'modules' config are imported and started, in dependency order
+    modules = ModuleRegistry()
     try:
-        await asyncio.gather(*modules)
+        await modules.run(shutdown_signal)
     except KeyboardInterrupt:
         shutdown_signal.set()
 
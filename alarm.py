@@ -1,73 +1,186 @@
-from threading import Thread
-from time import time, sleep
+import asyncio
+import heapq
+from datetime import datetime, timedelta, time as dt_time
+from itertools import count
+from time import time
+from typing import Dict, Iterable, List, Optional
 
 from bus import e_bus
 from bus.events import Event
+from log import LOG
+
+MODULE_NAME = 'alarm'
+DEPENDS = ('bus',)
+
+# longest single sleep, so that changes of the wall clock are noticed
+MAX_SLEEP = 60
+
+_ids = count(1)
+
+
+def parse_time(value: str) -> dt_time:
+    """Parse a HH:MM or HH:MM:SS time of day."""
+    parts = [int(part) for part in value.split(':')]
+    if not 2 <= len(parts) <= 3:
+        raise ValueError(f'invalid time of day {value!r}')
+    return dt_time(*parts)
 
 
 class Alarm:
-    def __init__(self, time, days, once=False):
+    """
+    An alarm going off at `time` (HH:MM[:SS], local time) on the given `days` (0 is Monday), or on every day if there
+    are none. A `once` alarm is removed after going off.
+    """
+
+    def __init__(self, time: str, days: Iterable[int] = (), once: bool = False):
+        self.id = next(_ids)
         self.time = time
-        self.days = days
+        self.days = sorted(set(days))
         self.once = once
-
-    def next(self):
-        pass
+        self.deadline: Optional[float] = None
+        self._time = parse_time(time)
+        # the heap entry currently scheduling this alarm, older entries are stale
+        self._entry: Optional[List] = None
+
+    def next(self, after: Optional[float] = None) -> Optional[float]:
+        """
+        Timestamp of the first occurrence strictly after `after` (now by default).
+        Local times are converted with the rules in effect on that day, so an alarm keeps its wall clock time across
+        DST changes. Times skipped by a change go off at the equivalent time after it, repeated ones only go off once.
+        """
+        after = time() if after is None else after
+        day = datetime.fromtimestamp(after).date()
+        for offset in range(8):
+            date = day + timedelta(days=offset)
+            if self.days and date.weekday() not in self.days:
+                continue
+            deadline = datetime.combine(date, self._time).timestamp()
+            if deadline > after:
+                return deadline
+        return None
 
     def serialize(self):
         return {
+            'id': self.id,
             'time': self.time,
             'days': self.days,
-            'once': self.once
+            'once': self.once,
+            'next': self.deadline
         }
 
     def __call__(self, *args, **kwargs):
         e_bus.emit('alarm.do_stuff', Event(data=self.serialize()))
 
 
-class Watcher(Thread):
-    def __init__(self):
-        super(Watcher, self).__init__()
-        self.running = True
-        self.repeating = dict()  # time: callable
-        self.one_time = dict()
-
-    def run(self):
-        while self.running:
-            curr_time = time()
-            for t, alarm in list(self.repeating.items()):
-                if curr_time <= t:
-                    alarm()
-                    del self.repeating[t]
-                    self.repeating[alarm.next()] = alarm
-
-            for t, alarm in list(self.one_time.items()):
-                if curr_time <= t:
-                    alarm()
-                    del self.one_time[t]
-            sleep(1)
-
-    def terminate(self):
-        self.running = False
-
-    def set(self, alarm, next=None, once=False):
-        if once:
-            self.one_time[next or alarm.next()] = alarm
-        else:
-            self.one_time[next or alarm.next()] = alarm
-
-
-watcher = Watcher()
+class AlarmScheduler:
+    """
+    Keeps alarms in a min-heap of deadlines and sleeps until the earliest one is due.
+    Cancelling or rescheduling only marks the old heap entry as stale, stale entries are skipped when they come up and
+    dropped all at once when they make up more than half of the heap.
+    """
 
-
-def set_alarm(time, days, once=False):
-    alarm = Alarm(time, days, once)
-    watcher.set(alarm, alarm.next(), alarm.once)
-
-
-def main():
-    watcher.start()
+    def __init__(self):
+        self.alarms: Dict[int, Alarm] = {}
+        self._heap: List[List] = []  # [deadline, sequence, alarm]
+        self._seq = count()
+        self._stale = 0
+        self._changed = asyncio.Event()
+
+    def add(self, alarm: Alarm, deadline: Optional[float] = None) -> int:
+        self.alarms[alarm.id] = alarm
+        self.reschedule(alarm.id, deadline)
+        return alarm.id
+
+    def cancel(self, alarm_id: int) -> bool:
+        alarm = self.alarms.pop(alarm_id, None)
+        if alarm is None:
+            return False
+        self._invalidate(alarm)
+        return True
+
+    def reschedule(self, alarm_id: int, deadline: Optional[float] = None) -> Optional[float]:
+        """Move an alarm to `deadline`, or to its next occurrence if there is none."""
+        alarm = self.alarms[alarm_id]
+        self._invalidate(alarm)
+        deadline = alarm.next() if deadline is None else deadline
+        alarm.deadline = deadline
+        if deadline is None:
+            # never goes off again
+            del self.alarms[alarm_id]
+            return None
+
+        entry = [deadline, next(self._seq), alarm]
+        alarm._entry = entry
+        if not self._heap or deadline < self._heap[0][0]:
+            self._changed.set()
+        heapq.heappush(self._heap, entry)
+        return deadline
+
+    def _invalidate(self, alarm: Alarm) -> None:
+        if alarm._entry is None:
+            return
+        alarm._entry = None
+        self._stale += 1
+        if self._stale > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap if entry[2]._entry is entry]
+            heapq.heapify(self._heap)
+            self._stale = 0
+
+    def _peek(self) -> Optional[List]:
+        heap = self._heap
+        while heap and heap[0][2]._entry is not heap[0]:
+            heapq.heappop(heap)
+            self._stale -= 1
+        return heap[0] if heap else None
+
+    def _fire_due(self, now: float) -> None:
+        while True:
+            entry = self._peek()
+            if entry is None or entry[0] > now:
+                return
+            heapq.heappop(self._heap)
+            alarm = entry[2]
+            alarm._entry = None
+            try:
+                alarm()
+            except Exception as e:
+                LOG.exception(f'Alarm {alarm.id} failed: {e}')
+            if alarm.id not in self.alarms:
+                # cancelled by a handler
+                continue
+            if alarm.once:
+                del self.alarms[alarm.id]
+            else:
+                # from now rather than from the deadline, so that missed occurrences do not all go off at once
+                self.reschedule(alarm.id, alarm.next(max(now, entry[0])))
+
+    async def run(self, shutdown_signal: asyncio.Event) -> None:
+        while not shutdown_signal.is_set():
+            self._changed.clear()
+            now = time()
+            self._fire_due(now)
+
+            entry = self._peek()
+            timeout = MAX_SLEEP if entry is None else min(MAX_SLEEP, entry[0] - now)
+            waiters = [asyncio.ensure_future(self._changed.wait()), asyncio.ensure_future(shutdown_signal.wait())]
+            _, pending = await asyncio.wait(waiters, timeout=max(timeout, 0), return_when=asyncio.FIRST_COMPLETED)
+            for waiter in pending:
+                waiter.cancel()
+
+
+scheduler = None
+
+
+def set_alarm(time, days, once=False) -> int:
+    return scheduler.add(Alarm(time, days, once))
+
+
+async def main(shutdown_signal: asyncio.Event):
+    global scheduler
+    scheduler = AlarmScheduler()
+
+    await scheduler.run(shutdown_signal)
 
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main(asyncio.Event()))
@@ -1,25 +1,42 @@
 import asyncio
 
 from audio.volumio import VolumioControl
-from config import config
+from bus import e_bus
+from common.events import ConfigChangedEvent
+from config.live import live_config
 from modular_conf.fields import StringField, IntField
 
 MODULE_NAME = 'audio'
+DEPENDS = ('bus',)
 CONFIG_FIELDS = [
     StringField('volumio_host', default='volumio.local'),
-    IntField('volumio_port', default=3000)
+    IntField('volumio_port', default=3000),
+    IntField('command_timeout', default=5),
+    IntField('reconnect_min', default=1),
+    IntField('reconnect_max', default=60)
 ]
 
 control = None
 
 
 async def main(shutdown_signal: asyncio.Event):
-    config.register_module(MODULE_NAME, CONFIG_FIELDS)
+    settings = live_config.register(MODULE_NAME, CONFIG_FIELDS)
 
     global control
-    control = VolumioControl(config.get(MODULE_NAME, 'volumio_host'), config.get(MODULE_NAME, 'volumio_port'))
+    control = VolumioControl(
+        settings.volumio_host,
+        settings.volumio_port,
+        timeout=settings.command_timeout,
+        reconnect_min=settings.reconnect_min,
+        reconnect_max=settings.reconnect_max
+    )
 
-    await shutdown_signal.wait()
+    async def on_config_changed(event: ConfigChangedEvent) -> None:
+        await control.apply_settings(live_config.get(MODULE_NAME), event.keys)
+
+    e_bus.on(f'config.changed.{MODULE_NAME}', on_config_changed)
+
+    await control.run(shutdown_signal)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,154 @@
+import asyncio
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import socketio
+
+from audio.state import VolumioState
+from log import LOG
+
+
+class Command:
+    __slots__ = ('event', 'data', 'key', 'expect', 'queue', 'deadline', 'waiters')
+
+    def __init__(self, event: str, data: Any, key: Optional[str], expect: Optional[Dict], queue: bool,
+                 deadline: float):
+        self.event = event
+        self.data = data
+        self.key = key
+        self.expect = expect
+        self.queue = queue
+        self.deadline = deadline
+        self.waiters: List[asyncio.Future] = []
+
+
+class CommandPipeline:
+    """
+    Sends commands to a Volumio device one at a time and in order, each one waiting for the device to confirm it before
+    the next one goes out. A command is confirmed once the mirrored state has the `expect`ed fields, or once the queue
+    changed for `queue` commands.
+    Commands with a `key` are idempotent, while one is still waiting to be sent another one with the same key replaces
+    it (latest wins), so that a burst of volume changes from a slider ends up as a single command.
+    While disconnected, commands that were not sent within `timeout` of their submission fail instead of going out
+    once the device is back.
+    """
+
+    def __init__(self, sio: socketio.AsyncClient, state: VolumioState, timeout: float = 5, max_pending: int = 100):
+        self.sio = sio
+        self.state = state
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.pending = deque()
+        self._keyed: Dict[str, Command] = {}
+        self._ready = asyncio.Event()
+        self.stats = {'sent': 0, 'coalesced': 0, 'timeouts': 0, 'rejected': 0, 'expired': 0}
+
+    async def submit(self, event: str, data: Any = None, key: Optional[str] = None, expect: Optional[Dict] = None,
+                     queue: bool = False) -> bool:
+        """
+        Queue a command for sending.
+        Returns:
+            whether the device confirmed it in time
+        """
+        deadline = asyncio.get_event_loop().time() + self.timeout
+        command = self._keyed.get(key) if key is not None else None
+        if command is not None:
+            command.event, command.data, command.expect, command.queue = event, data, expect, queue
+            command.deadline = deadline
+            self.stats['coalesced'] += 1
+        else:
+            if len(self.pending) >= self.max_pending:
+                LOG.warning(f'Too many pending Volumio commands, rejecting {event}')
+                self.stats['rejected'] += 1
+                return False
+            command = Command(event, data, key, expect, queue, deadline)
+            self.pending.append(command)
+            if key is not None:
+                self._keyed[key] = command
+            self._ready.set()
+
+        waiter = asyncio.get_event_loop().create_future()
+        command.waiters.append(waiter)
+        return await waiter
+
+    async def _send(self, command: Command) -> bool:
+        queue_version = self.state.queue_version
+        try:
+            await self.sio.emit(command.event, command.data)
+        except socketio.exceptions.SocketIOError as e:
+            LOG.warning(f'Failed to send {command.event} to Volumio: {e}')
+            return False
+        self.stats['sent'] += 1
+
+        if command.expect:
+            expect = command.expect.items()
+            confirmed = await self.state.wait_until(lambda: all(self.state.state.get(k) == v for k, v in expect),
+                                                    self.timeout)
+        elif command.queue:
+            confirmed = await self.state.wait_until(lambda: self.state.queue_version != queue_version, self.timeout)
+        else:
+            return True
+
+        if not confirmed:
+            LOG.warning(f'Volumio did not confirm {command.event} within {self.timeout}s')
+            self.stats['timeouts'] += 1
+        return confirmed
+
+    def _expire(self) -> None:
+        """Fail the pending commands whose deadline passed."""
+        now = asyncio.get_event_loop().time()
+        expired = [command for command in self.pending if command.deadline <= now]
+        if not expired:
+            return
+
+        LOG.warning(f'Volumio is not connected, dropping {len(expired)} pending commands')
+        self.stats['expired'] += len(expired)
+        self.pending = deque(command for command in self.pending if command.deadline > now)
+        for command in expired:
+            if command.key is not None:
+                del self._keyed[command.key]
+            for waiter in command.waiters:
+                if not waiter.done():
+                    waiter.set_result(False)
+
+    async def _wait_connected(self, connected: asyncio.Event) -> None:
+        """Wait for the connection while there are pending commands, expiring them in the meantime."""
+        loop = asyncio.get_event_loop()
+        while self.pending and not connected.is_set():
+            deadline = min(command.deadline for command in self.pending)
+            try:
+                await asyncio.wait_for(connected.wait(), max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                self._expire()
+
+    async def run(self, connected: asyncio.Event) -> None:
+        """Send queued commands whenever connected, until cancelled."""
+        command = None
+        try:
+            while True:
+                while not self.pending:
+                    self._ready.clear()
+                    await self._ready.wait()
+                if not connected.is_set():
+                    await self._wait_connected(connected)
+                    continue
+
+                command = self.pending.popleft()
+                if command.key is not None:
+                    del self._keyed[command.key]
+                if all(waiter.done() for waiter in command.waiters):
+                    # nobody is waiting for it anymore, e.g. the caller was cancelled
+                    command = None
+                    continue
+                confirmed = await self._send(command)
+                for waiter in command.waiters:
+                    if not waiter.done():
+                        waiter.set_result(confirmed)
+                command = None
+        finally:
+            for cancelled in ([command] if command is not None else []) + list(self.pending):
+                for waiter in cancelled.waiters:
+                    if not waiter.done():
+                        waiter.set_result(False)
+            self.pending.clear()
+            self._keyed.clear()
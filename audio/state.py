@@ -0,0 +1,98 @@
+import asyncio
+from typing import Callable, Dict, List, Optional, Set
+
+# pushState fields grouped by what they describe, a change in any field of a group is reported as a change of it
+FIELD_GROUPS = {
+    'track': ('title', 'artist', 'album', 'albumart', 'uri', 'trackType', 'duration', 'service'),
+    'volume': ('volume', 'mute', 'disableVolumeControl'),
+    'status': ('status', 'position', 'random', 'repeat', 'repeatSingle')
+}
+_MISSING = object()
+_GROUP_OF = {field: group for group, fields in FIELD_GROUPS.items() for field in fields}
+
+
+class VolumioState:
+    """
+    Mirror of the player state and queue of a Volumio device, updated incrementally from its pushState and pushQueue
+    messages. Keeps an index from track uri to queue position.
+    """
+
+    def __init__(self):
+        self.state: Dict = {}
+        self.queue: List[Dict] = []
+        self.queue_index: Dict[str, int] = {}
+        self.queue_version = 0
+        self._changed: Optional[asyncio.Future] = None
+
+    def apply_state(self, push: Dict) -> Set[str]:
+        """
+        Merge a pushState message into the mirror.
+        Returns:
+            the groups ('track', 'volume', 'status', 'other') with at least one changed field
+        """
+        changed = set()
+        for key, value in push.items():
+            if self.state.get(key, _MISSING) != value:
+                self.state[key] = value
+                changed.add(_GROUP_OF.get(key, 'other'))
+        if changed:
+            self._notify()
+        return changed
+
+    def group(self, name: str) -> Dict:
+        return {field: self.state.get(field) for field in FIELD_GROUPS[name]}
+
+    def apply_queue(self, queue: List[Dict]) -> bool:
+        """
+        Replace the mirrored queue with a pushQueue message.
+        Returns:
+            whether the queue changed
+        """
+        if queue == self.queue:
+            return False
+
+        self.queue = queue
+        index = {}
+        for pos, item in enumerate(queue):
+            uri = item.get('uri')
+            if uri is not None and uri not in index:
+                index[uri] = pos
+        self.queue_index = index
+        self.queue_version += 1
+        self._notify()
+        return True
+
+    def position(self, uri: str) -> Optional[int]:
+        """Queue position of the first occurrence of `uri`."""
+        return self.queue_index.get(uri)
+
+    def _notify(self) -> None:
+        waiter, self._changed = self._changed, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def wait_until(self, predicate: Callable[[], bool], timeout: float) -> bool:
+        """
+        Wait up to `timeout` seconds for `predicate` to hold, checking it after every change of the state or queue.
+        Returns:
+            whether it holds
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while not predicate():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            if self._changed is None:
+                self._changed = loop.create_future()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._changed), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def wait_for_position(self, uri: str, timeout: float) -> Optional[int]:
+        """Queue position of `uri`, waiting up to `timeout` seconds for it to show up in the queue."""
+        if await self.wait_until(lambda: uri in self.queue_index, timeout):
+            return self.queue_index[uri]
+        return None
@@ -1,32 +1,61 @@
 import asyncio
-from typing import Dict
+import random
+from typing import Dict, List, NamedTuple
 
 import socketio
 
+from audio.commands import CommandPipeline
+from audio.state import VolumioState
 from bus import e_bus, Event
+from log import LOG
 from utils import make_callback
 
+# how long to wait for a track added to the queue to show up in it
+QUEUE_UPDATE_TIMEOUT = 5
+
 
 class VolumioControl:
-    def __init__(self, host, port):
+    """
+    Controls a Volumio device over its socket.io API. Commands go through a CommandPipeline, so they are delivered in
+    order, repeated volume and playback changes collapse into the newest one and every call reports whether the device
+    confirmed it.
+    """
+
+    def __init__(self, host, port, timeout=5, reconnect_min=1, reconnect_max=60, sio=None):
         super().__init__()
-        self.sio = socketio.AsyncClient()
+        self.mirror = VolumioState()
+        self.sio = sio or socketio.AsyncClient()
         self.url = f'http://{host}:{port}'
-        self.sio.connect(self.url)
-
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.connected = asyncio.Event()
+        self._moved = asyncio.Event()
+        self.commands = CommandPipeline(self.sio, self.mirror, timeout)
+
+        self.sio.on('connect', self._on_connect)
+        self.sio.on('disconnect', self._on_disconnect)
         self.sio.on('pushState', self._push_state)
         self.sio.on('pushQueue', self._push_queue)
-        self._update_state()
 
-        self.state = {}
+        e_bus.on('tracking.action.shutdown', make_callback(self.pause))
+
+    async def _on_connect(self) -> None:
+        self.connected.set()
+        await self.sio.emit('getState')
+        await self.sio.emit('getQueue')
+
+    async def _on_disconnect(self) -> None:
+        self.connected.clear()
 
-        e_bus.on('tracking.action.shutdown', make_callback(self.pause, self))
+    async def pause(self) -> bool:
+        return await self.commands.submit('pause', key='playback', expect={'status': 'pause'})
 
-    async def pause(self) -> None:
-        await self.sio.emit('pause')
+    async def resume(self) -> bool:
+        return await self.commands.submit('play', key='playback', expect={'status': 'play'})
 
-    async def resume(self) -> None:
-        await self.sio.emit('play')
+    @property
+    def state(self) -> Dict:
+        return self.mirror.state
 
     async def get_status(self) -> Dict:
         return self.state.get('status')
@@ -35,29 +64,31 @@ class VolumioControl:
         return f'{self.state.get("title")} by {self.state.get("artist")} - {self.state.get("album")}'
 
     async def _push_state(self, *args) -> None:
-        self.state = args[0]
+        for group in self.mirror.apply_state(args[0]):
+            if group != 'other':
+                e_bus.emit(f'audio.volumio.{group}', Event(self.mirror.group(group)))
 
     async def _push_queue(self, *args) -> None:
-        # TODO: figure out
-        self.state['queue'] = args[0]  # ?????
+        if self.mirror.apply_queue(args[0] or []):
+            e_bus.emit('audio.volumio.queue', Event({'length': len(self.mirror.queue)}))
 
-    async def set_volume(self, volume: int) -> None:
-        await self.sio.emit('volume', volume)
+    async def set_volume(self, volume: int) -> bool:
+        return await self.commands.submit('volume', volume, key='volume', expect={'volume': volume})
 
-    async def mute(self) -> None:
-        await self.sio.emit('mute')
+    async def mute(self) -> bool:
+        return await self.commands.submit('mute', key='mute', expect={'mute': True})
 
-    async def unmute(self) -> None:
-        await self.sio.emit('unmute')
+    async def unmute(self) -> bool:
+        return await self.commands.submit('unmute', key='mute', expect={'mute': False})
 
-    async def add_to_queue(self, uri: str) -> None:
-        await self.sio.emit('addToQueue', data={'uri': uri})
+    async def add_to_queue(self, uri: str) -> bool:
+        return await self.commands.submit('addToQueue', {'uri': uri}, queue=True)
 
-    async def play_playlist(self, playlist: str) -> None:
-        await self.sio.emit('playPlaylist', data={'name': playlist})
+    async def play_playlist(self, playlist: str) -> bool:
+        return await self.commands.submit('playPlaylist', {'name': playlist}, queue=True)
 
-    async def enqueue_playlist(self, playlist: str) -> None:
-        await self.sio.emit('enqueue', data={'name': playlist})
+    async def enqueue_playlist(self, playlist: str) -> bool:
+        return await self.commands.submit('enqueue', {'name': playlist}, queue=True)
 
     async def play_song_in_playlist(self, current_song: str, playlist: str):
         # TODO: clear queue
@@ -65,16 +96,69 @@ class VolumioControl:
         await self.add_to_queue(current_song)
         await self.move_queue(current_song, 0)
 
-    async def move_queue(self, song_uri: str, pos: int) -> None:
-        curr_pos = 1234  # TODO: determine from current queue
-        await self.sio.emit('moveQueue', data={'from': curr_pos, 'to': pos})
-
-    async def _update_state(self):
-        await self.sio.emit('getState')
-
-    def __del__(self):
-        self.sio.disconnect()
-
-    async def restart(self) -> None:
-        await self.sio.disconnect()
-        await self.sio.connect(self.url)
+    async def move_queue(self, song_uri: str, pos: int) -> bool:
+        curr_pos = await self.mirror.wait_for_position(song_uri, QUEUE_UPDATE_TIMEOUT)
+        if curr_pos is None:
+            LOG.warning(f'Cannot move {song_uri}, it is not in the queue')
+            return False
+        if curr_pos == pos:
+            return True
+        return await self.commands.submit('moveQueue', {'from': curr_pos, 'to': pos}, queue=True)
+
+    async def apply_settings(self, settings: NamedTuple, keys: List[str]) -> None:
+        """Take over changed settings, reconnecting if the device moved."""
+        self.commands.timeout = settings.command_timeout
+        self.reconnect_min = settings.reconnect_min
+        self.reconnect_max = settings.reconnect_max
+
+        url = f'http://{settings.volumio_host}:{settings.volumio_port}'
+        if url != self.url:
+            self.url = url
+            # the socket.io client would keep reconnecting to the old url by itself, run reconnects instead
+            self._moved.set()
+
+    async def _connect(self, shutdown_signal: asyncio.Event) -> bool:
+        """
+        Connect to the current url, retrying with jittered exponential backoff.
+        Returns:
+            False if shutdown was requested before the connection was up
+        """
+        backoff = self.reconnect_min
+        while not shutdown_signal.is_set():
+            # a move before the connection is up needs no reconnect
+            self._moved.clear()
+            try:
+                await self.sio.connect(self.url)
+                return True
+            except socketio.exceptions.ConnectionError as e:
+                delay = random.uniform(backoff / 2, backoff)
+                LOG.warning(f'Volumio connection to {self.url} failed, retrying in {delay:.1f}s: {e}')
+                backoff = min(self.reconnect_max, backoff * 2)
+                try:
+                    await asyncio.wait_for(shutdown_signal.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        return False
+
+    async def run(self, shutdown_signal: asyncio.Event) -> None:
+        """
+        Connect and send commands until shutdown. Once connected the socket.io client reconnects by itself, until the
+        device moves and the connection is set up again here.
+        """
+        sender = asyncio.ensure_future(self.commands.run(self.connected))
+        shutdown = asyncio.ensure_future(shutdown_signal.wait())
+
+        try:
+            while await self._connect(shutdown_signal):
+                moved = asyncio.ensure_future(self._moved.wait())
+                await asyncio.wait({shutdown, moved}, return_when=asyncio.FIRST_COMPLETED)
+                moved.cancel()
+                if shutdown_signal.is_set():
+                    break
+                LOG.info(f'Volumio moved, reconnecting to {self.url}')
+                # also stops the reconnection attempts of the client to the old url
+                await self.sio.shutdown()
+        finally:
+            shutdown.cancel()
+            sender.cancel()
+            await self.sio.shutdown()
@@ -0,0 +1,64 @@
+"""
+Run the benchmarks and print the results as JSON, e.g. to compare two commits:
+
+    python -m bench --output before.json
+    python -m bench --only emit presence --quick
+"""
+import argparse
+import importlib
+import json
+import platform
+import sys
+from datetime import datetime, timezone
+from time import perf_counter
+
+from bench.common import git_revision
+from log import LOG
+
+# benchmark name: module with a run(quick) function, imported only when selected
+BENCHMARKS = {
+    'emit': 'bench.emit',
+    'presence': 'bench.presence',
+    'log': 'bench.logcalls',
+    'api': 'bench.api',
+    'mqtt': 'bench.mqtt_bridge',
+    'volumio': 'bench.volumio'
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Run the benchmark suite.')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help='benchmarks to run, all by default')
+    parser.add_argument('--quick', action='store_true', help='smaller workloads, for a quick check')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    args = parser.parse_args()
+
+    # debug output would dominate the hot paths, and must not end up mixed into the results
+    LOG.configure(level='info', stdout=False)
+
+    results = {
+        'revision': git_revision(),
+        'time': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': args.quick,
+        'benchmarks': {}
+    }
+    for name in args.only or BENCHMARKS:
+        print(f'Running {name}', file=sys.stderr)
+        start = perf_counter()
+        module = importlib.import_module(BENCHMARKS[name])
+        result = module.run(quick=args.quick)
+        result['elapsed_sec'] = round(perf_counter() - start, 3)
+        results['benchmarks'][name] = result
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
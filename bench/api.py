@@ -0,0 +1,89 @@
+"""Throughput and latency of the /api handlers, served by aiohttp on localhost."""
+import asyncio
+import random
+from time import perf_counter, time
+from typing import Dict, Optional
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from bench.common import percentiles
+import tracking
+from tracking.history import PresenceHistory
+import web as web_module
+
+
+def make_tracker(users: int, transitions: int, seed: int = 0) -> tracking.UserTracker:
+    """A tracker with `users` users present and `transitions` enter/exit transitions each over the last 30 days."""
+    rng = random.Random(seed)
+    now = time()
+    history = PresenceHistory(max_transitions=transitions)
+    tracker = tracking.UserTracker(history)
+    for u in range(users):
+        name = f'user{u}'
+        times = sorted(rng.uniform(now - 30 * 86400, now) for _ in range(transitions))
+        for i, when in enumerate(times):
+            history.record(name, i % 2 == 0, when)
+        tracker.users[name] = times[-1]
+    tracker.version += 1
+    return tracker
+
+
+async def load(session: ClientSession, url: str, requests: int, concurrency: int,
+               headers: Optional[Dict] = None) -> Dict:
+    samples = []
+    statuses = {}
+
+    async def worker(count: int) -> None:
+        for _ in range(count):
+            start = perf_counter()
+            async with session.get(url, headers=headers) as response:
+                await response.read()
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+            samples.append(perf_counter() - start)
+
+    start = perf_counter()
+    await asyncio.gather(*(worker(max(1, requests // concurrency)) for _ in range(concurrency)))
+    elapsed = perf_counter() - start
+    result = {'requests': len(samples), 'concurrency': concurrency, 'requests_per_sec': round(len(samples) / elapsed),
+              'statuses': {str(status): count for status, count in statuses.items()}}
+    result.update(percentiles(samples))
+    return result
+
+
+async def run_async(quick: bool) -> Dict:
+    tracking.tracker = make_tracker(users=20, transitions=2000 if quick else 10000)
+
+    app = web.Application()
+    app.add_routes(web_module.routes)
+    server = TestServer(app, host='127.0.0.1')
+    await server.start_server()
+
+    requests = 500 if quick else 5000
+    results = {}
+    try:
+        async with ClientSession() as session:
+            url = str(server.make_url('/api/tracking/'))
+            async with session.get(url) as response:
+                etag = response.headers.get('ETag')
+            end = time()
+            history = '/api/tracking/history?start={}&end={}'
+            # name: (url, headers, requests)
+            cases = {
+                'tracking': (url, None, requests),
+                'tracking_not_modified': (url, {'If-None-Match': etag}, requests),
+                'tracking_gzip': (url, {'Accept-Encoding': 'gzip'}, requests),
+                'history_day': (str(server.make_url(history.format(end - 86400, end))), None, requests // 10),
+                'history_month': (str(server.make_url(history.format(end - 30 * 86400, end))), None, requests // 100),
+                'bus_stats': (str(server.make_url('/api/bus/stats')), None, requests)
+            }
+            for name, (case_url, headers, count) in cases.items():
+                results[name] = {concurrency: await load(session, case_url, count, concurrency, headers)
+                                 for concurrency in (1, 16)}
+    finally:
+        await server.close()
+    return results
+
+
+def run(quick: bool = False) -> Dict:
+    return asyncio.run(run_async(quick))
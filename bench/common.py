@@ -0,0 +1,42 @@
+import subprocess
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Sequence
+
+
+def measure(fn: Callable[[], None], number: int, repeat: int = 5) -> Dict:
+    """
+    Time `number` calls of `fn`, `repeat` times, and report the best run.
+    The best run is the least disturbed by the rest of the system, so it is the most stable number across runs.
+    """
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        'ops_per_sec': round(number / best),
+        'us_per_op': round(best / number * 1e6, 3),
+        'number': number,
+        'repeat': repeat
+    }
+
+
+def percentiles(samples: List[float], points: Sequence[int] = (50, 90, 99)) -> Dict:
+    """Nearest rank percentiles of `samples`, in milliseconds."""
+    ordered = sorted(samples)
+    result = {}
+    for point in points:
+        index = min(len(ordered) - 1, max(0, round(point / 100 * len(ordered)) - 1))
+        result[f'p{point}_ms'] = round(ordered[index] * 1000, 3)
+    result['max_ms'] = round(ordered[-1] * 1000, 3)
+    return result
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(('git', 'rev-parse', 'HEAD'), capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,41 @@
+"""EventBus.emit throughput for different numbers of handlers and topics."""
+from itertools import cycle
+from typing import Dict
+
+from bench.common import measure
+from bus import EventBus
+from bus.events import Event
+
+
+def emit_case(handlers: int, topics: int, wildcard: bool, number: int) -> Dict:
+    """
+    `handlers` handlers on every one of `topics` topics, half of them subscribed with a wildcard pattern if
+    `wildcard` is set. Topics are emitted round robin.
+    """
+    bus = EventBus()
+    names = [f'bench.topic{i}.changed' for i in range(topics)]
+    for i in range(handlers):
+        def handler(event: Event) -> None:
+            pass
+
+        if wildcard and i % 2:
+            bus.on('bench.*.changed', handler)
+        else:
+            for name in names:
+                bus.on(name, handler)
+    event = Event({'value': 1})
+    next_topic = cycle(names).__next__
+    emit = bus.emit
+    result = measure(lambda: emit(next_topic(), event), number)
+    result.update({'handlers': handlers, 'topics': topics, 'wildcard': wildcard})
+    return result
+
+
+def run(quick: bool = False) -> Dict:
+    number = 20000 if quick else 200000
+    cases = []
+    for handlers in (0, 1, 10, 100):
+        for topics in (1, 100) if quick else (1, 100, 10000):
+            cases.append(emit_case(handlers, topics, False, number // max(1, handlers // 10)))
+        cases.append(emit_case(handlers, 100, True, number // max(1, handlers // 10)))
+    return {'cases': cases}
@@ -0,0 +1,18 @@
+"""Overhead of LOG calls, with the records going through the queue listener to no output."""
+from typing import Dict
+
+from bench.common import measure
+from log import LOG
+
+
+def run(quick: bool = False) -> Dict:
+    number = 20000 if quick else 200000
+    LOG.configure(level='info', stdout=False)
+    value = {'user': 'alice', 'mac': 'b8:27:eb:1c:0a:af'}
+    return {
+        'debug_disabled': measure(lambda: LOG.debug('Bus - %s: %s', 'tracking.event.user_enter', value), number),
+        'info_plain': measure(lambda: LOG.info('User entered'), number // 10),
+        'info_args': measure(lambda: LOG.info('User %s entered', 'alice'), number // 10),
+        'info_fstring_extra': measure(lambda: LOG.info(f'User {value["user"]} entered',
+                                                       extra={'user': value['user']}), number // 10)
+    }
@@ -0,0 +1,62 @@
+"""Bus to MQTT publishing and MQTT to bus forwarding through an in-process broker."""
+import asyncio
+from time import perf_counter
+from typing import Dict
+
+from bench.standins import Broker, BrokerClient, Message
+from bus import EventBus
+from bus.events import Event
+import mqtt
+
+
+async def publish_case(messages: int, batch_size: int) -> Dict:
+    """Bus events published to the broker, from the first emit until the last one is acknowledged."""
+    bus = EventBus()
+    broker = Broker()
+    client = mqtt.Client(bus=bus, publish=[('bench.#', 'bench/#')], batch_size=batch_size,
+                         buffer_size=messages, client=BrokerClient(broker))
+    shutdown_signal = asyncio.Event()
+    runner = asyncio.ensure_future(client.run(shutdown_signal))
+    await client.connected.wait()
+
+    event = Event({'value': 1})
+    start = perf_counter()
+    for i in range(messages):
+        bus.emit(f'bench.sensor{i % 100}.value', event)
+    while client.stats['published'] < messages:
+        await asyncio.sleep(0)
+    elapsed = perf_counter() - start
+
+    shutdown_signal.set()
+    await runner
+    return {'messages': messages, 'batch_size': batch_size, 'messages_per_sec': round(messages / elapsed)}
+
+
+async def receive_case(messages: int, filters: int) -> Dict:
+    """Broker messages forwarded to the bus, with `filters` subscription mappings of which one matches."""
+    bus = EventBus()
+    broker = Broker()
+    subscribe = [(f'home/room{i}/+', f'sensor.room{i}.*') for i in range(filters)]
+    client = mqtt.Client(bus=bus, subscribe=subscribe, client=BrokerClient(broker))
+    received = []
+    bus.on('sensor.room0.temperature', received.append)
+    shutdown_signal = asyncio.Event()
+    runner = asyncio.ensure_future(client.run(shutdown_signal))
+    await client.connected.wait()
+
+    start = perf_counter()
+    for _ in range(messages):
+        client.on_message(None, None, Message('home/room0/temperature', b'21.5'))
+    elapsed = perf_counter() - start
+
+    shutdown_signal.set()
+    await runner
+    return {'messages': len(received), 'filters': filters, 'messages_per_sec': round(messages / elapsed)}
+
+
+def run(quick: bool = False) -> Dict:
+    messages = 10000 if quick else 100000
+    return {
+        'publish': [asyncio.run(publish_case(messages, batch_size)) for batch_size in (1, 100)],
+        'receive': [asyncio.run(receive_case(messages, filters)) for filters in (1, 100)]
+    }
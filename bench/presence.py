@@ -0,0 +1,55 @@
+"""Parsing of recorded arp-scan output and the presence update of wifi.Watcher."""
+import asyncio
+import os
+import tempfile
+from time import perf_counter
+from typing import Dict
+
+from bench.common import measure
+from bench.standins import fake_arp_scan_command, make_arp_scan_output
+from wifi.arpscan import arp_scan, parse_arp_scan
+from wifi.index import MacIndex, pack_macs
+
+
+def parse_case(hosts: int, number: int) -> Dict:
+    lines = make_arp_scan_output(hosts).split('\n')
+    result = measure(lambda: set(parse_arp_scan(lines)), number)
+    result.update({'hosts': hosts, 'lines_per_sec': round(result['ops_per_sec'] * len(lines))})
+    return result
+
+
+def match_case(hosts: int, tracked: int, number: int) -> Dict:
+    """Matching the macs of a scan against the tracked devices, as done by wifi.Watcher after every scan."""
+    macs = set(parse_arp_scan(make_arp_scan_output(hosts).split('\n')))
+    to_track = [(f'user{i}', mac) for i, mac in enumerate(sorted(macs)[:tracked])]
+    index = MacIndex(to_track)
+    result = measure(lambda: index.keys.intersection(pack_macs(macs)), number)
+    result.update({'hosts': hosts, 'tracked': tracked})
+    return result
+
+
+async def scan_case(hosts: int, number: int) -> Dict:
+    """A whole scan through the subprocess pipeline, with a fake arp-scan printing a recording."""
+    fd, recording = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(fd, 'w') as f:
+        f.write(make_arp_scan_output(hosts))
+    command = fake_arp_scan_command(recording)
+    terminate = asyncio.Event()
+    try:
+        samples = []
+        for _ in range(number):
+            start = perf_counter()
+            await arp_scan(terminate, command=command)
+            samples.append(perf_counter() - start)
+    finally:
+        os.unlink(recording)
+    return {'hosts': hosts, 'best_ms': round(min(samples) * 1000, 3), 'number': number}
+
+
+def run(quick: bool = False) -> Dict:
+    scale = 1 if quick else 10
+    return {
+        'parse': [parse_case(hosts, max(1, 20000 * scale // hosts)) for hosts in (256, 4096, 65536)],
+        'match': [match_case(4096, tracked, 100 * scale) for tracked in (10, 1000)],
+        'scan': [asyncio.run(scan_case(hosts, 3 if quick else 10)) for hosts in (256, 65536)]
+    }
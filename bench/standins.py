@@ -0,0 +1,138 @@
+"""Local stand-ins for the external systems the benchmarks would otherwise talk to."""
+import asyncio
+import random
+import sys
+from typing import Dict, List, Optional
+
+from bus.topics import topic_matches
+
+ARP_SCAN_HEADER = (
+    'Interface: eth0, datalink type: EN10MB (Ethernet)\n'
+    'Starting arp-scan 1.9.7 with {hosts} hosts (https://github.com/royhills/arp-scan)\n'
+)
+ARP_SCAN_FOOTER = (
+    '\n{hosts} packets received by filter, 0 packets dropped by kernel\n'
+    'Ending arp-scan 1.9.7: {hosts} hosts scanned in 2.455 seconds (104.28 hosts/sec). {hosts} responded\n'
+)
+
+
+def random_mac(rng: random.Random) -> str:
+    return ':'.join(f'{rng.randrange(256):02x}' for _ in range(6))
+
+
+def make_arp_scan_output(hosts: int, seed: int = 0, duplicates: float = 0.05) -> str:
+    """A recording of an arp-scan of `hosts` responding hosts, with some duplicate responses like real scans have."""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(hosts):
+        ip = f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}'
+        mac = random_mac(rng)
+        lines.append(f'{ip}\t{mac}\tRaspberry Pi Foundation')
+        if rng.random() < duplicates:
+            lines.append(f'{ip}\t{mac}\tRaspberry Pi Foundation (DUP: 2)')
+    return ARP_SCAN_HEADER.format(hosts=hosts) + '\n'.join(lines) + ARP_SCAN_FOOTER.format(hosts=hosts)
+
+
+def fake_arp_scan_command(recording: str) -> List[str]:
+    """An arp-scan replacement printing the recording at `recording` (a file path)."""
+    return [sys.executable, '-c', f'import sys; sys.stdout.write(open({recording!r}).read())']
+
+
+class PublishInfo:
+    def __init__(self, published: bool):
+        self.published = published
+
+    async def wait_for_publish(self) -> None:
+        if not self.published:
+            raise RuntimeError('not connected')
+
+    def is_published(self) -> bool:
+        return self.published
+
+
+class Message:
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+
+
+class Broker:
+    """An in-process MQTT broker routing every publish synchronously to the subscribed clients."""
+
+    def __init__(self):
+        self.clients: List['BrokerClient'] = []
+        self.messages = 0
+
+    def route(self, topic: str, payload: bytes) -> None:
+        self.messages += 1
+        for client in self.clients:
+            if any(topic_matches(f, topic, '/', '+', '#') for f in client.filters):
+                client.on_message(client, None, Message(topic, payload))
+
+
+class BrokerClient:
+    """Stand-in for aiomqtt.Client connected to a Broker."""
+
+    def __init__(self, broker: Broker):
+        self.broker = broker
+        self.filters = set()
+        self.connected = False
+        self.on_message = self.on_connect = self.on_publish = self.on_subscribe = self.on_disconnect = None
+
+    def loop_start(self) -> None:
+        pass
+
+    async def loop_stop(self) -> None:
+        pass
+
+    async def connect(self, host: str, port: int, keepalive: int = 60) -> None:
+        self.connected = True
+        self.broker.clients.append(self)
+        self.on_connect(self, None, {}, 0)
+
+    def disconnect(self) -> None:
+        if self.connected:
+            self.connected = False
+            self.broker.clients.remove(self)
+            self.on_disconnect(self, None, 0)
+
+    def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False) -> PublishInfo:
+        if self.connected:
+            self.broker.route(topic, payload)
+        return PublishInfo(self.connected)
+
+    def subscribe(self, topic: str, qos: int = 0) -> None:
+        self.filters.add(topic)
+
+
+class FakeVolumio:
+    """
+    Stand-in for the socket.io connection to a Volumio device: commands are applied to a device state and pushed
+    back to the mirror after `latency` seconds, like the real device answers with pushState and pushQueue.
+    """
+
+    def __init__(self, mirror, latency: float = 0.002):
+        self.mirror = mirror
+        self.latency = latency
+        self.state: Dict = {'status': 'stop', 'volume': 50, 'mute': False}
+        self.queue: List[Dict] = []
+        self.received = 0
+        self.connected = True
+
+    async def emit(self, event: str, data: Optional[object] = None) -> None:
+        self.received += 1
+        if event == 'volume':
+            self.state['volume'] = data
+        elif event in ('mute', 'unmute'):
+            self.state['mute'] = event == 'mute'
+        elif event in ('play', 'pause'):
+            self.state['status'] = event
+        elif event == 'addToQueue':
+            self.queue = self.queue + [{'uri': data['uri']}]
+        asyncio.get_event_loop().call_later(self.latency, self._push, dict(self.state), list(self.queue))
+
+    def _push(self, state: Dict, queue: List[Dict]) -> None:
+        self.mirror.apply_state(state)
+        self.mirror.apply_queue(queue)
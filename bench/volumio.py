@@ -0,0 +1,64 @@
+"""Volumio command pipeline against a fake device, e.g. a volume slider sending a command per tick."""
+import asyncio
+from time import perf_counter
+from typing import Dict
+
+from audio.commands import CommandPipeline
+from audio.state import VolumioState
+from bench.standins import FakeVolumio
+
+
+async def slider_case(ticks: int, tick_interval: float, latency: float) -> Dict:
+    """`ticks` volume changes `tick_interval` seconds apart, until the device confirmed the last one."""
+    mirror = VolumioState()
+    device = FakeVolumio(mirror, latency)
+    pipeline = CommandPipeline(device, mirror, timeout=1)
+    connected = asyncio.Event()
+    connected.set()
+    sender = asyncio.ensure_future(pipeline.run(connected))
+
+    start = perf_counter()
+    pending = []
+    for tick in range(ticks):
+        pending.append(asyncio.ensure_future(pipeline.submit('volume', tick % 101, key='volume',
+                                                             expect={'volume': tick % 101})))
+        await asyncio.sleep(tick_interval)
+    confirmed = await asyncio.gather(*pending)
+    elapsed = perf_counter() - start
+    sender.cancel()
+
+    return {
+        'ticks': ticks,
+        'tick_interval_ms': tick_interval * 1000,
+        'latency_ms': latency * 1000,
+        'sent': device.received,
+        'coalesced': pipeline.stats['coalesced'],
+        'confirmed': sum(confirmed),
+        'total_ms': round(elapsed * 1000, 3)
+    }
+
+
+async def queue_case(commands: int, latency: float) -> Dict:
+    """Ordered queue additions, each waiting for the queue push confirming it."""
+    mirror = VolumioState()
+    device = FakeVolumio(mirror, latency)
+    pipeline = CommandPipeline(device, mirror, timeout=1)
+    connected = asyncio.Event()
+    connected.set()
+    sender = asyncio.ensure_future(pipeline.run(connected))
+
+    start = perf_counter()
+    await asyncio.gather(*(pipeline.submit('addToQueue', {'uri': f'track{i}'}, queue=True) for i in range(commands)))
+    elapsed = perf_counter() - start
+    sender.cancel()
+
+    in_order = [item['uri'] for item in mirror.queue] == [f'track{i}' for i in range(commands)]
+    return {'commands': commands, 'latency_ms': latency * 1000, 'in_order': in_order,
+            'commands_per_sec': round(commands / elapsed)}
+
+
+def run(quick: bool = False) -> Dict:
+    return {
+        'slider': [asyncio.run(slider_case(100 if quick else 500, 0.001, latency)) for latency in (0.002, 0.02)],
+        'queue': [asyncio.run(queue_case(100 if quick else 1000, 0.001))]
+    }
@@ -1,11 +1,77 @@
 import asyncio
 from collections import defaultdict, OrderedDict
-from typing import Optional, Callable, List
+from itertools import count
+from logging import DEBUG
+from time import perf_counter
+from typing import Optional, Callable, List, Dict, Tuple, Hashable
 
 from asyncio import iscoroutine, ensure_future
 
+from modular_conf.fields import BoolField, IntField, ChoiceField, TupleListField
+
+from bus.codec import set_default_codec
+from bus.coalesce import MODES as COALESCE_MODES, Coalescer
 from bus.events import Event, EventError
+from bus.topics import TopicCache, TopicTrie
+from config import config
 from log import LOG
+import metrics
+
+MODULE_NAME = 'bus'
+DEPENDS = ('log',)
+CONFIG_FIELDS = [
+    BoolField('queued', False),
+    IntField('queue_size', default=1024),
+    IntField('workers', default=4),
+    ChoiceField('overflow', default='block', choices=('block', 'drop_oldest', 'drop_newest'), type=str),
+    ChoiceField('codec', default='json', choices=('json', 'orjson', 'msgpack'), type=str),
+    TupleListField(
+        name='coalesce',
+        n_elems=3,
+        element_names=('topic', 'mode', 'window_ms'),
+        default=[]
+    )
+]
+
+# upper bound of distinct topics whose resolved handlers are cached
+DISPATCH_CACHE_SIZE = 16384
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+
+_UNRESOLVED = object()
+
+# topics get their own metric labels up to this many, events on any further topic are counted under 'other', e.g.
+# when websocket clients emit arbitrary topics
+MAX_TOPIC_LABELS = 256
+OTHER_TOPICS = 'other'
+
+EMITTED = metrics.counter('bus_events_emitted_total', 'Events dispatched to the bus handlers', ('topic',))
+HANDLER_ERRORS = metrics.counter('bus_handler_errors_total', 'Exceptions raised by bus handlers', ('topic',))
+HANDLER_SECONDS = metrics.histogram(
+    'bus_handler_seconds', 'Bus handler run time, for coroutine handlers from their first step until they finish',
+    ('handler',))
+
+
+def handler_name(f: Callable) -> str:
+    """A readable name of a bus handler for metrics and logs, e.g. wifi.main.<locals>.on_config_changed."""
+    name = getattr(f, '__qualname__', None)
+    if name is None:
+        return repr(f)
+    return f'{getattr(f, "__module__", None) or "?"}.{name}'
+
+
+class _Handler:
+    """One subscription of a handler, with everything dispatching needs so the hot path does no lookups."""
+    __slots__ = ('f', 'order', 'name', 'timer', 'limit')
+
+    def __init__(self, f: Callable[[Event], None], order: int, name: str, limit: Optional[asyncio.Semaphore]):
+        self.f = f
+        self.order = order
+        self.name = name
+        self.timer = HANDLER_SECONDS.labels(name)
+        self.limit = limit
 
 
 class EventException(Exception):
@@ -14,13 +80,39 @@ class EventException(Exception):
 
 
 class EventBus:
+    """
+    Publish/subscribe event bus.
+    Handlers subscribe to exact topics or to patterns, where `*` matches a single level and a trailing `#` any number
+    of levels, e.g. `tracking.*` or `tracking.#`. The handlers of each emitted topic are resolved once and cached until
+    the subscriptions change.
+    """
+
     def __init__(self, scheduler=ensure_future, loop=None):
         self._events = defaultdict(OrderedDict)
+        self._patterns = TopicTrie()
+        self._counter = count()
+        self._dispatch: Dict[str, Tuple[_Handler, ...]] = TopicCache(DISPATCH_CACHE_SIZE)
+        self._taps: Tuple[Callable[[str, Event], None], ...] = ()
+        # the handler called right now, coroutine handlers only for their synchronous part
+        self._running: Optional[_Handler] = None
+        self._emitted: Dict[str, metrics.CounterValue] = {}
+
+        # coalescing, see coalesce()
+        self._coalescers: Dict[str, Coalescer] = {}
+        self._coalesce_patterns = TopicTrie()
+        self._coalescing: Dict[str, Optional[Coalescer]] = {}
         self._all_handlers = list()
         self._schedule = scheduler
         self._loop = loop
 
-    def _add_event_handler(self, event_type: str, k: Callable[[Event], None], v: Callable[[Event], None]) -> None:
+        # queued mode, see start()
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._overflow = OVERFLOW_BLOCK
+        self._counters = {'processed': 0, 'dropped_oldest': 0, 'dropped_newest': 0, 'inline': 0}
+
+    def _add_event_handler(self, event_type: str, k: Callable[[Event], None], v: Callable[[Event], None],
+                           concurrency: Optional[int] = None) -> None:
         # Fire 'new_listener' *before* adding the new listener!
         # self.emit('new_listener', event, k)
 
@@ -28,53 +120,321 @@ class EventBus:
         # Note that k and v are the same for `on` handlers, but
         # different for `once` handlers, where v is a wrapped version
         # of k which removes itself before calling k
-        self._events[event_type][k] = v
+        if self._patterns.is_pattern(event_type):
+            self._patterns.add(event_type, event_type)
+        # the limit belongs to this subscription, the same handler may be subscribed elsewhere with another one
+        limit = asyncio.Semaphore(concurrency) if concurrency is not None else None
+        self._events[event_type][k] = _Handler(v, next(self._counter), handler_name(k), limit)
+        self._dispatch.clear()
 
-    def on(self, event_type: str, callback: Optional[Callable[[Event], None]] = None) -> Callable:
+    def _resolve(self, event_type: str) -> Tuple[_Handler, ...]:
+        """Collect the handlers of exact and pattern subscriptions matching `event_type` in subscription order."""
+        found = []
+        subscriptions = [event_type] if event_type in self._events else []
+        subscriptions.extend(p for p in self._patterns.match(event_type) if p != event_type)
+        for subscription in subscriptions:
+            found.extend(self._events[subscription].values())
+        found.sort(key=lambda h: h.order)
+
+        handlers = tuple(found)
+        self._dispatch.put(event_type, handlers)
+        return handlers
+
+    def on(self, event_type: str, callback: Optional[Callable[[Event], None]] = None,
+           concurrency: Optional[int] = None) -> Callable:
+        """
+        Subscribe `callback` to `event_type`, which may be a pattern.
+        Args:
+            event_type (str): topic or topic pattern
+            callback (Callable): handler, may be a coroutine function. If None, a decorator is returned
+            concurrency (int): maximum number of concurrently running coroutines of this handler
+        """
         def _on(f):
-            self._add_event_handler(event_type, f, f)
+            self._add_event_handler(event_type, f, f, concurrency)
             return f
 
-        if self is None:
+        if callback is None:
             return _on
         else:
             return _on(callback)
 
+    def tap(self, f: Callable[[str, Event], None]) -> None:
+        """
+        Call `f(event_type, event)` synchronously for every dispatched event, e.g. to forward events elsewhere.
+        Taps see events after coalescing and do not count as handlers.
+        """
+        self._taps = self._taps + (f,)
+
+    def untap(self, f: Callable[[str, Event], None]) -> None:
+        self._taps = tuple(x for x in self._taps if x != f)
+
+    def coalesce(self, event_type: str, mode: str, window: float,
+                 key: Optional[Callable[[str, Event], Hashable]] = None) -> Coalescer:
+        """
+        Coalesce high frequency events before they reach any handler, see Coalescer for the modes.
+        Args:
+            event_type (str): topic or topic pattern to coalesce
+            mode (str): 'debounce', 'throttle' or 'latest'
+            window (float): window length in seconds
+            key (Callable): maps (event_type, event) to the key events are coalesced by, the topic by default
+        """
+        self.uncoalesce(event_type)
+        coalescer = Coalescer(self._emit, mode, window, key)
+        self._coalescers[event_type] = coalescer
+        self._coalesce_patterns.add(event_type, event_type)
+        self._coalescing.clear()
+        return coalescer
+
+    def uncoalesce(self, event_type: str) -> None:
+        """Stop coalescing `event_type`, dispatching whatever is still pending."""
+        coalescer = self._coalescers.pop(event_type, None)
+        if coalescer is not None:
+            self._coalesce_patterns.remove(event_type, event_type)
+            self._coalescing.clear()
+            coalescer.flush()
+
+    def _resolve_coalescer(self, event_type: str) -> Optional[Coalescer]:
+        """The most recently registered coalescer whose pattern matches `event_type`."""
+        patterns = list(self._coalesce_patterns.match(event_type))
+        coalescer = None
+        for pattern in self._coalescers:
+            if pattern in patterns:
+                coalescer = self._coalescers[pattern]
+        self._coalescing[event_type] = coalescer
+        return coalescer
+
     def emit(self, event_type: str, event: Event):
-        LOG.debug(f'Bus - {event_type}: {event}')
-        handled = False
+        if self._coalescers:
+            coalescer = self._coalescing.get(event_type, _UNRESOLVED)
+            if coalescer is _UNRESOLVED:
+                coalescer = self._resolve_coalescer(event_type)
+            if coalescer is not None:
+                coalescer.push(event_type, event)
+                to_handle = self._dispatch.get(event_type)
+                if to_handle is None:
+                    to_handle = self._resolve(event_type)
+                return bool(to_handle)
+
+        return self._emit(event_type, event)
 
-        to_handle = list(self._events[event_type].values())
-        for f in to_handle:
-            result = f(event)
+    def _count_emit(self, event_type: str) -> None:
+        emitted = self._emitted.get(event_type)
+        if emitted is None:
+            if len(EMITTED.values) < MAX_TOPIC_LABELS:
+                emitted = self._emitted[event_type] = EMITTED.labels(event_type)
+            else:
+                emitted = EMITTED.labels(OTHER_TOPICS)
+        emitted.value += 1
+
+    def _topic_label(self, event_type: str) -> str:
+        """The metric label of `event_type`, its emit was counted before."""
+        return event_type if event_type in self._emitted else OTHER_TOPICS
+
+    def _emit(self, event_type: str, event: Event) -> bool:
+        if LOG.level <= DEBUG:
+            # checked here, the arguments would be packed on every emit otherwise
+            LOG.debug('Bus - %s: %s', event_type, event, extra={'topic': event_type})
+        self._count_emit(event_type)
+
+        # handlers are cached as an immutable tuple, so handlers removing themselves while we iterate is safe
+        to_handle = self._dispatch.get(event_type)
+        if to_handle is None:
+            to_handle = self._resolve(event_type)
+
+        if not to_handle and type(event) == EventError:
+            raise EventException("Uncaught, unspecified 'error' event.")
+
+        for tap in self._taps:
+            tap(event_type, event)
+
+        if self._queue is not None:
+            try:
+                self._enqueue((event_type, event, to_handle))
+            except asyncio.QueueFull:
+                if self._overflow == OVERFLOW_DROP_NEWEST:
+                    self._counters['dropped_newest'] += 1
+                    return False
+                # block: we cannot wait here, so the producer pays by running the handlers itself
+                self._counters['inline'] += 1
+                self._dispatch_now(event_type, event, to_handle)
+            return bool(to_handle)
+
+        self._dispatch_now(event_type, event, to_handle)
+        return bool(to_handle)
+
+    async def emit_async(self, event_type: str, event: Event) -> bool:
+        """
+        Like emit, but in queued mode with the 'block' overflow policy waits for room in the queue instead of
+        dispatching inline.
+        """
+        if self._queue is None or self._overflow != OVERFLOW_BLOCK or not self._queue.full() or self._coalescers:
+            return self.emit(event_type, event)
+
+        if LOG.level <= DEBUG:
+            LOG.debug('Bus - %s: %s', event_type, event, extra={'topic': event_type})
+        self._count_emit(event_type)
+        to_handle = self._dispatch.get(event_type)
+        if to_handle is None:
+            to_handle = self._resolve(event_type)
+        for tap in self._taps:
+            tap(event_type, event)
+        await self._queue.put((event_type, event, to_handle))
+        return bool(to_handle)
+
+    def _dispatch_now(self, event_type: str, event: Event, to_handle: Tuple[_Handler, ...]) -> None:
+        for handler in to_handle:
+            timer = handler.timer
+            # handlers may emit themselves, restore the outer one afterwards
+            running, self._running = self._running, handler
+            begin = perf_counter()
+            try:
+                result = handler.f(event)
+            except Exception:
+                HANDLER_ERRORS.labels(self._topic_label(event_type)).inc()
+                raise
+            finally:
+                self._running = running
 
             # If f was a coroutine function, we need to schedule it and
             # handle potential errors
             if iscoroutine and iscoroutine(result):
+                result = self._timed(timer, result)
+                if handler.limit is not None:
+                    result = self._limited(handler.limit, result)
+
                 if self._loop:
                     d = self._schedule(result, loop=self._loop)
                 else:
                     d = self._schedule(result)
+                # tasks carry the handler name, e.g. for the loop monitor
+                if hasattr(d, 'set_name'):
+                    d.set_name(handler.name)
 
                 # scheduler gave us an asyncio Future
                 if hasattr(d, 'add_done_callback'):
                     @d.add_done_callback
                     def _callback(f):
-                        exc = f.exception()
+                        exc = None if f.cancelled() else f.exception()
                         if exc:
+                            HANDLER_ERRORS.labels(self._topic_label(event_type)).inc()
                             self.emit('error', EventError(exc))
 
                 # scheduler gave us a twisted Deferred
                 elif hasattr(d, 'addErrback'):
                     @d.addErrback
                     def _callback(exc: Exception):
+                        HANDLER_ERRORS.labels(self._topic_label(event_type)).inc()
                         self.emit('error', EventError(exc))
-            handled = True
+            else:
+                timer.observe(perf_counter() - begin)
 
-        if not handled and type(event) == EventError:
-            raise EventException("Uncaught, unspecified 'error' event.")
+    @staticmethod
+    async def _limited(limit: asyncio.Semaphore, coro):
+        async with limit:
+            return await coro
 
-        return handled
+    @staticmethod
+    async def _timed(timer: metrics.HistogramValue, coro):
+        begin = perf_counter()
+        try:
+            return await coro
+        finally:
+            timer.observe(perf_counter() - begin)
+
+    def _enqueue(self, item: Tuple) -> None:
+        if self._overflow == OVERFLOW_DROP_OLDEST and self._queue.full():
+            self._queue.get_nowait()
+            self._queue.task_done()
+            self._counters['dropped_oldest'] += 1
+        self._queue.put_nowait(item)
+
+    def _report_error(self, exc: BaseException) -> None:
+        try:
+            self.emit('error', EventError(exc))
+        except EventException:
+            LOG.error(f'Unhandled exception in bus handler: {exc!r}')
+
+    async def _work(self) -> None:
+        while True:
+            event_type, event, to_handle = await self._queue.get()
+            try:
+                pending = []
+                for handler in to_handle:
+                    timer = handler.timer
+                    self._running = handler
+                    begin = perf_counter()
+                    try:
+                        result = handler.f(event)
+                    except Exception as e:
+                        HANDLER_ERRORS.labels(self._topic_label(event_type)).inc()
+                        self._report_error(e)
+                        continue
+                    finally:
+                        self._running = None
+                    if iscoroutine(result):
+                        result = self._timed(timer, result)
+                        limit = handler.limit
+                        task = ensure_future(self._limited(limit, result) if limit is not None else result)
+                        task.set_name(handler.name)
+                        pending.append(task)
+                    else:
+                        timer.observe(perf_counter() - begin)
+
+                if pending:
+                    for result in await asyncio.gather(*pending, return_exceptions=True):
+                        if isinstance(result, Exception):
+                            HANDLER_ERRORS.labels(self._topic_label(event_type)).inc()
+                            self._report_error(result)
+                self._counters['processed'] += 1
+            finally:
+                self._queue.task_done()
+
+    def start(self, workers: int = 4, queue_size: int = 1024, overflow: str = OVERFLOW_BLOCK) -> None:
+        """
+        Switch to queued mode: emit only enqueues events and a pool of workers runs the handlers.
+        Must be called from within the running event loop.
+        Args:
+            workers (int): number of events handled concurrently
+            queue_size (int): maximum number of pending events
+            overflow (str): what emit does on a full queue, one of 'block', 'drop_oldest' or 'drop_newest'
+        """
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+            raise ValueError(f'unknown overflow policy {overflow!r}')
+        if self._queue is not None:
+            raise EventException('Event bus is already running in queued mode')
+
+        self._overflow = overflow
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(workers)]
+
+    async def stop(self, drain: bool = True) -> None:
+        """Leave queued mode, by default after handling all pending events."""
+        if self._queue is None:
+            return
+        if drain:
+            await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+
+    def running_handler(self) -> Optional[str]:
+        """Name of the handler being called right now, if any. Safe to call from other threads."""
+        handler = self._running
+        return handler.name if handler is not None else None
+
+    def stats(self) -> Dict:
+        """Queue depth and drop counters of the queued mode, and the number of coalesced events."""
+        return dict(
+            self._counters,
+            coalesced=sum(c.coalesced for c in self._coalescers.values()),
+            queued=self._queue is not None,
+            queue_depth=self._queue.qsize() if self._queue is not None else 0,
+            queue_size=self._queue.maxsize if self._queue is not None else 0,
+            workers=len(self._workers),
+            overflow=self._overflow
+        )
 
     def once(self, event_type: str, f: Optional[Callable[[Event], None]] = None):
         """The same as ``ee.on``, except that the listener is automatically
@@ -99,27 +459,54 @@ class EventBus:
     def remove_listener(self, event_type: str, f: Callable[[Event], None]) -> None:
         """Removes the function ``f`` from ``event``."""
         self._events[event_type].pop(f)
+        if not self._events[event_type]:
+            del self._events[event_type]
+            self._patterns.remove(event_type, event_type)
+        self._dispatch.clear()
 
     def remove_all_listeners(self, event_type: Optional[str] = None) -> None:
         """Remove all listeners attached to ``event``.
         If ``event`` is ``None``, remove all listeners on all events.
         """
         if event_type is not None:
-            self._events[event_type] = OrderedDict()
+            self._events.pop(event_type, None)
+            self._patterns.remove(event_type, event_type)
         else:
             self._events = defaultdict(OrderedDict)
+            self._patterns = TopicTrie()
+        self._dispatch.clear()
 
     def listeners(self, event_type: str) -> List[Callable[[Event], None]]:
         """Returns a list of all listeners registered to the ``event``.
         """
-        return list(self._events[event_type].keys())
+        return list(self._events.get(event_type, ()))
 
 
 e_bus = EventBus()
 
 
 async def main(shutdown_signal: asyncio.Event):
+    config.register_module(MODULE_NAME, CONFIG_FIELDS)
+    set_default_codec(config.get(MODULE_NAME, 'codec'))
+
+    for topic, mode, window_ms in config.get(MODULE_NAME, 'coalesce'):
+        # entries from the config file, the environment or the config API may come as strings
+        try:
+            window = float(window_ms) / 1000
+        except (TypeError, ValueError):
+            LOG.error(f'Not coalescing {topic}, the window {window_ms!r} is not a number of milliseconds')
+            continue
+        if mode not in COALESCE_MODES:
+            LOG.error(f'Not coalescing {topic}, unknown mode {mode!r}')
+            continue
+        e_bus.coalesce(topic, mode, window)
+
+    if config.get(MODULE_NAME, 'queued'):
+        e_bus.start(workers=config.get(MODULE_NAME, 'workers'), queue_size=config.get(MODULE_NAME, 'queue_size'),
+                    overflow=config.get(MODULE_NAME, 'overflow'))
+
     await shutdown_signal.wait()
+    await e_bus.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,74 @@
+import asyncio
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+from bus.events import Event
+
+MODE_DEBOUNCE = 'debounce'
+MODE_THROTTLE = 'throttle'
+MODE_LATEST = 'latest'
+MODES = (MODE_DEBOUNCE, MODE_THROTTLE, MODE_LATEST)
+
+
+def topic_key(event_type: str, event: Event) -> Hashable:
+    return event_type
+
+
+class Coalescer:
+    """
+    Collapses bursts of events into at most one dispatch per window and key, always with the newest event.
+    Modes:
+        debounce: dispatch once no new event arrived for `window` seconds
+        throttle: dispatch the first event right away, then at most the newest one at the end of each window
+        latest: collect events for `window` seconds after the first one, then dispatch the newest one per key
+    By default every topic is its own key, `key` can group by anything else, e.g. a sensor id in the event data.
+    """
+
+    def __init__(self, dispatch: Callable[[str, Event], None], mode: str, window: float,
+                 key: Optional[Callable[[str, Event], Hashable]] = None):
+        if mode not in MODES:
+            raise ValueError(f'unknown coalescing mode {mode!r}')
+        self.dispatch = dispatch
+        self.mode = mode
+        self.window = window
+        self.key = key or topic_key
+        self.pending: Dict[Hashable, Tuple[str, Event]] = {}
+        self.timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        self.coalesced = 0
+
+    def push(self, event_type: str, event: Event) -> None:
+        key = self.key(event_type, event)
+        timer = self.timers.get(key)
+
+        if self.mode == MODE_THROTTLE and timer is None:
+            # leading edge, nothing pending to coalesce with
+            self.timers[key] = asyncio.get_event_loop().call_later(self.window, self._flush, key)
+            self.dispatch(event_type, event)
+            return
+
+        if key in self.pending:
+            self.coalesced += 1
+        self.pending[key] = (event_type, event)
+
+        if self.mode == MODE_DEBOUNCE and timer is not None:
+            timer.cancel()
+            timer = None
+        if timer is None:
+            self.timers[key] = asyncio.get_event_loop().call_later(self.window, self._flush, key)
+
+    def _flush(self, key: Hashable) -> None:
+        del self.timers[key]
+        item = self.pending.pop(key, None)
+        if item is None:
+            return
+        if self.mode == MODE_THROTTLE:
+            # keep throttling for another window after the trailing dispatch
+            self.timers[key] = asyncio.get_event_loop().call_later(self.window, self._flush, key)
+        self.dispatch(*item)
+
+    def flush(self) -> None:
+        """Dispatch everything pending right away."""
+        for key in list(self.timers):
+            self.timers.pop(key).cancel()
+        pending, self.pending = self.pending, {}
+        for item in pending.values():
+            self.dispatch(*item)
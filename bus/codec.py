@@ -0,0 +1,97 @@
+import json
+from typing import Any, Dict
+
+from bus.events import Event
+from log import LOG
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Codec:
+    """Encodes the plain dicts produced by Event.to_dict to bytes and back."""
+    name = None
+    content_type = None
+
+    def encode(self, obj: Dict) -> bytes:
+        raise NotImplementedError()
+
+    def decode(self, data: bytes) -> Any:
+        raise NotImplementedError()
+
+
+class JsonCodec(Codec):
+    name = 'json'
+    content_type = 'application/json'
+
+    def encode(self, obj: Dict) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(Codec):
+    name = 'orjson'
+    content_type = 'application/json'
+
+    def encode(self, obj: Dict) -> bytes:
+        return orjson.dumps(obj)
+
+    def decode(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def encode(self, obj: Dict) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+codecs: Dict[str, Codec] = {'json': JsonCodec()}
+if orjson is not None:
+    codecs['orjson'] = OrjsonCodec()
+if msgpack is not None:
+    codecs['msgpack'] = MsgpackCodec()
+
+_default = codecs['json']
+
+
+def get_codec(name: str = None) -> Codec:
+    """The codec called `name`, or the default codec if name is None."""
+    if name is None:
+        return _default
+    try:
+        return codecs[name]
+    except KeyError:
+        raise ValueError(f'codec {name!r} is not available') from None
+
+
+def set_default_codec(name: str) -> Codec:
+    """Make `name` the default codec, falling back to JSON if its backend is not installed."""
+    global _default
+    if name not in codecs:
+        LOG.warning(f'Codec {name} is not installed, using json')
+        name = 'json'
+    _default = codecs[name]
+    return _default
+
+
+def encode_event(event: Event, codec: Codec = None) -> bytes:
+    return (codec or _default).encode(event.to_dict())
+
+
+def decode_event(data: bytes, codec: Codec = None) -> Event:
+    return Event.from_dict((codec or _default).decode(data))
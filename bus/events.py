@@ -1,17 +1,82 @@
 import json
-from typing import Dict, Optional
+from typing import Any, Dict, Optional, Tuple, Type
+
+# event type name: event class, used to restore the right class when decoding
+_event_types: Dict[str, Type['Event']] = {}
+
+
+class RemoteError(Exception):
+    """An exception restored from a serialized EventError, keeping the name of the original exception type."""
+
+    def __init__(self, type_name: str, message: str):
+        super().__init__(message)
+        self.type_name = type_name
+
+
+def _encode_value(value: Any, kind: Optional[type]) -> Any:
+    if value is None or kind is None:
+        return value
+    if kind is Exception:
+        type_name = value.type_name if isinstance(value, RemoteError) else type(value).__name__
+        return {'type': type_name, 'message': str(value)}
+    if hasattr(kind, 'from_dict'):
+        return value.to_dict()
+    return value
+
+
+def _decode_value(value: Any, kind: Optional[type]) -> Any:
+    if value is None or kind is None:
+        return value
+    if kind is Exception:
+        return RemoteError(value.get('type'), value.get('message'))
+    if hasattr(kind, 'from_dict'):
+        return kind.from_dict(value)
+    if not isinstance(value, kind):
+        raise ValueError(f'expected {kind.__name__}, got {type(value).__name__}')
+    return value
 
 
 class Event:
+    """
+    Base class of everything sent over the bus.
+    Events are slotted, subclasses must declare __slots__ for their own fields and extend `schema`, the
+    (field name, type) pairs that make up their serialized form. A type of None means any JSON compatible value,
+    types with to_dict/from_dict (like common.User) are nested.
+    """
+    __slots__ = ('data',)
+    schema: Tuple[Tuple[str, Optional[type]], ...] = (('data', None),)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _event_types[cls.__name__] = cls
+
     def __init__(self, data: Optional[Dict] = None):
         self.data = data
 
-    def serialize(self) -> Dict:
-        return json.dumps(self.data)
+    def to_dict(self) -> Dict:
+        obj = {'type': type(self).__name__}
+        for name, kind in self.schema:
+            obj[name] = _encode_value(getattr(self, name, None), kind)
+        return obj
+
+    @staticmethod
+    def from_dict(obj: Dict) -> 'Event':
+        """Restore an event from to_dict output, as an instance of the class it was created from."""
+        cls = _event_types.get(obj.get('type'), Event)
+        event = cls.__new__(cls)
+        for name, kind in cls.schema:
+            setattr(event, name, _decode_value(obj.get(name), kind))
+        return event
+
+    def serialize(self) -> str:
+        return json.dumps(self.to_dict())
 
     @staticmethod
     def deserialize(value: str) -> 'Event':
         obj = json.loads(value)
+        if isinstance(obj, dict) and obj.get('type') in _event_types:
+            return Event.from_dict(obj)
+        # plain data, as sent by older clients
         return Event(obj)
 
     def __str__(self) -> str:
@@ -20,14 +85,32 @@ class Event:
         else:
             return ''
 
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+
+_event_types[Event.__name__] = Event
+
 
 class InfoEvent(Event):
+    __slots__ = ('message',)
+    schema = Event.schema + (('message', str),)
+
     def __init__(self, message: str):
         super().__init__()
         self.message = message
 
+    def __str__(self) -> str:
+        return self.message
+
 
 class EventError(Event):
+    __slots__ = ('error',)
+    schema = Event.schema + (('error', Exception),)
+
     def __init__(self, error: Exception):
         super().__init__()
         self.error = error
+
+    def __str__(self) -> str:
+        return repr(self.error)
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterator, List
+
+
+class _Node:
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children: Dict[str, '_Node'] = {}
+        self.values: Dict[Hashable, None] = {}
+
+
+class TopicTrie:
+    """
+    Subscription patterns indexed level by level, so that matching a topic costs O(levels) no matter how many
+    patterns are registered.
+    A `single` level matches exactly one level, a trailing `multi` level matches any number of levels, including none.
+    With the bus defaults `tracking.*` matches `tracking.event` and `tracking.#` matches `tracking`, `tracking.event`
+    and `tracking.event.user_enter`.
+    """
+
+    def __init__(self, sep: str = '.', single: str = '*', multi: str = '#'):
+        self.sep = sep
+        self.single = single
+        self.multi = multi
+        self._root = _Node()
+
+    def is_pattern(self, topic: str) -> bool:
+        return any(level in (self.single, self.multi) for level in topic.split(self.sep))
+
+    def add(self, pattern: str, value: Hashable) -> None:
+        levels = pattern.split(self.sep)
+        if self.multi in levels[:-1]:
+            raise ValueError(f'{self.multi!r} is only allowed as the last level of {pattern!r}')
+        node = self._root
+        for level in levels:
+            node = node.children.setdefault(level, _Node())
+        node.values[value] = None
+
+    def remove(self, pattern: str, value: Hashable) -> None:
+        path: List[_Node] = [self._root]
+        levels = pattern.split(self.sep)
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].values.pop(value, None)
+
+        # prune empty branches
+        for level, node, parent in zip(reversed(levels), reversed(path[1:]), reversed(path[:-1])):
+            if node.values or node.children:
+                break
+            del parent.children[level]
+
+    def match(self, topic: str) -> Iterator[Hashable]:
+        """Yield the values of all patterns matching `topic`."""
+        levels = topic.split(self.sep)
+        stack = [(self._root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            multi = node.children.get(self.multi)
+            if multi is not None:
+                yield from multi.values
+            if depth == len(levels):
+                yield from node.values
+                continue
+            child = node.children.get(levels[depth])
+            if child is not None:
+                stack.append((child, depth + 1))
+            if levels[depth] != self.single:
+                child = node.children.get(self.single)
+                if child is not None:
+                    stack.append((child, depth + 1))
+
+
+class TopicCache(OrderedDict):
+    """
+    Per topic results of matching, bounded to `size` topics. When full the least recently resolved topic is evicted,
+    one at a time, so that a few more topics than fit only cost their own misses instead of emptying the cache.
+    Hits are plain dict lookups and do not reorder anything.
+    """
+
+    def __init__(self, size: int):
+        super().__init__()
+        self.size = size
+
+    def put(self, topic: str, value) -> None:
+        if len(self) >= self.size:
+            self.popitem(last=False)
+        self[topic] = value
+
+
+def topic_matches(pattern: str, topic: str, sep: str = '.', single: str = '*', multi: str = '#') -> bool:
+    """Match a single topic against a single pattern, using the same rules as TopicTrie."""
+    pattern_levels = pattern.split(sep)
+    topic_levels = topic.split(sep)
+    for i, level in enumerate(pattern_levels):
+        if level == multi:
+            return True
+        if i >= len(topic_levels) or (level != single and level != topic_levels[i]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
@@ -1,54 +1,239 @@
+import asyncio
 import json
-import sys
-import traceback
-import tornado
+from collections import deque
+from time import perf_counter
+from typing import Dict, Iterable, List, Set, Tuple
 
-from bus import EventBusEmitter
-from bus.message import Message
+from aiohttp import web, WSMsgType
+from aiohttp.abc import Request
+
+from bus import EventBus, e_bus
+from bus.events import Event
+from bus.topics import TopicTrie
 from log import LOG
+import metrics
+
+SLOW_CLIENT_COALESCE = 'coalesce'
+SLOW_CLIENT_DROP = 'drop'
+
+CLIENTS = metrics.gauge('websocket_clients', 'Connected websocket clients')
+RECEIVED = metrics.counter('websocket_received_total', 'Messages received from websocket clients', ('type',))
+SENT = metrics.counter('websocket_sent_total', 'Messages sent to websocket clients')
+SEND_SECONDS = metrics.histogram('websocket_send_seconds', 'Time to hand a message to a websocket client')
+HANDLE_SECONDS = metrics.histogram('websocket_handle_seconds', 'Time to handle a message from a websocket client',
+                                   ('type',))
+
+
+class WebsocketClient:
+    """
+    A connected websocket with its own bounded send queue, drained by a dedicated sender task so that a slow client
+    never holds up the bus or the other clients.
+    """
+
+    def __init__(self, ws: web.WebSocketResponse, queue_size: int, slow_policy: str):
+        self.ws = ws
+        self.queue_size = queue_size
+        self.slow_policy = slow_policy
+        self.filters: Set[str] = set()
+        self.queue = deque()  # (topic, payload)
+        self.ready = asyncio.Event()
+        self.dropped = False
+        self.coalesced = 0
+
+    def push(self, topic: str, payload: str) -> bool:
+        """
+        Queue a message for sending.
+        Returns:
+            False if the client is too slow and has to be disconnected
+        """
+        if len(self.queue) >= self.queue_size:
+            if self.slow_policy == SLOW_CLIENT_DROP:
+                self.dropped = True
+                return False
+            self._compact()
+        self.queue.append((topic, payload))
+        self.ready.set()
+        return True
+
+    def _compact(self) -> None:
+        """Keep only the newest message per topic, then drop the oldest messages if that was not enough."""
+        latest: Dict[str, str] = {}
+        for topic, payload in self.queue:
+            latest.pop(topic, None)
+            latest[topic] = payload
+        self.coalesced += len(self.queue) - len(latest)
+        self.queue = deque(latest.items())
+        while len(self.queue) >= self.queue_size:
+            self.queue.popleft()
+            self.coalesced += 1
+
+    async def send_loop(self) -> None:
+        while not self.ws.closed:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue and not self.ws.closed:
+                _, payload = self.queue.popleft()
+                begin = perf_counter()
+                await self.ws.send_str(payload)
+                SEND_SECONDS.observe(perf_counter() - begin)
+                SENT.inc()
+
+
+class WebsocketBridge:
+    """
+    Bridges the event bus to websocket clients.
+    Clients pick the topics they receive with bus topic patterns, either through the `topics` query parameter
+    (comma separated, all topics by default) or with {"type": "subscribe", "topics": [...]} and
+    {"type": "unsubscribe", "topics": [...]} messages. Invalid patterns are answered with
+    {"type": "error", "error": ..., "topics": [...]}. Events are sent as {"topic": ..., "event": ...}, serialized once
+    per broadcast no matter how many clients receive them. Clients may emit events with
+    {"type": "emit", "topic": ..., "event": ...}.
+    """
+
+    def __init__(self, bus: EventBus = e_bus, queue_size: int = 256, slow_policy: str = SLOW_CLIENT_COALESCE):
+        self.bus = bus
+        self.queue_size = queue_size
+        self.slow_policy = slow_policy
+        self.clients: Set[WebsocketClient] = set()
+        self._filters = TopicTrie()
+        self._dispatch: Dict[str, Tuple[WebsocketClient, ...]] = {}
+
+    def _subscribe(self, client: WebsocketClient, topics: Iterable[str]) -> List:
+        """
+        Returns:
+            the topics that are not valid patterns, e.g. a.#.b, and were not subscribed
+        """
+        invalid = []
+        for topic in topics:
+            if not isinstance(topic, str):
+                invalid.append(topic)
+            elif topic and topic not in client.filters:
+                try:
+                    self._filters.add(topic, (topic, client))
+                except ValueError:
+                    invalid.append(topic)
+                    continue
+                client.filters.add(topic)
+        self._dispatch.clear()
+        return invalid
 
-client_connections = []
+    @staticmethod
+    def _reject(client: WebsocketClient, topics: List) -> None:
+        client.push('error', json.dumps({'type': 'error', 'error': 'invalid topic pattern', 'topics': topics},
+                                        default=str))
 
+    def _unsubscribe(self, client: WebsocketClient, topics: Iterable[str]) -> None:
+        for topic in topics:
+            if topic in client.filters:
+                client.filters.discard(topic)
+                self._filters.remove(topic, (topic, client))
+        self._dispatch.clear()
 
-class WebsocketEventHandler(tornado.websocket.WebSocketHandler):
-    def __init__(self, application, request, **kwargs):
-        tornado.websocket.WebSocketHandler.__init__(
-            self, application, request, **kwargs)
-        self.emitter = EventBusEmitter
+    def _on_event(self, event_type: str, event: Event) -> None:
+        clients = self._dispatch.get(event_type)
+        if clients is None:
+            clients = tuple({client for _, client in self._filters.match(event_type)})
+            self._dispatch[event_type] = clients
+        if not clients:
+            return
+
+        payload = json.dumps({'topic': event_type, 'event': event.to_dict()}, default=str)
+        for client in clients:
+            if client.dropped:
+                continue
+            if not client.push(event_type, payload):
+                LOG.warning('Dropping slow websocket client')
+                asyncio.ensure_future(client.ws.close())
 
-    def on(self, event_name, handler):
-        self.emitter.on(event_name, handler)
+    def _attach(self, client: WebsocketClient) -> None:
+        if not self.clients:
+            self.bus.tap(self._on_event)
+        self.clients.add(client)
+        CLIENTS.inc()
+
+    def _detach(self, client: WebsocketClient) -> None:
+        if client not in self.clients:
+            return
+        self._unsubscribe(client, list(client.filters))
+        self.clients.discard(client)
+        CLIENTS.dec()
+        if not self.clients:
+            self.bus.untap(self._on_event)
 
-    def on_message(self, message):
-        # LOG.debug(message)
+    def _on_message(self, client: WebsocketClient, message: str) -> None:
+        begin = perf_counter()
         try:
-            deserialized_message = Message.deserialize(message)
-        except:
+            data = json.loads(message)
+            kind = data['type']
+        except (ValueError, KeyError, TypeError):
+            RECEIVED.labels('invalid').inc()
+            LOG.warning('Invalid websocket message')
             return
+        if kind not in ('subscribe', 'unsubscribe', 'emit'):
+            # unknown types are ignored, keep them out of the labels
+            kind = 'unknown'
+        RECEIVED.labels(kind).inc()
 
+        topics = data.get('topics', ())
+        if not isinstance(topics, list):
+            topics = [topics]
+        if kind == 'subscribe':
+            invalid = self._subscribe(client, topics)
+            if invalid:
+                self._reject(client, invalid)
+        elif kind == 'unsubscribe':
+            self._unsubscribe(client, [topic for topic in topics if isinstance(topic, str)])
+        elif kind == 'emit':
+            try:
+                event = Event.from_dict(data['event']) if data.get('event') else Event()
+                self.bus.emit(data['topic'], event)
+            except Exception as e:
+                LOG.exception(f'Failed to emit websocket message: {e}')
+        HANDLE_SECONDS.labels(kind).observe(perf_counter() - begin)
+
+    async def _send(self, client: WebsocketClient) -> None:
+        """Run the sender of `client`, a failed send ends the connection instead of leaving its queue undrained."""
         try:
-            self.emitter.emit(deserialized_message.type, deserialized_message)
-        except Exception as e:
-            LOG.exception(e)
-            traceback.print_exc(file=sys.stdout)
-            pass
-
-        for client in client_connections:
-            client.write_message(message)
-
-    def open(self):
-        self.write_message(Message("connected").serialize())
-        client_connections.append(self)
-
-    def on_close(self):
-        client_connections.remove(self)
-
-    def emit(self, channel_message):
-        if (hasattr(channel_message, 'serialize') and
-                callable(getattr(channel_message, 'serialize'))):
-            self.write_message(channel_message.serialize())
-        else:
-            self.write_message(json.dumps(channel_message))
-
-    def check_origin(self, origin):
-        return True
+            await client.send_loop()
+        except (ConnectionResetError, RuntimeError) as e:
+            LOG.warning(f'Websocket send failed, dropping the client: {e!r}')
+            self._detach(client)
+            await client.ws.close()
+
+    async def handle(self, request: Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        client = WebsocketClient(ws, self.queue_size, self.slow_policy)
+        self._attach(client)
+        sender = asyncio.ensure_future(self._send(client))
+
+        try:
+            topics = request.query.get('topics')
+            invalid = self._subscribe(client, topics.split(',') if topics else ['#'])
+            client.push('connected', json.dumps({'type': 'connected'}))
+            if invalid:
+                self._reject(client, invalid)
+
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT:
+                    self._on_message(client, msg.data)
+                elif msg.type == WSMsgType.ERROR:
+                    LOG.warning(f'Websocket closed with exception {ws.exception()}')
+        finally:
+            self._detach(client)
+            sender.cancel()
+        return ws
+
+    async def close(self) -> None:
+        """Disconnect all clients."""
+        for client in list(self.clients):
+            await client.ws.close(code=1001, message=b'Server shutdown')
+
+    def stats(self) -> Dict:
+        return {
+            'clients': len(self.clients),
+            'queued': sum(len(c.queue) for c in self.clients),
+            'coalesced': sum(c.coalesced for c in self.clients)
+        }
+
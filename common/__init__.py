@@ -1,6 +1,16 @@
+from typing import Dict
 
 
 class User:
+    __slots__ = ('name', 'mac')
+
     def __init__(self, name: str, mac: str = None):
         self.name = name
         self.mac = mac
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'mac': self.mac}
+
+    @classmethod
+    def from_dict(cls, obj: Dict) -> 'User':
+        return cls(obj['name'], obj.get('mac'))
@@ -1,8 +1,23 @@
+from typing import List
+
 from bus import Event
 from common import User
 
 
 class TrackingEvent(Event):
+    __slots__ = ('user',)
+    schema = Event.schema + (('user', User),)
+
     def __init__(self, user: User):
         super().__init__()
         self.user = user
+
+
+class ConfigChangedEvent(Event):
+    __slots__ = ('module', 'keys')
+    schema = Event.schema + (('module', str), ('keys', list))
+
+    def __init__(self, module: str, keys: List[str]):
+        super().__init__()
+        self.module = module
+        self.keys = keys
@@ -0,0 +1,65 @@
+from collections import namedtuple
+from typing import Dict, Iterable, List, NamedTuple
+
+from modular_conf import Config
+
+from bus import e_bus, EventBus
+from common.events import ConfigChangedEvent
+from config import config
+
+
+class LiveConfig:
+    """
+    Hands every module an immutable snapshot of its config, a named tuple read with plain attribute access, and keeps
+    it current when the config is updated at runtime.
+    An update only looks at the keys it contains, replaces the snapshots of the modules with changed values and emits
+    `config.changed.<module>` with the changed keys, so modules can re-apply their settings.
+    """
+
+    def __init__(self, config: Config = config, bus: EventBus = e_bus):
+        self.config = config
+        self.bus = bus
+        self._snapshots: Dict[str, NamedTuple] = {}
+
+    def register(self, module: str, fields: Iterable) -> NamedTuple:
+        """Register the config fields of a module, like Config.register_module, and return its snapshot."""
+        fields = list(fields)
+        self.config.register_module(module, fields)
+        names = [field.name for field in fields]
+        settings_type = namedtuple(f'{module.title()}Settings', names)
+        snapshot = settings_type(*(self.config.get(module, name) for name in names))
+        self._snapshots[module] = snapshot
+        return snapshot
+
+    def get(self, module: str) -> NamedTuple:
+        return self._snapshots[module]
+
+    def update(self, data: Dict[str, Dict], full: bool = False) -> Dict[str, List[str]]:
+        """
+        Update the config, see Config.update, and notify the modules whose values changed.
+        Returns:
+            the changed keys per module
+        """
+        self.config.update(data, full=full)
+
+        changes = {}
+        for module, values in data.items():
+            snapshot = self._snapshots.get(module)
+            if snapshot is None or not isinstance(values, dict):
+                continue
+            changed = {}
+            for key in values:
+                if key in snapshot._fields:
+                    value = self.config.get(module, key)
+                    if value != getattr(snapshot, key):
+                        changed[key] = value
+            if changed:
+                self._snapshots[module] = snapshot._replace(**changed)
+                changes[module] = sorted(changed)
+
+        for module, keys in changes.items():
+            self.bus.emit(f'config.changed.{module}', ConfigChangedEvent(module, keys))
+        return changes
+
+
+live_config = LiveConfig()
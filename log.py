@@ -1,23 +1,90 @@
-import inspect
+import asyncio
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
 import sys
+from types import CodeType
+from typing import Dict, List, Optional, Tuple
 
+from modular_conf.fields import BoolField, ChoiceField, IntField, StringField
 
-def _make_log_method(fn):
+from config import config
+
+MODULE_NAME = 'log'
+CONFIG_FIELDS = [
+    ChoiceField('level', default='debug', choices=('debug', 'info', 'warning', 'error'), type=str),
+    ChoiceField('format', default='text', choices=('text', 'json'), type=str),
+    BoolField('stdout', True),
+    StringField('file', default=''),
+    ChoiceField('rotation', default='size', choices=('none', 'size', 'time'), type=str),
+    IntField('max_bytes', default=10 * 1024 * 1024),
+    IntField('backup_count', default=5),
+    StringField('when', default='midnight')
+]
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s:%(name)s: %(message)s'
+TEXT_DATEFMT = '%H:%M:%S'
+
+# extra fields copied into structured records, pass them like LOG.info('...', extra={'user': name})
+JSON_EXTRA_FIELDS = ('topic', 'user', 'latency')
+
+
+def _make_log_method(fn, level, **defaults):
     @classmethod
-    def method(cls, *args, **kwargs):
-        cls._log(fn, *args, **kwargs)
+    def method(cls, msg, *args, **kwargs):
+        if level < cls.level:
+            # disabled levels cost a single comparison, nothing is formatted or looked up
+            cls._custom_name = None
+            return
+        if defaults:
+            kwargs = dict(defaults, **kwargs)
+        cls._log(level, msg, args, kwargs)
 
     method.__func__.__doc__ = fn.__doc__
     return method
 
 
+class JsonFormatter(logging.Formatter):
+    """Formats records as single line JSON objects."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'timestamp': record.created,
+            'level': record.levelname,
+            'module': record.name,
+            'message': record.getMessage()
+        }
+        for field in JSON_EXTRA_FIELDS:
+            value = record.__dict__.get(field)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread.
+    Unlike the stdlib QueueHandler it only merges the message arguments, which may be mutated after the call returns,
+    and leaves the actual formatting to the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
 class LOG:
     """
     Custom logger class that acts like logging.Logger
     The logger name is automatically generated by the module of the caller
+    Arguments are only formatted if the level is enabled, so pass them separately in hot paths.
     Usage:
-        >>> LOG.debug(f'My message: {debug_str}')
+        >>> LOG.debug('My message: %s', debug_str)
         13:12:43.673 - :<module>:1 - DEBUG - My message: hi
         >>> LOG('custom_name').debug('Another message')
         13:13:10.462 - custom_name - DEBUG - Another message
@@ -26,38 +93,118 @@ class LOG:
     _custom_name = None
     handler = None
     level = None
+    _listener = None
+
+    _loggers: Dict[str, logging.Logger] = {}
+    _call_sites: Dict[Tuple[CodeType, int], str] = {}
 
     # Copy actual logging methods from logging.Logger
     # Usage: LOG.debug(message)
-    debug = _make_log_method(logging.Logger.debug)
-    info = _make_log_method(logging.Logger.info)
-    warning = _make_log_method(logging.Logger.warning)
-    error = _make_log_method(logging.Logger.error)
-    exception = _make_log_method(logging.Logger.exception)
+    debug = _make_log_method(logging.Logger.debug, logging.DEBUG)
+    info = _make_log_method(logging.Logger.info, logging.INFO)
+    warning = _make_log_method(logging.Logger.warning, logging.WARNING)
+    error = _make_log_method(logging.Logger.error, logging.ERROR)
+    exception = _make_log_method(logging.Logger.exception, logging.ERROR, exc_info=True)
 
     @classmethod
     def init(cls):
+        """
+        Log to stdout in text format. All I/O happens on a background thread, the calling thread only puts records
+        in a queue.
+        """
         cls.level = logging.DEBUG
-        fmt = '%(asctime)s %(levelname)s:%(name)s: %(message)s'
-        datefmt = '%H:%M:%S'
-        formatter = logging.Formatter(fmt, datefmt)
-        cls.handler = logging.StreamHandler(sys.stdout)
-        cls.handler.setFormatter(formatter)
+        cls.handler = _QueueHandler(queue.SimpleQueue())
+        cls._listener = None
+        cls.set_outputs([cls.make_stream_handler(logging.Formatter(TEXT_FORMAT, TEXT_DATEFMT))])
+        atexit.register(cls.shutdown)
         cls.create_logger('')  # Enables logging in external modules
 
+    @staticmethod
+    def make_stream_handler(formatter: logging.Formatter) -> logging.Handler:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(formatter)
+        return handler
+
+    @classmethod
+    def set_outputs(cls, handlers: List[logging.Handler]) -> None:
+        """Replace the handlers doing the actual output on the listener thread."""
+        old = cls._listener
+        if old is not None:
+            old.stop()
+            for handler in old.handlers:
+                handler.close()
+        cls._listener = logging.handlers.QueueListener(cls.handler.queue, *handlers)
+        cls._listener.start()
+
+    @classmethod
+    def configure(cls, level: str = 'debug', format: str = 'text', stdout: bool = True, file: Optional[str] = None,
+                  rotation: str = 'size', max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5,
+                  when: str = 'midnight') -> None:
+        """
+        Reconfigure level and outputs.
+        Args:
+            level (str): 'debug', 'info', 'warning' or 'error'
+            format (str): 'text' or 'json' (one object per line)
+            stdout (bool): log to stdout
+            file (str): log file, if any
+            rotation (str): rotate the log file when it reaches max_bytes ('size'), on `when` ('time') or never
+            max_bytes (int): size limit for 'size' rotation
+            backup_count (int): number of rotated files to keep
+            when (str): interval of 'time' rotation, as understood by TimedRotatingFileHandler
+        """
+        if format == 'json':
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter(TEXT_FORMAT, TEXT_DATEFMT)
+
+        handlers = []
+        if stdout:
+            handlers.append(cls.make_stream_handler(formatter))
+        if file:
+            if rotation == 'size':
+                handler = logging.handlers.RotatingFileHandler(file, maxBytes=max_bytes, backupCount=backup_count)
+            elif rotation == 'time':
+                handler = logging.handlers.TimedRotatingFileHandler(file, when=when, backupCount=backup_count)
+            else:
+                handler = logging.FileHandler(file)
+            handler.setFormatter(formatter)
+            handlers.append(handler)
+
+        cls.set_outputs(handlers)
+        cls.set_level(logging.getLevelName(level.upper()))
+
+    @classmethod
+    def shutdown(cls) -> None:
+        """Flush pending records and stop the listener thread."""
+        listener, cls._listener = cls._listener, None
+        if listener is not None:
+            listener.stop()
+
+    @classmethod
+    def set_level(cls, level: int) -> None:
+        cls.level = level
+        for logger in cls._loggers.values():
+            logger.setLevel(level)
+
     @classmethod
     def create_logger(cls, name):
+        logger = cls._loggers.get(name)
+        if logger is not None:
+            return logger
+
         logger = logging.getLogger(name)
         logger.propagate = False
-        logger.addHandler(cls.handler)
+        if cls.handler not in logger.handlers:
+            logger.addHandler(cls.handler)
         logger.setLevel(cls.level)
+        cls._loggers[name] = logger
         return logger
 
     def __init__(self, name):
         LOG._custom_name = name
 
     @classmethod
-    def _log(cls, func, *args, **kwargs):
+    def _log(cls, level, msg, args, kwargs):
         if cls._custom_name is not None:
             name = cls._custom_name
             cls._custom_name = None
@@ -66,19 +213,24 @@ class LOG:
             # [0] - _log()
             # [1] - debug(), info(), warning(), or error()
             # [2] - caller
-            stack = inspect.stack()
+            frame = sys._getframe(2)
+            call_site = (frame.f_code, frame.f_lineno)
+            name = cls._call_sites.get(call_site)
+            if name is None:
+                name = f'{frame.f_globals.get("__name__", "")}:{frame.f_code.co_name}:{frame.f_lineno}'
+                cls._call_sites[call_site] = name
 
-            # Record:
-            # [0] - frame object
-            # [1] - filename
-            # [2] - line number
-            # [3] - function
-            # ...
-            record = stack[2]
-            mod = inspect.getmodule(record[0])
-            module_name = mod.__name__ if mod else ''
-            name = module_name + ':' + record[3] + ':' + str(record[2])
-        func(cls.create_logger(name), *args, **kwargs)
+        logger = cls._loggers.get(name)
+        if logger is None:
+            logger = cls.create_logger(name)
+        logger.log(level, msg, *args, **kwargs)
 
 
 LOG.init()
+
+
+async def main(shutdown_signal: asyncio.Event):
+    config.register_module(MODULE_NAME, CONFIG_FIELDS)
+    LOG.configure(**{field.name: config.get(MODULE_NAME, field.name) for field in CONFIG_FIELDS})
+
+    await shutdown_signal.wait()
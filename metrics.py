@@ -0,0 +1,223 @@
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+# seconds, suited to everything from a bus handler to a presence scan
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class GaugeValue:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set_function(self, f: Callable[[], float]) -> None:
+        """Read the value from `f` whenever the metrics are rendered instead of recording it."""
+        self.function = f
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # per bucket, not cumulative, the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    """
+    A named metric with one value per combination of label values.
+    Values are plain objects updated in place without locks, recording happens on the event loop thread and costs a
+    dict lookup plus an addition. Callers on hot paths keep the value returned by `labels` around.
+    """
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values: Dict[Tuple[str, ...], object] = {}
+        if not self.label_names:
+            # unlabelled metrics are reported from the start, e.g. as 0 clients
+            self.values[()] = self._new_value()
+
+    def _new_value(self):
+        raise NotImplementedError()
+
+    def labels(self, *values: str):
+        value = self.values.get(values)
+        if value is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f'{self.name} expects the labels {", ".join(self.label_names)}')
+            value = self.values[values] = self._new_value()
+        return value
+
+    def remove(self, *values: str) -> None:
+        self.values.pop(values, None)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError()
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {_escape(self.documentation)}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. the number of emitted events. Names end with _total by convention."""
+    kind = 'counter'
+
+    def _new_value(self) -> CounterValue:
+        return CounterValue()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def _samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value.value)}'
+                for labels, value in list(self.values.items())]
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. the number of connected clients."""
+    kind = 'gauge'
+
+    def _new_value(self) -> GaugeValue:
+        return GaugeValue()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+    def set_function(self, f: Callable[[], float]) -> None:
+        self.labels().set_function(f)
+
+    def _samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value.get())}'
+                for labels, value in list(self.values.items())]
+
+
+class Histogram(Metric):
+    """Observations counted into buckets by upper bound, e.g. durations in seconds."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels)
+
+    def _new_value(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for labels, value in list(self.values.items()):
+            cumulative = 0
+            total = value.sum
+            for bound, count in zip(self.buckets + (float('inf'),), list(value.counts)):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}')
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+class Registry:
+    """All metrics of the process, rendered together in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def _get(self, cls, name: str, *args, **kwargs) -> Metric:
+        # modules may be reloaded or instantiate their classes several times, they all share one metric
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        elif type(metric) is not cls:
+            raise ValueError(f'metric {name} is already registered as a {metric.kind}')
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._get(Counter, name, documentation, labels)
+
+    def gauge(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self._get(Gauge, name, documentation, labels)
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, documentation, labels, buckets)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
@@ -0,0 +1,191 @@
+import asyncio
+import sys
+import threading
+import traceback
+from collections import deque
+from time import monotonic, time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from modular_conf.fields import IntField
+
+from bus import e_bus
+from common.events import ConfigChangedEvent
+from config.live import live_config
+from log import LOG
+import metrics
+
+MODULE_NAME = 'monitor'
+DEPENDS = ('bus',)
+CONFIG_FIELDS = [
+    IntField('interval_ms', default=100),
+    # the loop counts as blocked once a heartbeat is this late
+    IntField('threshold_ms', default=250),
+    IntField('history', default=50),
+    IntField('stack_depth', default=30)
+]
+
+LAG_SECONDS = metrics.histogram('event_loop_lag_seconds', 'Delay of the event loop heartbeat')
+STALLS = metrics.counter('event_loop_stalls_total', 'Heartbeats delayed beyond the blocking threshold')
+
+monitor = None
+
+
+class Stall:
+    """The event loop was blocked for `duration` seconds, with what was running at the time of the stack sample."""
+    __slots__ = ('at', 'duration', 'handler', 'task', 'stack')
+
+    def __init__(self, at: float, duration: float, handler: Optional[str], task: Optional[str], stack: List[str]):
+        self.at = at
+        self.duration = duration
+        self.handler = handler
+        self.task = task
+        self.stack = stack
+
+    @property
+    def culprit(self) -> str:
+        if self.handler is not None:
+            return f'bus handler {self.handler}'
+        if self.task is not None:
+            return f'task {self.task}'
+        return 'an unknown callback'
+
+    def to_dict(self) -> Dict:
+        return {
+            'at': self.at,
+            'duration': self.duration,
+            'handler': self.handler,
+            'task': self.task,
+            'stack': self.stack
+        }
+
+
+def describe_task(task: Optional[asyncio.Task]) -> Optional[str]:
+    if task is None:
+        return None
+    # bus handler tasks are named after the handler, others keep generic names like Task-12
+    if not task.get_name().startswith('Task-'):
+        return task.get_name()
+    coro = task.get_coro()
+    return getattr(coro, '__qualname__', None) or repr(coro)
+
+
+class LoopMonitor:
+    """
+    Measures the event loop lag with a heartbeat callback every `interval` seconds and watches the heartbeat from a
+    separate thread. When a heartbeat is more than `threshold` seconds late the thread samples the stack of the loop
+    thread, which shows the blocking callback while it is still running, together with the bus handler or task
+    it belongs to. Once the loop gets to the heartbeat the stall is recorded with its full duration.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float = 0.1, threshold: float = 0.25,
+                 history: int = 50, stack_depth: int = 30):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_depth = stack_depth
+        self.stalls = deque(maxlen=history)
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+        # written by the loop, read by the thread: (heartbeat number, when it was due)
+        self._heartbeat: Tuple[int, float] = (0, monotonic())
+        # written by the thread, read by the loop: (heartbeat number, handler, task, stack)
+        self._sample: Optional[Tuple] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._thread: Optional[threading.Thread] = None
+        self._thread_id: Optional[int] = None
+        self._stop = threading.Event()
+
+    def apply_settings(self, settings: NamedTuple) -> None:
+        self.interval = settings.interval_ms / 1000
+        self.threshold = settings.threshold_ms / 1000
+        self.stack_depth = settings.stack_depth
+        if settings.history != self.stalls.maxlen:
+            self.stalls = deque(self.stalls, maxlen=settings.history)
+
+    def start(self) -> None:
+        """Start watching, must be called from the loop thread."""
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._heartbeat = (0, monotonic() + self.interval)
+        self._handle = self.loop.call_later(self.interval, self._beat)
+        self._thread = threading.Thread(target=self._watch, name='loop-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _beat(self) -> None:
+        now = monotonic()
+        number, due = self._heartbeat
+        lag = max(0.0, now - due)
+        LAG_SECONDS.observe(lag)
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+
+        if lag >= self.threshold:
+            sample = self._sample
+            if sample is not None and sample[0] == number:
+                _, handler, task, stack = sample
+            else:
+                # blocked for less than the polling period of the thread, nothing was sampled
+                handler, task, stack = None, None, []
+            self._record(Stall(time() - lag, lag, handler, task, stack))
+
+        self._heartbeat = (number + 1, now + self.interval)
+        self._handle = self.loop.call_later(self.interval, self._beat)
+
+    def _record(self, stall: Stall) -> None:
+        STALLS.inc()
+        self.stalls.append(stall)
+        stack = ''.join(stall.stack)
+        LOG.warning(f'Event loop blocked for {stall.duration * 1000:.0f}ms by {stall.culprit}'
+                    + (f', stack when sampled:\n{stack}' if stack else ''), extra={'latency': stall.duration})
+
+    def _watch(self) -> None:
+        while not self._stop.wait(min(self.interval, self.threshold) / 2):
+            number, due = self._heartbeat
+            sample = self._sample
+            if monotonic() - due < self.threshold or (sample is not None and sample[0] == number):
+                continue
+            # the loop thread is stuck in whatever it is running right now
+            frame = sys._current_frames().get(self._thread_id)
+            stack = traceback.format_stack(frame, limit=self.stack_depth) if frame is not None else []
+            self._sample = (number, e_bus.running_handler(), describe_task(asyncio.current_task(self.loop)), stack)
+
+    def report(self) -> Dict:
+        return {
+            'interval': self.interval,
+            'threshold': self.threshold,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+            'stalls': [stall.to_dict() for stall in reversed(self.stalls)]
+        }
+
+
+async def main(shutdown_signal: asyncio.Event):
+    settings = live_config.register(MODULE_NAME, CONFIG_FIELDS)
+
+    global monitor
+    monitor = LoopMonitor(asyncio.get_event_loop(), interval=settings.interval_ms / 1000,
+                          threshold=settings.threshold_ms / 1000, history=settings.history,
+                          stack_depth=settings.stack_depth)
+
+    def on_config_changed(event: ConfigChangedEvent) -> None:
+        monitor.apply_settings(live_config.get(MODULE_NAME))
+
+    e_bus.on(f'config.changed.{MODULE_NAME}', on_config_changed)
+
+    monitor.start()
+    await shutdown_signal.wait()
+    monitor.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(asyncio.Event()))
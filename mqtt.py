@@ -1,50 +1,321 @@
 import asyncio
 import json
+import random
+from collections import deque
+from time import perf_counter
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
 import aiomqtt
-from modular_conf.fields import StringField, IntField
+from modular_conf.fields import StringField, IntField, TupleListField
 
+from bus import e_bus, EventBus
+from bus.codec import encode_event
 from bus.events import Event
-from config import config
+from bus.topics import TopicCache, TopicTrie
+from common.events import ConfigChangedEvent
+from config.live import live_config
 from log import LOG
+import metrics
 
 
 MODULE_NAME = 'mqtt'
+DEPENDS = ('bus',)
 
 
 CONFIG_FIELDS = [
     StringField('mqtt_host', default='localhost'),
-    IntField('mqtt_port', default=9000)
+    IntField('mqtt_port', default=9000),
+    StringField('client_id', default='home-awareness'),
+    # bus topic (pattern) -> mqtt topic, e.g. ('tracking.#', 'home/tracking/#')
+    TupleListField(
+        name='publish',
+        n_elems=2,
+        element_names=('bus_topic', 'mqtt_topic'),
+        default=[]
+    ),
+    # mqtt topic (filter) -> bus topic, e.g. ('home/sensors/+/temperature', 'sensor.*.temperature')
+    TupleListField(
+        name='subscribe',
+        n_elems=2,
+        element_names=('mqtt_topic', 'bus_topic'),
+        default=[]
+    ),
+    IntField('qos', default=1),
+    IntField('buffer_size', default=1000),
+    IntField('batch_size', default=100),
+    IntField('publish_timeout', default=10),
+    IntField('reconnect_min', default=1),
+    IntField('reconnect_max', default=60)
 ]
 
+BUS_WILDCARDS = ('.', '*', '#')
+MQTT_WILDCARDS = ('/', '+', '#')
+
+
+# upper bound of distinct topics whose matching handlers are cached
+DISPATCH_CACHE_SIZE = 16384
+
+PUBLISHED = metrics.counter('mqtt_published_total', 'Messages published to the broker and acknowledged')
+RECEIVED = metrics.counter('mqtt_received_total', 'Messages received from the broker')
+DROPPED = metrics.counter('mqtt_dropped_total', 'Messages dropped from the full outgoing buffer')
+PUBLISH_SECONDS = metrics.histogram('mqtt_publish_seconds', 'Time until a batch of publishes was acknowledged')
 
 _client = None
+_UNDECODED = object()
+
+
+class MqttEvent(Event):
+    """
+    An inbound MQTT message.
+    The payload is kept as received and only decoded from JSON on the first access to `data`, so messages that are
+    just forwarded are never decoded and all handlers of a message share one decoding.
+    Serialized, e.g. for websocket clients, the event carries the payload text as received instead of `data`.
+    """
+    __slots__ = ('topic', '_payload', '_data')
+    # the payload is the source of `data`, serializing it instead avoids decoding and encoding it again
+    schema = (('topic', str), ('payload', str))
+
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+
+    @property
+    def payload(self) -> bytes:
+        return self._payload
+
+    @payload.setter
+    def payload(self, value: Union[bytes, str]):
+        self._payload = value.encode('utf-8') if isinstance(value, str) else value
+        self._data = _UNDECODED
+
+    @property
+    def data(self):
+        if self._data is _UNDECODED:
+            try:
+                self._data = json.loads(self._payload)
+            except ValueError:
+                self._data = self._payload.decode('utf-8', errors='replace')
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        # keep the payload in line, it is what gets forwarded
+        self._payload = json.dumps(value).encode('utf-8')
+        self._data = value
+
+    def to_dict(self) -> Dict:
+        return {'type': type(self).__name__, 'topic': self.topic,
+                'payload': self._payload.decode('utf-8', errors='replace')}
 
 
-def callback_wrapper(topic, f):
-    def func(client, userdata, message):
-        f(Event(json.loads(message)))
+class Dispatcher:
+    """
+    Routes inbound messages to the handlers of all matching subscriptions, with MQTT '+' and '#' wildcards.
+    Matching goes through a single TopicTrie and is cached per topic, the cache is cleared when subscriptions change.
+    """
 
-    return func
+    def __init__(self):
+        self._filters = TopicTrie(*MQTT_WILDCARDS)
+        self._cache: Dict[str, Tuple[Callable[[MqttEvent], None], ...]] = TopicCache(DISPATCH_CACHE_SIZE)
+
+    def add(self, topic_filter: str, handler: Callable[[MqttEvent], None]) -> None:
+        self._filters.add(topic_filter, (topic_filter, handler))
+        self._cache.clear()
+
+    def remove(self, topic_filter: str, handler: Callable[[MqttEvent], None]) -> None:
+        self._filters.remove(topic_filter, (topic_filter, handler))
+        self._cache.clear()
+
+    def dispatch(self, topic: str, payload: bytes) -> int:
+        """Hand the message to every matching handler, returns the number of handlers."""
+        handlers = self._cache.get(topic)
+        if handlers is None:
+            handlers = tuple(dict.fromkeys(handler for _, handler in self._filters.match(topic)))
+            self._cache.put(topic, handlers)
+        if handlers:
+            event = MqttEvent(topic, payload)
+            for handler in handlers:
+                handler(event)
+        return len(handlers)
+
+
+class TopicMap:
+    """
+    Translates topics matching `source` into `target`, between bus and mqtt topic syntax.
+    Wildcards in `target` are filled with the levels matched by the wildcards in `source`, in order, so
+    ('home/+/temperature', 'sensor.*.temperature') maps home/kitchen/temperature to sensor.kitchen.temperature and
+    ('tracking.#', 'home/tracking/#') maps tracking.event.user_enter to home/tracking/event/user_enter.
+    Raises:
+        ValueError: `target` has wildcards that `source` does not capture, in order
+    """
+
+    def __init__(self, source: str, target: str, source_syntax: Tuple[str, str, str],
+                 target_syntax: Tuple[str, str, str]):
+        self.source = source
+        self.target = target
+        self.source_sep, self.source_single, self.source_multi = source_syntax
+        self.target_sep, self.target_single, self.target_multi = target_syntax
+        self._source_levels = source.split(self.source_sep)
+        self._target_levels = target.split(self.target_sep)
+
+        captured = [level for level in self._source_levels if level in (self.source_single, self.source_multi)]
+        filled = [level for level in self._target_levels if level in (self.target_single, self.target_multi)]
+        kinds = {self.source_single: self.target_single, self.source_multi: self.target_multi}
+        if [kinds[level] for level in captured[:len(filled)]] != filled:
+            raise ValueError(f'the wildcards of {target!r} cannot be filled from {source!r}')
+
+    def translate(self, topic: str) -> Optional[str]:
+        captures: List[Union[str, List[str]]] = []
+        levels = topic.split(self.source_sep)
+        for i, pattern in enumerate(self._source_levels):
+            if pattern == self.source_multi:
+                captures.append(levels[i:])
+                break
+            if i >= len(levels):
+                return None
+            if pattern == self.source_single:
+                captures.append(levels[i])
+            elif pattern != levels[i]:
+                return None
+        else:
+            if len(levels) != len(self._source_levels):
+                return None
+
+        result = []
+        captures.reverse()
+        for level in self._target_levels:
+            if level == self.target_single and captures and isinstance(captures[-1], str):
+                result.append(captures.pop())
+            elif level == self.target_multi and captures and isinstance(captures[-1], list):
+                result.extend(captures.pop())
+            elif level in (self.target_single, self.target_multi):
+                return None
+            else:
+                result.append(level)
+        return self.target_sep.join(result)
 
 
 class Client:
-    def __init__(self, host=None, port=None, clientid=None):
-        self.host = host or config.get(MODULE_NAME, 'mqtt_host')
-        self.port = port or config.get(MODULE_NAME, 'mqtt_port')
+    """
+    Bidirectional bridge between the event bus and an MQTT broker.
+    Bus events matching a 'publish' mapping are queued and published in batches with all QoS acknowledgements awaited
+    together. While disconnected they are kept in a bounded buffer (oldest dropped first) that is flushed on
+    reconnect. Messages on 'subscribe' mappings are emitted on the bus. Lost connections are retried with jittered
+    exponential backoff.
+    """
 
-        self.client = aiomqtt.Client(clientid)
+    def __init__(self, host=None, port=None, clientid=None, bus: EventBus = e_bus,
+                 publish: List[Tuple[str, str]] = (), subscribe: List[Tuple[str, str]] = (), qos=1,
+                 buffer_size=1000, batch_size=100, publish_timeout=10, reconnect_min=1, reconnect_max=60, client=None):
+        self.host = host or 'localhost'
+        self.port = port or 9000
+        self.bus = bus
+        self.qos = qos
+        self.batch_size = batch_size
+        self.publish_timeout = publish_timeout
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+
+        self.client = client or aiomqtt.Client(client_id=clientid or '')
         self.client.on_message = self.on_message
         self.client.on_connect = self.on_connect
         self.client.on_publish = self.on_publish
         self.client.on_subscribe = self.on_subscribe
         self.client.on_disconnect = self.on_disconnect
 
+        self._publish_maps = TopicTrie(*BUS_WILDCARDS)
+        self._publish_dispatch: Dict[str, Tuple[TopicMap, ...]] = {}
+        self.dispatcher = Dispatcher()
+        self._subscriptions: Dict[str, int] = {}
+        self._forwarders: Dict[Tuple[str, str], Callable[[MqttEvent], None]] = {}
+
+        self.outgoing = deque(maxlen=buffer_size)  # (mqtt topic, payload)
+        self.connected = asyncio.Event()
+        self._disconnected = asyncio.Event()
+        self._pending = asyncio.Event()
+        self.stats = {'published': 0, 'received': 0, 'dropped': 0}
+
+        self.set_publish(publish)
+        self.set_subscribe(subscribe)
+
+    def set_publish(self, publish: List[Tuple[str, str]]) -> None:
+        """Replace the (bus topic, mqtt topic) mappings of published events."""
+        self._publish_maps = TopicTrie(*BUS_WILDCARDS)
+        for bus_topic, mqtt_topic in publish:
+            try:
+                self._publish_maps.add(bus_topic, TopicMap(bus_topic, mqtt_topic, BUS_WILDCARDS, MQTT_WILDCARDS))
+            except ValueError as e:
+                LOG.error(f'Ignoring MQTT publish mapping {bus_topic} -> {mqtt_topic}: {e}')
+        self._publish_dispatch = {}
+
+    def set_subscribe(self, subscribe: List[Tuple[str, str]]) -> None:
+        """
+        Replace the (mqtt topic, bus topic) mappings of messages forwarded to the bus.
+        Topics no longer mapped stay subscribed at the broker until the next connection, their messages are ignored.
+        """
+        wanted = {(mqtt_topic, bus_topic) for mqtt_topic, bus_topic in subscribe}
+        for key in self._forwarders.keys() - wanted:
+            self.dispatcher.remove(key[0], self._forwarders.pop(key))
+            if not any(mqtt_topic == key[0] for mqtt_topic, _ in wanted):
+                self._subscriptions.pop(key[0], None)
+        for mqtt_topic, bus_topic in wanted - self._forwarders.keys():
+            try:
+                mapping = TopicMap(mqtt_topic, bus_topic, MQTT_WILDCARDS, BUS_WILDCARDS)
+            except ValueError as e:
+                LOG.error(f'Ignoring MQTT subscribe mapping {mqtt_topic} -> {bus_topic}: {e}')
+                continue
+            self._forwarders[mqtt_topic, bus_topic] = self._make_forwarder(mapping)
+            self.dispatcher.add(mqtt_topic, self._forwarders[mqtt_topic, bus_topic])
+            if self._subscriptions.get(mqtt_topic, -1) < self.qos:
+                self._subscriptions[mqtt_topic] = self.qos
+                if self.connected.is_set():
+                    self.client.subscribe(mqtt_topic, self.qos)
+
+    def apply_settings(self, settings: NamedTuple, keys: List[str]) -> None:
+        """Take over changed settings, reconnecting if the broker moved. A new client_id needs a restart."""
+        self.qos = settings.qos
+        self.batch_size = settings.batch_size
+        self.publish_timeout = settings.publish_timeout
+        self.reconnect_min = settings.reconnect_min
+        self.reconnect_max = settings.reconnect_max
+        if settings.buffer_size != self.outgoing.maxlen:
+            self.outgoing = deque(self.outgoing, maxlen=settings.buffer_size)
+        if 'publish' in keys:
+            self.set_publish(settings.publish)
+        if 'subscribe' in keys:
+            self.set_subscribe(settings.subscribe)
+
+        if (settings.mqtt_host, settings.mqtt_port) != (self.host, self.port):
+            self.host, self.port = settings.mqtt_host, settings.mqtt_port
+            if self.connected.is_set():
+                LOG.info(f'MQTT broker moved, reconnecting to {self.host}:{self.port}')
+                # run reconnects to the new broker once the disconnect is through
+                self.client.disconnect()
+
     def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            # the broker refused the connection, e.g. 5 for not authorized
+            LOG.warning(f'MQTT broker {self.host}:{self.port} refused the connection ({rc})')
+            self._disconnected.set()
+            return
         LOG.info(f'MQTT client ({client}) connected')
+        for topic, qos in self._subscriptions.items():
+            self.client.subscribe(topic, qos)
+        self.connected.set()
+        self._pending.set()
 
     def on_message(self, client, userdata, msg):
-        pass
+        self.stats['received'] += 1
+        RECEIVED.inc()
+        self.dispatcher.dispatch(msg.topic, msg.payload)
+
+    def _make_forwarder(self, mapping: TopicMap) -> Callable[[MqttEvent], None]:
+        def forward(event: MqttEvent) -> None:
+            bus_topic = mapping.translate(event.topic)
+            if bus_topic is not None:
+                self.bus.emit(bus_topic, event)
+
+        return forward
 
     def on_publish(self, client, userdata, mid):
         pass
@@ -53,7 +324,10 @@ class Client:
         pass
 
     def on_disconnect(self, client, userdata, rc):
-        pass
+        if self.connected.is_set():
+            LOG.warning(f'MQTT client disconnected ({rc})')
+        self.connected.clear()
+        self._disconnected.set()
 
     async def connect(self):
         await self.client.connect(self.host, self.port, keepalive=60)
@@ -66,20 +340,146 @@ class Client:
         """
         Subscribe to a certain topic. Callback will be called with messages received in that topic.
         Args:
-            topic (str): mqtt topic
-            callback (function): callback
+            topic (str): mqtt topic, may contain wildcards
+            callback (function): callback, called with an MqttEvent
             qos (int): quality of service flag for mqtt
         """
-        await self.client.subscribe(topic, qos)
-        await self.client.message_callback_add(topic, callback_wrapper(topic, callback))
+        self.dispatcher.add(topic, callback)
+        if self._subscriptions.get(topic, -1) < qos:
+            self._subscriptions[topic] = qos
+            if self.connected.is_set():
+                self.client.subscribe(topic, qos)
+
+    def _on_bus_event(self, event_type: str, event: Event) -> None:
+        maps = self._publish_dispatch.get(event_type)
+        if maps is None:
+            maps = tuple(self._publish_maps.match(event_type))
+            self._publish_dispatch[event_type] = maps
+        if not maps:
+            return
+
+        # messages from mqtt are forwarded as received
+        payload = getattr(event, 'payload', None) if isinstance(event, MqttEvent) else None
+        if payload is None:
+            payload = encode_event(event)
+        for mapping in maps:
+            topic = mapping.translate(event_type)
+            if topic is None:
+                LOG.warning(f'Not publishing {event_type}, {mapping.source} -> {mapping.target} cannot map it')
+                continue
+            if len(self.outgoing) == self.outgoing.maxlen:
+                self.stats['dropped'] += 1
+                DROPPED.inc()
+            self.outgoing.append((topic, payload))
+        self._pending.set()
+
+    async def _publish_batches(self) -> None:
+        while True:
+            await self._pending.wait()
+            self._pending.clear()
+
+            while self.outgoing and self.connected.is_set():
+                batch = [self.outgoing.popleft() for _ in range(min(self.batch_size, len(self.outgoing)))]
+                sent, infos = [], []
+                attempted = 0
+                begin = perf_counter()
+                try:
+                    # put everything on the wire first, then wait for all acknowledgements at once
+                    for topic, payload in batch:
+                        try:
+                            infos.append(self.client.publish(topic, payload, self.qos))
+                            sent.append((topic, payload))
+                        except ValueError as e:
+                            # e.g. an invalid topic, it would fail again on every retry
+                            LOG.warning(f'Dropping MQTT message to {topic!r}: {e}')
+                            self.stats['dropped'] += 1
+                            DROPPED.inc()
+                        attempted += 1
+                    await asyncio.wait_for(asyncio.gather(*(info.wait_for_publish() for info in infos)),
+                                           self.publish_timeout)
+                except (asyncio.TimeoutError, OSError, RuntimeError, ValueError) as e:
+                    unacked = [item for item, info in zip(sent, infos) if not info.is_published()]
+                    unacked.extend(batch[attempted:])
+                    LOG.warning(f'MQTT publish failed, buffering {len(unacked)} messages: {e!r}')
+                    # a full buffer drops the newest messages when refilled from the left
+                    dropped = max(0, len(self.outgoing) + len(unacked) - self.outgoing.maxlen)
+                    self.stats['dropped'] += dropped
+                    DROPPED.inc(dropped)
+                    self.outgoing.extendleft(reversed(unacked))
+                    break
+                PUBLISH_SECONDS.observe(perf_counter() - begin)
+                self.stats['published'] += len(sent)
+                PUBLISHED.inc(len(sent))
+
+    @staticmethod
+    async def _wait_first(*events: asyncio.Event) -> None:
+        waiters = [asyncio.ensure_future(event.wait()) for event in events]
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    async def run(self, shutdown_signal: asyncio.Event) -> None:
+        """Keep the connection up until shutdown, publishing bus events in the meantime."""
+        self.client.loop_start()
+        self.bus.tap(self._on_bus_event)
+        publisher = asyncio.ensure_future(self._publish_batches())
+        backoff = self.reconnect_min
+
+        try:
+            while not shutdown_signal.is_set():
+                self._disconnected.clear()
+                try:
+                    await self.connect()
+                except (OSError, asyncio.TimeoutError) as e:
+                    LOG.warning(f'MQTT connection to {self.host}:{self.port} failed: {e}')
+                else:
+                    # connected once the broker accepted in its CONNACK, a refusal ends up in _disconnected
+                    await self._wait_first(self.connected, self._disconnected, shutdown_signal)
+                    if self.connected.is_set():
+                        backoff = self.reconnect_min
+                        await self._wait_first(self._disconnected, shutdown_signal)
+                    else:
+                        self.client.disconnect()
+                if shutdown_signal.is_set():
+                    break
+
+                delay = random.uniform(backoff / 2, backoff)
+                LOG.info(f'Reconnecting to MQTT broker {self.host}:{self.port} in {delay:.1f}s')
+                backoff = min(self.reconnect_max, backoff * 2)
+                try:
+                    await asyncio.wait_for(shutdown_signal.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.bus.untap(self._on_bus_event)
+            publisher.cancel()
+            self.client.disconnect()
+            await self.client.loop_stop()
 
 
 async def main(shutdown_signal: asyncio.Event):
-    config.register_module(MODULE_NAME, CONFIG_FIELDS)
+    settings = live_config.register(MODULE_NAME, CONFIG_FIELDS)
 
     global _client
-    _client = Client(clientid='home-awareness')
+    _client = Client(
+        host=settings.mqtt_host,
+        port=settings.mqtt_port,
+        clientid=settings.client_id,
+        publish=settings.publish,
+        subscribe=settings.subscribe,
+        qos=settings.qos,
+        buffer_size=settings.buffer_size,
+        batch_size=settings.batch_size,
+        publish_timeout=settings.publish_timeout,
+        reconnect_min=settings.reconnect_min,
+        reconnect_max=settings.reconnect_max
+    )
+
+    def on_config_changed(event: ConfigChangedEvent) -> None:
+        _client.apply_settings(live_config.get(MODULE_NAME), event.keys)
+
+    e_bus.on(f'config.changed.{MODULE_NAME}', on_config_changed)
 
-    await shutdown_signal.wait()
-    # _client.connect()
-    # _client.publish('test/test', json.dumps({'testdata': 123}))
+    await _client.run(shutdown_signal)
@@ -0,0 +1,130 @@
+import asyncio
+import importlib
+from time import perf_counter
+from types import ModuleType
+from typing import Dict, List, Optional
+
+from modular_conf.fields import BoolField
+
+from config import config
+from log import LOG
+
+MODULE_NAME = 'modules'
+
+# always loaded, everything else depends on them
+CORE_MODULES = ('log', 'bus')
+# loaded if enabled in the 'modules' config, in the order used between modules that do not depend on each other
+OPTIONAL_MODULES = ('monitor', 'snapshot', 'tracking', 'wifi', 'audio', 'alarm', 'web', 'mqtt')
+
+CONFIG_FIELDS = [BoolField(name, default=True) for name in OPTIONAL_MODULES]
+
+_loaded: Dict[str, ModuleType] = {}
+
+
+def module(name: str) -> Optional[ModuleType]:
+    """The subsystem `name` if it was loaded, for optional integrations with it."""
+    return _loaded.get(name)
+
+
+class ModuleInfo:
+    """
+    A loaded subsystem. Subsystems are python modules with a MODULE_NAME, an `async def main(shutdown_signal)` entry
+    point and optionally DEPENDS, the names of the subsystems that have to be started before them.
+    """
+
+    def __init__(self, name: str, module: ModuleType, import_time: float):
+        self.name = name
+        self.module = module
+        self.depends = tuple(getattr(module, 'DEPENDS', ()))
+        self.import_time = import_time
+        self.init_time: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def _main(self, shutdown_signal: asyncio.Event, started: asyncio.Future) -> None:
+        begin = perf_counter()
+
+        def mark_started() -> None:
+            self.init_time = perf_counter() - begin
+            if not started.done():
+                started.set_result(None)
+
+        # runs once main is suspended for the first time, i.e. once its synchronous setup is done
+        asyncio.get_event_loop().call_soon(mark_started)
+        await self.module.main(shutdown_signal)
+
+
+class ModuleRegistry:
+    """
+    Imports the enabled subsystems and starts them in dependency order.
+    A subsystem counts as started once its main first waits for something, dependents see whatever it set up before
+    that, e.g. the registered config or its module globals. The waiting parts of all mains (connecting, serving,
+    scanning) run concurrently. Dependencies that are disabled are skipped, the subsystems have to cope without them.
+    """
+
+    def __init__(self, core=CORE_MODULES, optional=OPTIONAL_MODULES):
+        self.core = core
+        self.optional = optional
+        self.modules: Dict[str, ModuleInfo] = {}
+
+    def enabled(self) -> List[str]:
+        config.register_module(MODULE_NAME, CONFIG_FIELDS)
+        return list(self.core) + [name for name in self.optional if config.get(MODULE_NAME, name)]
+
+    def load(self, names: List[str]) -> None:
+        for name in names:
+            begin = perf_counter()
+            # shared dependencies count towards the first subsystem importing them
+            imported = importlib.import_module(name)
+            self.modules[name] = ModuleInfo(name, imported, perf_counter() - begin)
+            _loaded[name] = imported
+
+    def order(self) -> List[ModuleInfo]:
+        """
+        Modules sorted so that every module comes after its enabled dependencies.
+        Raises:
+            ValueError: the dependencies are circular
+        """
+        ordered: List[ModuleInfo] = []
+        done = set()
+        remaining = list(self.modules.values())
+        while remaining:
+            ready = [info for info in remaining if all(dep in done or dep not in self.modules for dep in info.depends)]
+            if not ready:
+                raise ValueError(f'circular module dependencies between {", ".join(info.name for info in remaining)}')
+            # one at a time, a module may unblock modules listed before the other ready ones
+            ordered.append(ready[0])
+            done.add(ready[0].name)
+            remaining.remove(ready[0])
+        return ordered
+
+    async def start(self, shutdown_signal: asyncio.Event) -> None:
+        for info in self.order():
+            LOG.info(f'Starting {info.name}')
+            started = asyncio.get_event_loop().create_future()
+            info.task = asyncio.ensure_future(info._main(shutdown_signal, started))
+            await started
+            if info.task.done() and info.task.exception() is not None:
+                LOG.error(f'Module {info.name} failed to start: {info.task.exception()!r}')
+
+    def report(self) -> List[Dict]:
+        return [{
+            'module': info.name,
+            'depends': list(info.depends),
+            'import_ms': round(info.import_time * 1000, 1),
+            'init_ms': round(info.init_time * 1000, 1) if info.init_time is not None else None
+        } for info in self.modules.values()]
+
+    def log_report(self) -> None:
+        lines = [f'{"module":<10} {"import ms":>10} {"init ms":>10}']
+        for entry in self.report():
+            init = f'{entry["init_ms"]:>10.1f}' if entry['init_ms'] is not None else f'{"-":>10}'
+            lines.append(f'{entry["module"]:<10} {entry["import_ms"]:>10.1f} {init}')
+        LOG.info('Startup timing\n' + '\n'.join(lines))
+
+    async def run(self, shutdown_signal: asyncio.Event) -> None:
+        """Load and start the enabled modules, then wait for all of them to finish."""
+        self.load(self.enabled())
+        await self.start(shutdown_signal)
+        self.log_report()
+        LOG.info('Done starting up')
+        await asyncio.gather(*(info.task for info in self.modules.values()))
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import os
+import tempfile
+from os import path
+from time import time
+from typing import Any, Callable, Dict, Optional
+
+from modular_conf.fields import StringField, IntField
+
+from config.live import live_config
+from log import LOG
+
+MODULE_NAME = 'snapshot'
+DEPENDS = ('log',)
+CONFIG_FIELDS = [
+    StringField('path', default=path.join(path.dirname(path.abspath(__file__)), 'snapshot.json')),
+    IntField('interval', default=60),
+    # snapshots older than this are ignored, the state they describe is too stale to be of use
+    IntField('max_age', default=86400)
+]
+
+# section name: function returning the JSON compatible state to save
+_sections: Dict[str, Callable[[], Any]] = {}
+# sections of the snapshot loaded at startup, handed out once by restore
+_loaded: Dict[str, Any] = {}
+
+
+def write_snapshot(file: str, data: Dict) -> None:
+    """Write `data` as JSON to `file` atomically, readers see either the old or the new snapshot, never a partial one."""
+    directory = path.dirname(path.abspath(file))
+    fd, tmp = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, file)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_snapshot(file: str, max_age: float) -> Optional[Dict]:
+    """
+    Returns:
+        the snapshot in `file`, or None if there is none or it is unusable
+    """
+    try:
+        with open(file) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        LOG.warning(f'Ignoring unreadable snapshot {file}: {e}')
+        return None
+
+    age = time() - data.get('saved_at', 0)
+    if not 0 <= age <= max_age:
+        LOG.info(f'Ignoring snapshot {file} saved {age:.0f}s ago')
+        return None
+    return data
+
+
+def register(name: str, dump: Callable[[], Any]) -> None:
+    """Include the state returned by `dump` in every snapshot, under `name`."""
+    _sections[name] = dump
+
+
+def restore(name: str) -> Optional[Any]:
+    """The state saved under `name` by the previous run, if there is a usable snapshot."""
+    return _loaded.pop(name, None)
+
+
+def collect() -> Dict:
+    data = {'saved_at': time(), 'sections': {}}
+    for name, dump in _sections.items():
+        try:
+            data['sections'][name] = dump()
+        except Exception as e:
+            LOG.exception(f'Failed to snapshot {name}: {e}')
+    return data
+
+
+async def save(file: str) -> None:
+    data = collect()
+    # fsync can take a while, keep it off the event loop
+    await asyncio.get_event_loop().run_in_executor(None, write_snapshot, file, data)
+
+
+async def _save_logged() -> None:
+    file = live_config.get(MODULE_NAME).path
+    try:
+        await save(file)
+    except OSError as e:
+        LOG.error(f'Failed to save snapshot {file}: {e}')
+
+
+async def main(shutdown_signal: asyncio.Event):
+    """
+    Load the previous snapshot, then save one every 'interval' seconds and at shutdown.
+    Has to be started before the modules restoring their state, the snapshot is loaded before the first await.
+    """
+    settings = live_config.register(MODULE_NAME, CONFIG_FIELDS)
+
+    data = read_snapshot(settings.path, settings.max_age)
+    if data is not None:
+        _loaded.update(data.get('sections', {}))
+        LOG.info(f'Restoring state from snapshot saved {time() - data["saved_at"]:.0f}s ago')
+
+    try:
+        while not shutdown_signal.is_set():
+            try:
+                await asyncio.wait_for(shutdown_signal.wait(), live_config.get(MODULE_NAME).interval)
+            except asyncio.TimeoutError:
+                await _save_logged()
+    finally:
+        # also when cancelled, the final snapshot is the one the next start restores from
+        await _save_logged()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
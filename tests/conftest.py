@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# the subsystems are top level modules of the repository root
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
@@ -0,0 +1,78 @@
+import asyncio
+import sys
+
+import pytest
+
+from bench.standins import fake_arp_scan_command, make_arp_scan_output
+from wifi.arpscan import arp_scan, parse_arp_scan, parse_arp_scan_line
+from wifi.scanner import ScanError
+
+# recorded with arp-scan 1.9.5, one host answered twice
+RECORDED = """Interface: enp6s0, datalink type: EN10MB (Ethernet)
+Starting arp-scan 1.9.5 with 256 hosts (https://github.com/royhills/arp-scan)
+192.168.141.1\tcc:ce:1e:6c:d0:0a\t(Unknown)
+192.168.141.43\tb8:27:eb:d8:94:5f\tRaspberry Pi Foundation
+192.168.141.48\tb8:27:eb:1c:0a:af\tRaspberry Pi Foundation
+192.168.141.48\tb8:27:eb:1c:0a:af\tRaspberry Pi Foundation (DUP: 2)
+192.168.141.52\tB8:27:EB:1C:0A:B0
+
+8 packets received by filter, 0 packets dropped by kernel
+Ending arp-scan 1.9.5: 256 hosts scanned in 2.455 seconds (104.28 hosts/sec). 5 responded
+"""
+
+
+@pytest.mark.parametrize('line, mac', [
+    ('192.168.141.1\tcc:ce:1e:6c:d0:0a\t(Unknown)', 'cc:ce:1e:6c:d0:0a'),
+    ('  10.0.0.2   B8:27:EB:1C:0A:AF', 'b8:27:eb:1c:0a:af'),
+    ('10.0.0.2\tb8:27:eb:1c:0a:zz\tnot hex', None),
+    ('10.0.0.2\tb8:27:eb:1c:0a\ttoo short', None),
+    ('10.0.0.2\tb8:27:eb:1c:0a:af:01\ttoo long', None),
+    ('Interface: enp6s0, datalink type: EN10MB (Ethernet)', None),
+    ('', None)
+])
+def test_parse_arp_scan_line(line, mac):
+    assert parse_arp_scan_line(line) == mac
+
+
+def test_parse_arp_scan():
+    assert list(parse_arp_scan(RECORDED.splitlines())) == [
+        'cc:ce:1e:6c:d0:0a', 'b8:27:eb:d8:94:5f', 'b8:27:eb:1c:0a:af', 'b8:27:eb:1c:0a:af', 'b8:27:eb:1c:0a:b0'
+    ]
+
+
+def test_parse_generated_scan():
+    assert len(set(parse_arp_scan(make_arp_scan_output(1000).splitlines()))) == 1000
+
+
+def scan(command, timeout: float = 5, terminate_after: float = None):
+    async def scenario():
+        terminate = asyncio.Event()
+        if terminate_after is not None:
+            asyncio.get_event_loop().call_later(terminate_after, terminate.set)
+        return await arp_scan(terminate, timeout=timeout, command=command)
+
+    return asyncio.run(scenario())
+
+
+def test_arp_scan(tmp_path):
+    recording = tmp_path / 'scan.txt'
+    recording.write_text(RECORDED)
+    assert scan(fake_arp_scan_command(str(recording))) == {
+        'cc:ce:1e:6c:d0:0a', 'b8:27:eb:d8:94:5f', 'b8:27:eb:1c:0a:af', 'b8:27:eb:1c:0a:b0'
+    }
+
+
+def test_arp_scan_failure():
+    with pytest.raises(ScanError, match='status 2'):
+        scan([sys.executable, '-c', 'import sys; sys.exit(2)'])
+    with pytest.raises(ScanError, match='could not run'):
+        scan(['/nonexistent/arp-scan'])
+
+
+def test_arp_scan_timeout():
+    with pytest.raises(ScanError, match='did not finish'):
+        scan([sys.executable, '-c', 'import time; time.sleep(30)'], timeout=0.2)
+
+
+def test_arp_scan_terminate():
+    assert scan([sys.executable, '-c', 'import time; time.sleep(30)'], terminate_after=0.2) is None
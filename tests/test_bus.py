@@ -0,0 +1,34 @@
+import pytest
+
+import bus
+from bus import EventBus
+from bus.events import Event
+
+
+def test_once_handlers_leave_nothing_behind():
+    e_bus = EventBus()
+    seen = []
+    for i in range(100):
+        e_bus.once(f'once.{i}', seen.append)
+    for i in range(100):
+        e_bus.emit(f'once.{i}', Event())
+    assert len(seen) == 100
+    assert not e_bus._events and not e_bus._dispatch
+
+
+def test_topic_labels_are_capped():
+    e_bus = EventBus()
+
+    def fail(event: Event) -> None:
+        raise ValueError()
+
+    e_bus.on('arbitrary.#', fail)
+    for i in range(2 * bus.MAX_TOPIC_LABELS):
+        # synchronous handlers raise into emit
+        with pytest.raises(ValueError):
+            e_bus.emit(f'arbitrary.{i}', Event())
+    assert len(bus.EMITTED.values) <= bus.MAX_TOPIC_LABELS + 1
+    assert len(bus.HANDLER_ERRORS.values) <= bus.MAX_TOPIC_LABELS + 1
+    assert len(e_bus._emitted) <= bus.MAX_TOPIC_LABELS
+    assert bus.EMITTED.labels(bus.OTHER_TOPICS).value > 0
+    assert bus.HANDLER_ERRORS.labels(bus.OTHER_TOPICS).value > 0
@@ -0,0 +1,23 @@
+import pytest
+
+from web.cache import _etag_matches
+
+ETAG = '"0123456789abcdef"'
+
+
+@pytest.mark.parametrize('header, matches', [
+    (None, False),
+    ('', False),
+    (ETAG, True),
+    (f'W/{ETAG}', True),
+    (f'"other", W/{ETAG}', True),
+    ('"other"', False),
+    # only the W/ prefix is stripped, not any leading W and / characters
+    ('W/"W0123456789abcdef"', False),
+    ('WW/"0123456789abcdef"', False),
+    ('*', True),
+    (' * ', True),
+    ('"other", *', True)
+])
+def test_etag_matches(header, matches):
+    assert _etag_matches(header, ETAG) == matches
@@ -0,0 +1,226 @@
+import asyncio
+
+import pytest
+
+from bench.standins import Broker, BrokerClient
+from bus import EventBus
+from bus.events import Event
+import mqtt
+
+
+class PahoClient(BrokerClient):
+    """BrokerClient validating topics on publish like paho does."""
+
+    def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        if not topic or '+' in topic or '#' in topic:
+            raise ValueError('Invalid topic.')
+        return super().publish(topic, payload, qos, retain)
+
+
+class RefusingClient(BrokerClient):
+    """BrokerClient whose broker refuses the first `refusals` connections as not authorized."""
+
+    def __init__(self, broker: Broker, refusals: int):
+        super().__init__(broker)
+        self.refusals = refusals
+        self.attempts = 0
+
+    async def connect(self, host: str, port: int, keepalive: int = 60) -> None:
+        self.attempts += 1
+        if self.refusals:
+            self.refusals -= 1
+            self.on_connect(self, None, {}, 5)
+        else:
+            await super().connect(host, port, keepalive)
+
+
+class Recorder(BrokerClient):
+    """A broker client subscribed to everything, recording the (topic, payload) of each message."""
+
+    def __init__(self, broker: Broker):
+        super().__init__(broker)
+        self.messages = []
+        self.on_connect = self.on_disconnect = lambda *args: None
+        self.on_message = lambda client, userdata, msg: self.messages.append((msg.topic, msg.payload))
+
+    async def start(self) -> 'Recorder':
+        await self.connect('broker', 1883)
+        self.subscribe('#')
+        return self
+
+
+def run(scenario) -> None:
+    asyncio.run(asyncio.wait_for(scenario(), 5))
+
+
+async def start(client: mqtt.Client):
+    shutdown_signal = asyncio.Event()
+    runner = asyncio.ensure_future(client.run(shutdown_signal))
+    await client.connected.wait()
+    return shutdown_signal, runner
+
+
+async def published(client: mqtt.Client, count: int) -> None:
+    while client.stats['published'] + client.stats['dropped'] < count:
+        await asyncio.sleep(0)
+
+
+def test_invalid_topic_does_not_stop_publishing():
+    async def scenario():
+        bus, broker = EventBus(), Broker()
+        recorder = await Recorder(broker).start()
+        client = mqtt.Client(bus=bus, publish=[('sensor.#', 'home/#')], client=PahoClient(broker))
+        shutdown_signal, runner = await start(client)
+
+        bus.emit('sensor.a+b', Event())
+        bus.emit('sensor.kitchen', Event({'value': 1}))
+        await published(client, 2)
+        assert [topic for topic, _ in recorder.messages] == ['home/kitchen']
+        assert client.stats == {'published': 1, 'received': 0, 'dropped': 1}
+
+        # the publisher is still running
+        bus.emit('sensor.hall', Event())
+        await published(client, 3)
+        assert recorder.messages[-1][0] == 'home/hall'
+
+        shutdown_signal.set()
+        await runner
+
+    run(scenario)
+
+
+def test_unfillable_publish_mapping_is_ignored():
+    client = mqtt.Client(bus=EventBus(), publish=[('sensor.*', 'home/#'), ('sensor.#', 'home/#')],
+                         client=BrokerClient(Broker()))
+    assert [m.target for m in client._publish_maps.match('sensor.kitchen')] == ['home/#']
+
+
+def bus_to_mqtt(source: str, target: str) -> mqtt.TopicMap:
+    return mqtt.TopicMap(source, target, mqtt.BUS_WILDCARDS, mqtt.MQTT_WILDCARDS)
+
+
+def test_topic_map_translate():
+    mapping = bus_to_mqtt('tracking.#', 'home/tracking/#')
+    assert mapping.translate('tracking.event.user_enter') == 'home/tracking/event/user_enter'
+    assert mapping.translate('audio.volumio.volume') is None
+
+    mapping = bus_to_mqtt('sensor.*.temperature', 'home/+/temperature')
+    assert mapping.translate('sensor.kitchen.temperature') == 'home/kitchen/temperature'
+    assert mapping.translate('sensor.kitchen.humidity') is None
+    assert mapping.translate('sensor.kitchen.temperature.max') is None
+    assert mapping.translate('sensor.kitchen') is None
+
+    # captures fill the target wildcards in order, captures left over are dropped
+    mapping = bus_to_mqtt('*.*.#', 'home/+/+/all')
+    assert mapping.translate('a.b.c.d') == 'home/a/b/all'
+
+    mapping = mqtt.TopicMap('home/+/temperature', 'sensor.*.temperature', mqtt.MQTT_WILDCARDS, mqtt.BUS_WILDCARDS)
+    assert mapping.translate('home/hall/temperature') == 'sensor.hall.temperature'
+
+
+@pytest.mark.parametrize('source, target', [('sensor.*', 'home/#'), ('sensor.#', 'home/+'), ('sensor.*', 'home/+/+'),
+                                            ('sensor.kitchen', 'home/+')])
+def test_topic_map_rejects_unfillable_target(source, target):
+    with pytest.raises(ValueError):
+        bus_to_mqtt(source, target)
+
+
+def test_publish_in_batches():
+    async def scenario():
+        bus, broker = EventBus(), Broker()
+        recorder = await Recorder(broker).start()
+        client = mqtt.Client(bus=bus, publish=[('sensor.#', 'home/#')], batch_size=10, client=BrokerClient(broker))
+        shutdown_signal, runner = await start(client)
+
+        batches = mqtt.PUBLISH_SECONDS.labels().count
+        for i in range(25):
+            bus.emit(f'sensor.room{i}', Event({'value': i}))
+        bus.emit('audio.volumio.volume', Event())
+        await published(client, 25)
+        assert [topic for topic, _ in recorder.messages] == [f'home/room{i}' for i in range(25)]
+        assert mqtt.PUBLISH_SECONDS.labels().count - batches == 3
+
+        shutdown_signal.set()
+        await runner
+
+    run(scenario)
+
+
+def test_buffer_while_disconnected():
+    async def scenario():
+        bus, broker = EventBus(), Broker()
+        recorder = await Recorder(broker).start()
+        client = mqtt.Client(bus=bus, publish=[('sensor.#', 'home/#')], buffer_size=3, reconnect_min=0.05,
+                             client=BrokerClient(broker))
+        shutdown_signal, runner = await start(client)
+
+        client.client.disconnect()
+        for i in range(5):
+            bus.emit(f'sensor.room{i}', Event())
+        assert [topic for topic, _ in client.outgoing] == ['home/room2', 'home/room3', 'home/room4']
+        assert client.stats['dropped'] == 2
+
+        # flushed once reconnected
+        await client.connected.wait()
+        await published(client, 5)
+        assert [topic for topic, _ in recorder.messages] == ['home/room2', 'home/room3', 'home/room4']
+
+        shutdown_signal.set()
+        await runner
+
+    run(scenario)
+
+
+def test_reconnect_backoff(monkeypatch):
+    delays = []
+
+    def uniform(low: float, high: float) -> float:
+        delays.append(high)
+        return 0
+
+    monkeypatch.setattr(mqtt.random, 'uniform', uniform)
+
+    async def scenario():
+        fake = RefusingClient(Broker(), refusals=4)
+        client = mqtt.Client(bus=EventBus(), reconnect_min=1, reconnect_max=4, client=fake)
+        shutdown_signal, runner = await start(client)
+        assert fake.attempts == 5
+        assert delays == [1, 2, 4, 4]
+
+        # a lost connection waits too, starting over from the minimum since the last one succeeded
+        for _ in range(3):
+            # let run take note of the connection first
+            await asyncio.sleep(0)
+        client.client.disconnect()
+        while fake.attempts < 6:
+            await asyncio.sleep(0)
+        await client.connected.wait()
+        assert delays == [1, 2, 4, 4, 1]
+
+        shutdown_signal.set()
+        await runner
+
+    run(scenario)
+
+
+def test_subscribe_forwards_to_bus():
+    async def scenario():
+        bus, broker = EventBus(), Broker()
+        sensor = await Recorder(broker).start()
+        client = mqtt.Client(bus=bus, subscribe=[('home/+/temperature', 'sensor.*.temperature')],
+                             client=BrokerClient(broker))
+        received = []
+        bus.on('sensor.#', lambda event: received.append(event))
+        shutdown_signal, runner = await start(client)
+
+        sensor.publish('home/kitchen/temperature', b'21.5')
+        sensor.publish('home/kitchen/humidity', b'40')
+        sensor.publish('home/hall/temperature', b'not json')
+        assert [(event.topic, event.data) for event in received] == [('home/kitchen/temperature', 21.5),
+                                                                     ('home/hall/temperature', 'not json')]
+        assert client.stats['received'] == 2
+
+        shutdown_signal.set()
+        await runner
+
+    run(scenario)
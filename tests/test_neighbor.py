@@ -0,0 +1,64 @@
+import asyncio
+from typing import Dict, Iterable, List
+
+from wifi.neighbor import (NUD_DELAY, NUD_FAILED, NUD_PROBE, NUD_REACHABLE, NUD_STALE, NUD_INCOMPLETE, NUD_PERMANENT,
+                           Neighbor, NeighborScanner, parse_proc_net_arp)
+
+PROC_NET_ARP = """IP address       HW type     Flags       HW address            Mask     Device
+192.168.1.1      0x1         0x6         b8:27:eb:00:00:01     *        wlan0
+192.168.1.20     0x1         0x2         B8:27:EB:00:00:14     *        wlan0
+192.168.1.30     0x1         0x0         00:00:00:00:00:00     *        wlan0
+"""
+
+
+class TableScanner(NeighborScanner):
+    """NeighborScanner reading the given neighbor tables in turn and recording the probed addresses."""
+
+    def __init__(self, tables: List[Dict[str, int]], use_netlink: bool = True):
+        super().__init__(asyncio.Event(), probe_wait=0)
+        self.use_netlink = use_netlink
+        self.tables = list(tables)
+        self.probed = []
+
+    def read_table(self) -> Dict[str, Neighbor]:
+        states = self.tables.pop(0)
+        return {mac: Neighbor(f'10.0.0.{i}', mac, state) for i, (mac, state) in enumerate(sorted(states.items()))}
+
+    def probe(self, ips: Iterable[str]) -> None:
+        self.probed.extend(ips)
+
+
+def scan(scanner: TableScanner, targets: Iterable[str]):
+    return asyncio.run(scanner.scan(targets))
+
+
+def test_parse_proc_net_arp():
+    assert list(parse_proc_net_arp(PROC_NET_ARP.splitlines())) == [
+        Neighbor('192.168.1.1', 'b8:27:eb:00:00:01', NUD_PERMANENT),
+        Neighbor('192.168.1.20', 'b8:27:eb:00:00:14', NUD_STALE),
+        Neighbor('192.168.1.30', '00:00:00:00:00:00', NUD_INCOMPLETE)
+    ]
+
+
+def test_only_confirmed_entries_are_present():
+    scanner = TableScanner([
+        {'a': NUD_REACHABLE, 'b': NUD_STALE, 'c': NUD_STALE, 'd': NUD_STALE, 'e': NUD_PERMANENT},
+        # a is not probed and stays present whatever happened in the meantime
+        {'a': NUD_STALE, 'b': NUD_DELAY, 'c': NUD_REACHABLE, 'd': NUD_PROBE, 'e': NUD_PERMANENT}
+    ])
+    assert scan(scanner, 'abcd') == {'a', 'c', 'e'}
+    assert len(scanner.probed) == 3
+
+
+def test_departed_entry_is_probed_at_its_last_address():
+    scanner = TableScanner([{'a': NUD_REACHABLE}, {'a': NUD_STALE}, {'a': NUD_FAILED}, {}, {}])
+    assert scan(scanner, 'a') == {'a'}
+    assert scan(scanner, 'a') == set()
+    assert scan(scanner, 'a') == set()
+    assert scanner.probed == ['10.0.0.0', '10.0.0.0']
+
+
+def test_proc_fallback_counts_complete_entries():
+    scanner = TableScanner([{'a': NUD_STALE, 'b': NUD_STALE}, {'a': NUD_STALE, 'b': NUD_INCOMPLETE}],
+                           use_netlink=False)
+    assert scan(scanner, 'ab') == {'a'}
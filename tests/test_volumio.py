@@ -0,0 +1,239 @@
+import asyncio
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+import pytest
+import socketio
+
+from audio import volumio
+from audio.state import VolumioState
+from audio.volumio import VolumioControl
+from bus import e_bus
+from bus.events import Event
+
+Settings = namedtuple('Settings', 'volumio_host volumio_port command_timeout reconnect_min reconnect_max')
+
+
+class FakeSocketIO:
+    """
+    Stand-in for socketio.AsyncClient connected to a Volumio device. Commands change the device state, which is pushed
+    back to the registered pushState and pushQueue handlers in a later loop iteration, like the real device does.
+    """
+
+    def __init__(self, state: Optional[Dict] = None, queue: Optional[List[Dict]] = None):
+        self.handlers = {}
+        self.connected = False
+        self.emitted = []
+        self.state = state or {'status': 'stop', 'volume': 50, 'mute': False, 'title': 'a', 'artist': 'b'}
+        self.queue = queue or []
+        self.connections = []
+        # url: number of connection attempts to refuse
+        self.refuse: Dict[str, int] = {}
+
+    def on(self, event: str, handler) -> None:
+        self.handlers[event] = handler
+
+    async def connect(self, url: str) -> None:
+        self.connections.append(url)
+        if self.refuse.get(url):
+            self.refuse[url] -= 1
+            raise socketio.exceptions.ConnectionError('Connection refused')
+        self.connected = True
+        await self.handlers['connect']()
+
+    async def shutdown(self) -> None:
+        if self.connected:
+            await self.disconnect()
+
+    async def disconnect(self) -> None:
+        self.connected = False
+        await self.handlers['disconnect']()
+
+    async def emit(self, event: str, data=None) -> None:
+        self.emitted.append((event, data))
+        if event == 'volume':
+            self.state['volume'] = data
+        elif event in ('play', 'pause'):
+            self.state['status'] = event
+        elif event == 'addToQueue':
+            self.queue = self.queue + [{'uri': data['uri']}]
+        elif event == 'moveQueue':
+            queue = list(self.queue)
+            queue.insert(data['to'], queue.pop(data['from']))
+            self.queue = queue
+
+        if event in ('getQueue', 'addToQueue', 'moveQueue'):
+            self.push('pushQueue', list(self.queue))
+        else:
+            self.push('pushState', dict(self.state))
+
+    def push(self, event: str, data) -> None:
+        asyncio.get_event_loop().call_soon(asyncio.ensure_future, self.handlers[event](data))
+
+
+async def settle() -> None:
+    """Let pushes scheduled by the fake device reach the mirror."""
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+async def connect(sio: FakeSocketIO) -> VolumioControl:
+    control = VolumioControl('volumio.test', 3000, timeout=1, sio=sio)
+    # cancelled by asyncio.run once the test is done
+    asyncio.ensure_future(control.commands.run(control.connected))
+    await control.sio.connect(control.url)
+    await settle()
+    return control
+
+
+def run(scenario) -> None:
+    asyncio.run(asyncio.wait_for(scenario(), 5))
+
+
+@pytest.fixture
+def emitted():
+    """The (topic, event) pairs of audio.volumio events emitted on the bus."""
+    events = []
+
+    def tap(event_type: str, event: Event) -> None:
+        if event_type.startswith('audio.volumio.'):
+            events.append((event_type, event))
+
+    e_bus.tap(tap)
+    yield events
+    e_bus.untap(tap)
+
+
+def test_apply_state_reports_changed_groups():
+    state = VolumioState()
+    assert state.apply_state({'status': 'play', 'volume': 20, 'title': 'x'}) == {'status', 'volume', 'track'}
+    assert state.apply_state({'status': 'play', 'volume': 30, 'title': 'x'}) == {'volume'}
+    assert state.apply_state({'status': 'play', 'volume': 30, 'title': 'x'}) == set()
+    assert state.apply_state({'consume': True}) == {'other'}
+    assert state.group('volume') == {'volume': 30, 'mute': None, 'disableVolumeControl': None}
+
+
+def test_apply_queue_indexes_first_occurrence():
+    state = VolumioState()
+    assert state.apply_queue([{'uri': 'a'}, {'uri': 'b'}, {'uri': 'a'}, {'title': 'no uri'}])
+    assert state.queue_index == {'a': 0, 'b': 1}
+    assert state.queue_version == 1
+    assert not state.apply_queue([{'uri': 'a'}, {'uri': 'b'}, {'uri': 'a'}, {'title': 'no uri'}])
+    assert state.queue_version == 1
+    assert state.apply_queue([{'uri': 'b'}])
+    assert state.position('b') == 0 and state.position('a') is None
+
+
+def test_push_state_emits_only_changed_groups(emitted):
+    async def scenario():
+        sio = FakeSocketIO()
+        control = await connect(sio)
+        assert sorted(topic for topic, _ in emitted) == ['audio.volumio.status', 'audio.volumio.track',
+                                                         'audio.volumio.volume']
+
+        emitted.clear()
+        assert await control.set_volume(70)
+        assert sio.emitted[-1] == ('volume', 70)
+        assert [(topic, event.data['volume']) for topic, event in emitted] == [('audio.volumio.volume', 70)]
+
+        # pushing an unchanged state reports nothing
+        emitted.clear()
+        sio.push('pushState', dict(sio.state))
+        await settle()
+        assert emitted == []
+
+    run(scenario)
+
+
+def test_push_queue_updates_index(emitted):
+    async def scenario():
+        sio = FakeSocketIO(queue=[{'uri': 'a'}, {'uri': 'b'}])
+        control = await connect(sio)
+        assert control.mirror.queue_index == {'a': 0, 'b': 1}
+        assert [event.data for topic, event in emitted if topic == 'audio.volumio.queue'] == [{'length': 2}]
+
+        emitted.clear()
+        sio.push('pushQueue', [{'uri': 'c'}, {'uri': 'a'}, {'uri': 'b'}])
+        await settle()
+        assert control.mirror.queue_index == {'c': 0, 'a': 1, 'b': 2}
+        assert [event.data for _, event in emitted] == [{'length': 3}]
+
+        # the same queue again is no change
+        emitted.clear()
+        sio.push('pushQueue', [{'uri': 'c'}, {'uri': 'a'}, {'uri': 'b'}])
+        await settle()
+        assert emitted == []
+
+    run(scenario)
+
+
+def test_move_queue(monkeypatch):
+    monkeypatch.setattr(volumio, 'QUEUE_UPDATE_TIMEOUT', 0.1)
+
+    async def scenario():
+        sio = FakeSocketIO(queue=[{'uri': 'a'}, {'uri': 'b'}])
+        control = await connect(sio)
+
+        assert await control.add_to_queue('c')
+        assert control.mirror.position('c') == 2
+        assert await control.move_queue('c', 0)
+        assert sio.emitted[-1] == ('moveQueue', {'from': 2, 'to': 0})
+        assert [item['uri'] for item in control.mirror.queue] == ['c', 'a', 'b']
+        assert control.mirror.queue_index == {'c': 0, 'a': 1, 'b': 2}
+
+        # already in place, nothing is sent
+        sent = len(sio.emitted)
+        assert await control.move_queue('c', 0)
+        assert len(sio.emitted) == sent
+
+        # never shows up in the queue
+        assert not await control.move_queue('missing', 0)
+        assert len(sio.emitted) == sent
+
+    run(scenario)
+
+
+def test_commands_expire_while_disconnected():
+    async def scenario():
+        sio = FakeSocketIO()
+        control = await connect(sio)
+        control.commands.timeout = 0.05
+        await sio.disconnect()
+
+        assert not await control.set_volume(70)
+        assert control.commands.stats['expired'] == 1
+
+        # the stale command is not sent once the device is back
+        sent = len(sio.emitted)
+        await sio.connect(control.url)
+        await settle()
+        assert [event for event, _ in sio.emitted[sent:]] == ['getState', 'getQueue']
+        assert await control.set_volume(80)
+        assert sio.emitted[-1] == ('volume', 80)
+
+    run(scenario)
+
+
+def test_reconnect_when_moved(monkeypatch):
+    monkeypatch.setattr(volumio.random, 'uniform', lambda low, high: 0)
+
+    async def scenario():
+        sio = FakeSocketIO()
+        control = VolumioControl('volumio.test', 3000, reconnect_min=0.01, sio=sio)
+        sio.refuse = {'http://volumio.test:3000': 1, 'http://moved.test:3000': 2}
+        shutdown_signal = asyncio.Event()
+        runner = asyncio.ensure_future(control.run(shutdown_signal))
+        await control.connected.wait()
+
+        await control.apply_settings(Settings('moved.test', 3000, 1, 0.01, 1), ['volumio_host'])
+        while len(sio.connections) < 5:
+            await asyncio.sleep(0)
+        await control.connected.wait()
+        assert sio.connections == ['http://volumio.test:3000'] * 2 + ['http://moved.test:3000'] * 3
+        assert await control.set_volume(20)
+
+        shutdown_signal.set()
+        await runner
+        assert not sio.connected
+
+    run(scenario)
@@ -0,0 +1,83 @@
+import asyncio
+from collections import namedtuple
+from typing import Iterable, List, Optional, Set
+
+import pytest
+
+from bus import e_bus
+from bus.events import Event
+from wifi import Watcher
+from wifi.scanner import Scanner
+from wifi.scheduler import ScanScheduler
+
+ALICE = 'b8:27:eb:1c:0a:af'
+BOB = 'b8:27:eb:1c:0a:b0'
+
+Settings = namedtuple('Settings', 'to_track')
+
+
+class ScriptedScanner(Scanner):
+    """Returns the given scan results in turn, calling `after[i]` after the i-th scan, then stops the watcher."""
+
+    def __init__(self, terminate: asyncio.Event, results: List[Set[str]], after=()):
+        self.terminate = terminate
+        self.results = list(results)
+        self.after = list(after)
+
+    async def scan(self, targets: Iterable[str]) -> Optional[Set[str]]:
+        if not self.results:
+            self.terminate.set()
+            return None
+        if self.after:
+            asyncio.get_event_loop().call_soon(self.after.pop(0))
+        return self.results.pop(0)
+
+
+@pytest.fixture
+def tracking_events():
+    """The (topic, user name) of tracking events emitted on the bus."""
+    events = []
+
+    def tap(event_type: str, event: Event) -> None:
+        if event_type.startswith('tracking.event.'):
+            events.append((event_type, event.user.name))
+
+    e_bus.tap(tap)
+    yield events
+    e_bus.untap(tap)
+
+
+def run_watcher(results: List[Set[str]], after=(), to_track=(('alice', ALICE), ('bob', BOB)),
+                restore=None) -> Watcher:
+    async def scenario():
+        terminate = asyncio.Event()
+        watcher = Watcher(terminate, None, ScanScheduler(interval=0.001), to_track=to_track)
+        watcher.scanner = ScriptedScanner(terminate, results, [lambda f=f: f(watcher) for f in after])
+        if restore is not None:
+            watcher.restore(restore)
+            watcher.scheduler.next_wake = None
+        await watcher.run()
+        return watcher
+
+    return asyncio.run(asyncio.wait_for(scenario(), 5))
+
+
+def test_enter(tracking_events):
+    run_watcher([{ALICE, 'aa:bb:cc:dd:ee:ff'}, {ALICE.upper()}])
+    assert tracking_events == [('tracking.event.user_enter', 'alice')]
+
+
+def test_untracked_device_exits(tracking_events):
+    # bob is no longer tracked after the first scan, he exits even though his device is still there
+    watcher = run_watcher([{ALICE, BOB}, {ALICE, BOB}],
+                          after=[lambda w: w.apply_settings(Settings([('alice', ALICE)]), ['to_track'])])
+    # entries come out of a set, in no particular order
+    assert sorted(tracking_events[:2]) == [('tracking.event.user_enter', 'alice'), ('tracking.event.user_enter', 'bob')]
+    assert tracking_events[2:] == [('tracking.event.user_exit', 'bob')]
+    assert list(watcher.users) == list(watcher.tracked)
+
+
+def test_restored_device_exits_under_its_name(tracking_events):
+    run_watcher([{ALICE}], to_track=(('alice', ALICE),),
+                restore={'tracked': {ALICE: 0, BOB: 0}, 'names': {BOB: 'bob'}})
+    assert tracking_events == [('tracking.event.user_exit', 'bob')]
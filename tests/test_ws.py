@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+from bus import EventBus
+from bus.events import Event
+from bus.ws import WebsocketBridge, WebsocketClient
+
+
+class FakeWebsocket:
+    """Stand-in for web.WebSocketResponse, failing sends once `broken`."""
+
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+        self.sent = []
+
+    async def send_str(self, data: str) -> None:
+        if self.broken:
+            raise ConnectionResetError('Cannot write to closing transport')
+        self.sent.append(json.loads(data))
+
+    async def close(self, **kwargs) -> None:
+        self.closed = True
+
+
+def attach(bridge: WebsocketBridge, topics) -> WebsocketClient:
+    client = WebsocketClient(FakeWebsocket(), bridge.queue_size, bridge.slow_policy)
+    bridge._attach(client)
+    invalid = bridge._subscribe(client, topics)
+    if invalid:
+        bridge._reject(client, invalid)
+    return client
+
+
+def test_invalid_patterns_are_rejected():
+    async def scenario():
+        bus = EventBus()
+        bridge = WebsocketBridge(bus)
+        client = attach(bridge, ['a.#.b', 'a.*', 3])
+        sender = asyncio.ensure_future(bridge._send(client))
+        assert client.filters == {'a.*'}
+
+        bus.emit('a.b', Event({'value': 1}))
+        await asyncio.sleep(0)
+        assert client.ws.sent == [{'type': 'error', 'error': 'invalid topic pattern', 'topics': ['a.#.b', 3]},
+                                  {'topic': 'a.b', 'event': {'type': 'Event', 'data': {'value': 1}}}]
+        sender.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_failed_send_drops_the_client():
+    async def scenario():
+        bus = EventBus()
+        bridge = WebsocketBridge(bus)
+        client = attach(bridge, ['#'])
+        other = attach(bridge, ['#'])
+        sender = asyncio.ensure_future(bridge._send(client))
+        other_sender = asyncio.ensure_future(bridge._send(other))
+
+        client.ws.broken = True
+        bus.emit('a', Event())
+        await sender
+        assert client.ws.closed
+        assert bridge.clients == {other}
+
+        bus.emit('b', Event())
+        await asyncio.sleep(0)
+        assert not client.queue
+        assert [message['topic'] for message in other.ws.sent] == ['a', 'b']
+        other_sender.cancel()
+
+    asyncio.run(scenario())
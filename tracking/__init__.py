@@ -0,0 +1,112 @@
+import asyncio
+from time import time
+from typing import Dict, List, NamedTuple
+
+from modular_conf.fields import ChoiceField, IntField
+
+from bus import e_bus
+from bus.events import Event
+from common.events import TrackingEvent
+from config.live import live_config
+
+from log import LOG
+import snapshot
+from tracking.history import PresenceHistory
+
+
+MODULE_NAME = 'tracking'
+DEPENDS = ('bus', 'snapshot')
+CONFIG_FIELDS = [
+    ChoiceField('test_choice', default='one', choices=('one', 'two', 'three', 'four'), type=str),
+    IntField('history_retention_days', default=30),
+    IntField('history_downsample_hours', default=24),
+    IntField('history_merge_gap', default=300),
+    IntField('history_max_transitions', default=10000),
+    IntField('history_compact_interval', default=3600)
+]
+
+
+tracker = None
+
+
+class UserTracker:
+    def __init__(self, history: PresenceHistory = None):
+        self.users = {}
+        # increases with every change of users, e.g. for caching
+        self.version = 0
+        self.history = history if history is not None else PresenceHistory()
+
+        e_bus.on('tracking.event.user_enter', self.on_user_enter)
+        e_bus.on('tracking.event.user_exit', self.on_user_exit)
+
+    async def on_user_enter(self, event: TrackingEvent) -> None:
+        if len(self.users) == 0:
+            LOG.info('First user entered, initializing system')
+            e_bus.emit('tracking.action.initialize', Event())
+
+        now = time()
+        self.users[event.user.name] = now
+        self.history.record(event.user.name, True, now)
+        self.version += 1
+
+    async def on_user_exit(self, event: TrackingEvent) -> None:
+        if event.user.name in self.users:
+            del self.users[event.user.name]
+            self.history.record(event.user.name, False)
+            self.version += 1
+
+        if len(self.users) == 0:
+            LOG.info('Last user let, shutting down system')
+            e_bus.emit('tracking.action.shutdown', Event())
+
+    def snapshot(self) -> Dict:
+        return {'users': dict(self.users), 'history': self.history.serialize()}
+
+    def restore(self, state: Dict) -> None:
+        """
+        Take over the users present before a restart. No initialize action is emitted for them, whatever it set up
+        is still in place.
+        """
+        self.users = dict(state.get('users', {}))
+        try:
+            self.history.load(state.get('history', {}))
+        except (ValueError, KeyError) as e:
+            LOG.warning(f'Ignoring presence history from snapshot: {e}')
+        self.version += 1
+
+    def get_current_users(self) -> List:
+        return [{'name': user, 'time': since} for user, since in self.users.items()]
+
+
+def apply_settings(settings: NamedTuple) -> None:
+    history = tracker.history
+    history.retention = settings.history_retention_days * 86400
+    history.downsample_after = settings.history_downsample_hours * 3600
+    history.merge_gap = settings.history_merge_gap
+    history.max_transitions = settings.history_max_transitions
+
+
+async def main(shutdown_signal: asyncio.Event):
+    settings = live_config.register(MODULE_NAME, CONFIG_FIELDS)
+
+    global tracker
+    tracker = UserTracker(PresenceHistory())
+    apply_settings(settings)
+    state = snapshot.restore(MODULE_NAME)
+    if state is not None:
+        tracker.restore(state)
+    snapshot.register(MODULE_NAME, tracker.snapshot)
+
+    e_bus.on(f'config.changed.{MODULE_NAME}', lambda event: apply_settings(live_config.get(MODULE_NAME)))
+
+    while not shutdown_signal.is_set():
+        try:
+            await asyncio.wait_for(shutdown_signal.wait(), live_config.get(MODULE_NAME).history_compact_interval)
+        except asyncio.TimeoutError:
+            dropped = tracker.history.compact()
+            if dropped:
+                LOG.debug(f'Dropped {dropped} presence transitions from history')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,194 @@
+from array import array
+from base64 import b64decode, b64encode
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, time as dt_time
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+EXIT = 0
+ENTER = 1
+
+
+class UserHistory:
+    """
+    Enter and exit transitions of one user, as two parallel append-only arrays sorted by time.
+    Transitions alternate, so whether the user was present at any time follows from the last transition before it.
+    """
+    __slots__ = ('times', 'kinds')
+
+    def __init__(self):
+        self.times = array('d')
+        self.kinds = array('B')
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def to_dict(self) -> Dict:
+        # raw array contents, snapshots are only read back on the same machine
+        return {'times': b64encode(self.times.tobytes()).decode(), 'kinds': b64encode(self.kinds.tobytes()).decode()}
+
+    @classmethod
+    def from_dict(cls, obj: Dict) -> 'UserHistory':
+        history = cls()
+        history.times.frombytes(b64decode(obj['times']))
+        history.kinds.frombytes(b64decode(obj['kinds']))
+        if len(history.times) != len(history.kinds):
+            raise ValueError('times and kinds differ in length')
+        return history
+
+    def record(self, kind: int, when: float) -> bool:
+        """
+        Returns:
+            False if the transition does not change anything, e.g. a second enter
+        """
+        if self.kinds and self.kinds[-1] == kind:
+            return False
+        if self.times and when < self.times[-1]:
+            # keep the arrays sorted if the clock went backwards
+            when = self.times[-1]
+        self.times.append(when)
+        self.kinds.append(kind)
+        return True
+
+    def present_at(self, when: float) -> bool:
+        i = bisect_right(self.times, when)
+        return i > 0 and self.kinds[i - 1] == ENTER
+
+    def intervals(self, start: float, end: float, now: float) -> List[Tuple[float, float]]:
+        """Presence intervals overlapping [start, end], clipped to it. An ongoing presence lasts until `now`."""
+        i = bisect_right(self.times, start)
+        j = bisect_right(self.times, end)
+        result = []
+        since = start if i > 0 and self.kinds[i - 1] == ENTER else None
+        for k in range(i, j):
+            if self.kinds[k] == ENTER:
+                since = self.times[k]
+            elif since is not None:
+                result.append((since, self.times[k]))
+                since = None
+        if since is not None and since <= now:
+            result.append((since, min(end, now)))
+        return result
+
+    def drop_before(self, when: float) -> int:
+        """
+        Forget transitions before `when`. A presence ongoing at `when` is kept as an enter at `when`.
+        Returns:
+            the number of dropped transitions
+        """
+        cut = bisect_left(self.times, when)
+        if cut == 0:
+            return 0
+        if self.kinds[cut - 1] == ENTER:
+            cut -= 1
+            self.times[cut] = max(self.times[cut], when)
+        del self.times[:cut]
+        del self.kinds[:cut]
+        return cut
+
+    def merge_gaps(self, before: float, gap: float) -> int:
+        """
+        Downsample transitions before `before` by dropping absences shorter than `gap`, e.g. a phone briefly
+        dropping off the network.
+        Returns:
+            the number of dropped transitions
+        """
+        end = bisect_left(self.times, before)
+        times, kinds = self.times, self.kinds
+        keep_times, keep_kinds = array('d'), array('B')
+        k = 0
+        while k < end:
+            if kinds[k] == EXIT and k + 1 < end and times[k + 1] - times[k] < gap:
+                k += 2
+                continue
+            keep_times.append(times[k])
+            keep_kinds.append(kinds[k])
+            k += 1
+        dropped = end - len(keep_times)
+        if dropped:
+            self.times = keep_times + times[end:]
+            self.kinds = keep_kinds + kinds[end:]
+        return dropped
+
+
+def split_days(start: float, end: float) -> Iterable[Tuple[str, float]]:
+    """Split [start, end] at local midnights into (ISO date, seconds) pairs."""
+    while start < end:
+        day = datetime.fromtimestamp(start).date()
+        midnight = datetime.combine(day + timedelta(days=1), dt_time()).timestamp()
+        yield day.isoformat(), min(end, midnight) - start
+        start = midnight
+
+
+def dwell_per_day(intervals: Dict[str, List[Tuple[float, float]]]) -> Dict[str, Dict[str, float]]:
+    """Seconds of presence of each user per local day, from the intervals returned by `PresenceHistory.intervals`."""
+    result = {}
+    for user, user_intervals in intervals.items():
+        days: Dict[str, float] = {}
+        for since, until in user_intervals:
+            for day, seconds in split_days(since, until):
+                days[day] = days.get(day, 0) + seconds
+        result[user] = days
+    return result
+
+
+class PresenceHistory:
+    """
+    Presence transitions of all users, answering range queries with binary searches over the per-user arrays.
+    Memory is bounded by `retention` (seconds of history kept), by merging short absences in transitions older than
+    `downsample_after` seconds and by a hard limit of `max_transitions` per user.
+    """
+
+    def __init__(self, retention: float = 30 * 86400, downsample_after: float = 86400, merge_gap: float = 300,
+                 max_transitions: int = 10000):
+        self.retention = retention
+        self.downsample_after = downsample_after
+        self.merge_gap = merge_gap
+        self.max_transitions = max_transitions
+        self.users: Dict[str, UserHistory] = {}
+
+    def __len__(self) -> int:
+        return sum(len(history) for history in self.users.values())
+
+    def serialize(self) -> Dict:
+        return {user: history.to_dict() for user, history in self.users.items()}
+
+    def load(self, data: Dict) -> None:
+        self.users = {user: UserHistory.from_dict(obj) for user, obj in data.items()}
+
+    def record(self, user: str, enter: bool, when: Optional[float] = None) -> None:
+        history = self.users.get(user)
+        if history is None:
+            history = self.users[user] = UserHistory()
+        history.record(ENTER if enter else EXIT, time() if when is None else when)
+        if len(history) > self.max_transitions:
+            history.drop_before(history.times[len(history) - self.max_transitions])
+
+    def _select(self, users: Optional[Iterable[str]]) -> Dict[str, UserHistory]:
+        if users is None:
+            return self.users
+        return {user: self.users[user] for user in users if user in self.users}
+
+    def intervals(self, start: float, end: float, users: Optional[Iterable[str]] = None,
+                  now: Optional[float] = None) -> Dict[str, List[Tuple[float, float]]]:
+        """Presence intervals of each user within [start, end], users that were not present are left out."""
+        now = time() if now is None else now
+        result = {}
+        for user, history in self._select(users).items():
+            intervals = history.intervals(start, end, now)
+            if intervals:
+                result[user] = intervals
+        return result
+
+    def compact(self, now: Optional[float] = None) -> int:
+        """
+        Apply retention and downsampling.
+        Returns:
+            the number of dropped transitions
+        """
+        now = time() if now is None else now
+        dropped = 0
+        for history in self.users.values():
+            dropped += history.drop_before(now - self.retention)
+            dropped += history.merge_gaps(now - self.downsample_after, self.merge_gap)
+        return dropped
@@ -1,38 +1,175 @@
 import asyncio
 from threading import Thread
+from time import perf_counter, time
+from typing import Awaitable, Callable
 
 from aiohttp import web
 from aiohttp.abc import Request, StreamResponse
+from modular_conf.fields import StringField, IntField, ChoiceField
 
+from bus import e_bus
+from bus.ws import WebsocketBridge
 from config import config
+from config.live import live_config
+from tracking.history import dwell_per_day
+from web import presence
+from web.cache import ResponseCache
+import metrics
+import registry
 import tracking
 
+MODULE_NAME = 'web'
+DEPENDS = ('bus', 'tracking')
+CONFIG_FIELDS = [
+    StringField('host', default='localhost'),
+    IntField('port', default=8080),
+    IntField('ws_queue_size', default=256),
+    ChoiceField('ws_slow_client', default='coalesce', choices=('coalesce', 'drop'), type=str)
+]
+
+REQUEST_SECONDS = metrics.histogram('http_request_seconds', 'HTTP request latency, websockets excluded',
+                                    ('route', 'method', 'status'))
+
 routes = web.RouteTableDef()
+bridge = None
+feed = None
+cache = ResponseCache()
+# increases with every config update through the api
+config_version = 0
+
+
+@web.middleware
+async def metrics_middleware(request: Request,
+                             handler: Callable[[Request], Awaitable[StreamResponse]]) -> StreamResponse:
+    begin = perf_counter()
+    # labelled by route pattern instead of path, so that the number of label values stays bounded
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        REQUEST_SECONDS.labels(route, request.method, str(e.status)).observe(perf_counter() - begin)
+        raise
+    except Exception:
+        REQUEST_SECONDS.labels(route, request.method, '500').observe(perf_counter() - begin)
+        raise
+    # the lifetime of a websocket connection says nothing about latency, see the websocket_* metrics instead
+    if not isinstance(response, web.WebSocketResponse):
+        REQUEST_SECONDS.labels(route, request.method, str(response.status)).observe(perf_counter() - begin)
+    return response
 
 
-@routes.get('/api/tracking/')
-async def api_tracking_list():
-    return tracking.get_current_users()
+@routes.get('/api/metrics')
+async def api_metrics(request: Request) -> StreamResponse:
+    """All metrics in the Prometheus text format."""
+    return web.Response(body=metrics.REGISTRY.render().encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
 
 
-@routes.get('/api/config')
-async def api_config(request: Request) -> StreamResponse:
+@routes.get('/api/ws')
+async def api_ws(request: Request) -> StreamResponse:
+    if bridge is None:
+        raise web.HTTPServiceUnavailable()
+    return await bridge.handle(request)
+
+
+@routes.get('/api/tracking/')
+async def api_tracking_list(request: Request) -> StreamResponse:
+    if tracking.tracker is None:
+        raise web.HTTPServiceUnavailable()
+    return cache.respond(request, 'tracking', tracking.tracker.version, tracking.tracker.get_current_users)
+
+
+@routes.get('/api/tracking/stream')
+async def api_tracking_stream(request: Request) -> StreamResponse:
+    if feed is None:
+        raise web.HTTPServiceUnavailable()
+    return await presence.stream(feed, request)
+
+
+@routes.get('/api/tracking/poll')
+async def api_tracking_poll(request: Request) -> StreamResponse:
+    if feed is None:
+        raise web.HTTPServiceUnavailable()
+    return await presence.poll(feed, request)
+
+
+@routes.get('/api/tracking/history')
+async def api_tracking_history(request: Request) -> StreamResponse:
+    """
+    Presence between the `start` and `end` timestamps (the last day by default), optionally only of the comma
+    separated `users`, with the presence intervals and dwell time per day of everyone who was present.
+    """
+    if tracking.tracker is None:
+        raise web.HTTPServiceUnavailable()
     try:
-        data = request.json()
-    except:
+        end = float(request.query.get('end', time()))
+        start = float(request.query.get('start', end - 86400))
+    except ValueError:
         raise web.HTTPBadRequest()
-    config.update(data, full=True)
+    if start > end:
+        raise web.HTTPBadRequest()
+    users = request.query.get('users')
+    users = users.split(',') if users else None
+
+    intervals = tracking.tracker.history.intervals(start, end, users)
+    return web.json_response({
+        'start': start,
+        'end': end,
+        'present': sorted(intervals),
+        'intervals': intervals,
+        'dwell': dwell_per_day(intervals)
+    })
+
+
+@routes.get('/api/bus/stats')
+async def api_bus_stats(request: Request) -> StreamResponse:
+    stats = e_bus.stats()
+    if bridge is not None:
+        stats['websocket'] = bridge.stats()
+    return web.json_response(stats)
+
 
-    return web.json_response(config.serialize_json(full=True))
+@routes.get('/api/wifi/scheduler')
+async def api_wifi_scheduler(request: Request) -> StreamResponse:
+    wifi = registry.module('wifi')
+    if wifi is None or wifi.watcher is None:
+        raise web.HTTPServiceUnavailable()
+    return web.json_response(wifi.watcher.scheduler.serialize())
+
+
+@routes.get('/api/monitor')
+async def api_monitor(request: Request) -> StreamResponse:
+    """Event loop lag and the most recent stalls with what blocked the loop, newest first."""
+    monitor = registry.module('monitor')
+    if monitor is None or monitor.monitor is None:
+        raise web.HTTPServiceUnavailable()
+    return web.json_response(monitor.monitor.report())
+
+
+def _config_response(request: Request) -> StreamResponse:
+    return cache.respond(request, 'config', config_version, lambda: config.serialize_json(full=True))
+
+
+@routes.get('/api/config')
+async def api_config(request: Request) -> StreamResponse:
+    return _config_response(request)
 
 
 @routes.post('/api/config')
 async def api_config_post(request: Request) -> StreamResponse:
-    return web.json_response(config.serialize_json(full=True))
+    try:
+        data = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest()
+    live_config.update(data, full=True)
+
+    global config_version
+    config_version += 1
+    return _config_response(request)
 
 
 def _serve(loop: asyncio.AbstractEventLoop, shutdown_signal: asyncio.Event, host: str, port: int) -> None:
-    app = web.Application()
+    app = web.Application(middlewares=[metrics_middleware])
     app.add_routes(routes)
     runner = web.AppRunner(app)
     asyncio.set_event_loop(loop)
@@ -44,14 +181,23 @@ def _serve(loop: asyncio.AbstractEventLoop, shutdown_signal: asyncio.Event, host
 
 
 async def main(shutdown_signal: asyncio.Event):
-    app = web.Application()
+    settings = live_config.register(MODULE_NAME, CONFIG_FIELDS)
+
+    global bridge, feed
+    feed = presence.PresenceFeed(e_bus)
+    feed.start()
+    bridge = WebsocketBridge(e_bus, queue_size=settings.ws_queue_size, slow_policy=settings.ws_slow_client)
+
+    app = web.Application(middlewares=[metrics_middleware])
     app.add_routes(routes)
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, 'localhost', 8080)
+    site = web.TCPSite(runner, settings.host, settings.port)
     await site.start()
 
     await shutdown_signal.wait()
+    await bridge.close()
+    await runner.cleanup()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+import gzip
+import hashlib
+import json
+from typing import Any, Callable, Dict, Optional
+
+from aiohttp import web
+from aiohttp.abc import Request
+
+# bodies smaller than this are not worth compressing
+MIN_GZIP_SIZE = 512
+
+
+class CachedResponse:
+    """One version of a JSON response, serialized once and compressed at most once."""
+    __slots__ = ('version', 'body', 'etag', '_gzipped')
+
+    def __init__(self, version: int, body: bytes):
+        self.version = version
+        self.body = body
+        # hashing the body keeps etags valid across restarts, when version counters start over
+        self.etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        self._gzipped: Optional[bytes] = None
+
+    @property
+    def gzipped(self) -> bytes:
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body)
+        return self._gzipped
+
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header matches `etag`, comparing weakly and with '*' matching any etag."""
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return True
+    return False
+
+
+class ResponseCache:
+    """
+    Serves JSON responses from a cache keyed on a version counter of their source, e.g. UserTracker.version.
+    The body is only rebuilt when the version moved on. Clients revalidating with If-None-Match get a 304 and clients
+    accepting gzip get the body compressed.
+    """
+
+    def __init__(self, min_gzip_size: int = MIN_GZIP_SIZE):
+        self.min_gzip_size = min_gzip_size
+        self._entries: Dict[str, CachedResponse] = {}
+
+    def get(self, key: str, version: int, producer: Callable[[], Any]) -> CachedResponse:
+        entry = self._entries.get(key)
+        if entry is None or entry.version != version:
+            entry = CachedResponse(version, json.dumps(producer()).encode('utf-8'))
+            self._entries[key] = entry
+        return entry
+
+    def invalidate(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def respond(self, request: Request, key: str, version: int, producer: Callable[[], Any]) -> web.Response:
+        entry = self.get(key, version, producer)
+        headers = {'ETag': entry.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+
+        if _etag_matches(request.headers.get('If-None-Match'), entry.etag):
+            return web.Response(status=304, headers=headers)
+
+        body = entry.body
+        if len(body) >= self.min_gzip_size and 'gzip' in request.headers.get('Accept-Encoding', ''):
+            body = entry.gzipped
+            headers['Content-Encoding'] = 'gzip'
+        return web.Response(body=body, content_type='application/json', headers=headers)
@@ -0,0 +1,153 @@
+import asyncio
+import json
+from collections import deque
+from time import time
+from typing import Dict, List, NamedTuple, Optional
+
+from aiohttp import web
+from aiohttp.abc import Request
+
+from bus import EventBus
+from bus.events import Event
+import tracking
+
+# bus topic: change type
+TOPICS = {
+    'tracking.event.user_enter': 'enter',
+    'tracking.event.user_exit': 'exit',
+    'tracking.action.initialize': 'initialize',
+    'tracking.action.shutdown': 'shutdown'
+}
+
+
+class Change(NamedTuple):
+    version: int
+    data: Dict
+    # server sent event frame, built once for all streaming clients
+    frame: bytes
+
+
+class PresenceFeed:
+    """
+    Keeps a short history of presence changes coming off the bus and hands them to streaming and long-polling
+    clients. All clients share the feed's bus subscriptions, so their number does not affect the bus.
+    """
+
+    def __init__(self, bus: EventBus, history: int = 256):
+        self.bus = bus
+        self.version = 0
+        self.changes = deque(maxlen=history)
+        self._next = None
+
+    def start(self) -> None:
+        for topic, kind in TOPICS.items():
+            self.bus.on(topic, self._make_handler(kind))
+
+    def _make_handler(self, kind: str):
+        def handler(event: Event) -> None:
+            user = getattr(event, 'user', None)
+            self._record(kind, user.name if user is not None else None)
+
+        return handler
+
+    def _record(self, kind: str, user: Optional[str]) -> None:
+        self.version += 1
+        data = {'version': self.version, 'type': kind, 'user': user, 'time': time()}
+        frame = f'id: {self.version}\nevent: {kind}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+        self.changes.append(Change(self.version, data, frame))
+
+        if self._next is not None:
+            self._next.set_result(None)
+            self._next = None
+
+    def since(self, version: int) -> Optional[List[Change]]:
+        """
+        Changes after `version`.
+        Returns:
+            None if `version` is too old to be answered from the history and the client has to start over
+        """
+        if version > self.version:
+            # from before a restart
+            return None
+        if version == self.version:
+            return []
+        if not self.changes or self.changes[0].version > version + 1:
+            return None
+        # changes are consecutive, so the position follows from the version
+        start = version + 1 - self.changes[0].version
+        return [self.changes[i] for i in range(start, len(self.changes))]
+
+    async def wait(self, version: int, timeout: float) -> Optional[List[Change]]:
+        """Like since, but waits up to `timeout` seconds for a change if there is none yet."""
+        changes = self.since(version)
+        if changes != []:
+            return changes
+
+        if self._next is None:
+            self._next = asyncio.get_event_loop().create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._next), timeout)
+        except asyncio.TimeoutError:
+            return []
+        return self.since(version)
+
+
+def _current_users() -> List:
+    return tracking.tracker.get_current_users() if tracking.tracker is not None else []
+
+
+async def stream(feed: PresenceFeed, request: Request, heartbeat: float = 15) -> web.StreamResponse:
+    """
+    Server sent event stream of presence changes. Starts with a `snapshot` event of the current users unless the
+    client resumes with a Last-Event-ID that is still in the history.
+    """
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    await response.prepare(request)
+
+    try:
+        version = int(request.headers.get('Last-Event-ID', -1))
+    except ValueError:
+        version = -1
+
+    try:
+        while True:
+            changes = feed.since(version) if version >= 0 else None
+            if changes is None:
+                version = feed.version
+                snapshot = json.dumps({'version': version, 'users': _current_users()})
+                await response.write(f'id: {version}\nevent: snapshot\ndata: {snapshot}\n\n'.encode('utf-8'))
+
+            changes = await feed.wait(version, heartbeat)
+            if changes is None:
+                continue
+            if not changes:
+                await response.write(b': keepalive\n\n')
+                continue
+            await response.write(b''.join(change.frame for change in changes))
+            version = changes[-1].version
+    except ConnectionResetError:
+        # client went away
+        pass
+    return response
+
+
+async def poll(feed: PresenceFeed, request: Request, max_timeout: float = 60) -> web.Response:
+    """
+    Long poll for presence changes after the `since` version, waiting up to `timeout` seconds for one.
+    Answers with the changes, or with the current users and `reset` if `since` is missing or too old.
+    """
+    try:
+        since = int(request.query.get('since', -1))
+        timeout = min(float(request.query.get('timeout', 30)), max_timeout)
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+    changes = await feed.wait(since, timeout) if since >= 0 else None
+    if changes is None:
+        return web.json_response({'version': feed.version, 'reset': True, 'users': _current_users()})
+    version = changes[-1].version if changes else max(since, 0)
+    return web.json_response({'version': version, 'changes': [change.data for change in changes]})
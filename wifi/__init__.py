@@ -0,0 +1,209 @@
+import asyncio
+from time import perf_counter, time
+from typing import Dict, List, NamedTuple
+
+from modular_conf.fields import TupleListField, IntField, ChoiceField
+
+from common import User
+from config.live import live_config
+from bus import e_bus
+from bus.events import Event, InfoEvent
+from common.events import ConfigChangedEvent, TrackingEvent
+from log import LOG
+import metrics
+import snapshot
+from wifi.arpscan import ArpScanner
+from wifi.index import MacIndex, format_mac, pack_mac, pack_macs
+from wifi.neighbor import NeighborScanner
+from wifi.scanner import Scanner, ScanError
+from wifi.scheduler import ScanScheduler
+
+MODULE_NAME = 'wifi'
+DEPENDS = ('bus', 'snapshot')
+CONFIG_FIELDS = [
+    TupleListField(
+        name='to_track',
+        n_elems=2,
+        element_names=('name', 'mac'),
+        default=[]
+    ),
+    ChoiceField('backend', default='arp-scan', choices=('arp-scan', 'neighbor'), type=str),
+    IntField('scan_timeout', default=20),
+    # seconds the neighbor backend waits for probed entries, covering the kernel's delay_first_probe_time
+    IntField('probe_wait', default=6),
+    IntField('exit_threshold', default=600),
+    IntField('scan_interval', default=30),
+    IntField('fast_interval', default=5),
+    IntField('idle_interval', default=60),
+    IntField('near_exit_margin', default=60),
+    IntField('backoff_base', default=5),
+    IntField('backoff_max', default=300)
+]
+
+# settings that take effect by replacing the scanner or the scheduler
+SCANNER_KEYS = frozenset(('backend', 'probe_wait', 'scan_timeout'))
+SCHEDULER_KEYS = frozenset(('exit_threshold', 'scan_interval', 'fast_interval', 'idle_interval', 'near_exit_margin',
+                            'backoff_base', 'backoff_max'))
+
+SCAN_SECONDS = metrics.histogram('wifi_scan_seconds', 'Duration of presence scans', ('backend',))
+SCAN_FAILURES = metrics.counter('wifi_scan_failures_total', 'Failed presence scans', ('backend',))
+DEVICES = metrics.gauge('wifi_devices', 'Devices by state: seen in the last scan, tracked and present', ('state',))
+
+watcher = None
+
+
+def make_scanner(settings: NamedTuple, terminate: asyncio.Event) -> Scanner:
+    if settings.backend == 'neighbor':
+        return NeighborScanner(terminate, probe_wait=settings.probe_wait)
+    return ArpScanner(terminate, timeout=settings.scan_timeout)
+
+
+def make_scheduler(settings: NamedTuple) -> ScanScheduler:
+    return ScanScheduler(
+        exit_threshold=settings.exit_threshold,
+        interval=settings.scan_interval,
+        fast_interval=settings.fast_interval,
+        idle_interval=settings.idle_interval,
+        near_exit_margin=settings.near_exit_margin,
+        backoff_base=settings.backoff_base,
+        backoff_max=settings.backoff_max
+    )
+
+
+class Watcher:
+    def __init__(self, terminate: asyncio.Event, scanner: Scanner, scheduler: ScanScheduler, exit_threshold=600,
+                 to_track=()):
+        self.tracked = {}  # packed mac: last seen
+        # packed mac: the user it entered as, exits are reported for them even if to_track changed in the meantime
+        self.users: Dict[int, User] = {}
+        self.terminate = terminate
+        self.scanner = scanner
+        self.scheduler = scheduler
+        self.exit_threshold = exit_threshold
+        self.index = MacIndex(to_track)
+
+    def apply_settings(self, settings: NamedTuple, keys: List[str]) -> None:
+        """Take over changed settings, the scan in progress finishes with the old ones."""
+        if 'to_track' in keys:
+            self.index = MacIndex(settings.to_track)
+            LOG.debug(f'Rebuilt wifi mac index with {len(self.index)} tracked devices')
+        if SCANNER_KEYS.intersection(keys):
+            self.scanner = make_scanner(settings, self.terminate)
+        if SCHEDULER_KEYS.intersection(keys):
+            scheduler = make_scheduler(settings)
+            scheduler.next_wake, scheduler.failures = self.scheduler.next_wake, self.scheduler.failures
+            self.scheduler = scheduler
+            self.exit_threshold = settings.exit_threshold
+
+    def snapshot(self) -> Dict:
+        return {
+            'tracked': {format_mac(key): seen for key, seen in self.tracked.items()},
+            'names': {format_mac(key): user.name for key, user in self.users.items()},
+            'next_wake': self.scheduler.next_wake
+        }
+
+    def restore(self, state: Dict) -> None:
+        """
+        Take over the devices seen before a restart with their last seen times, so that the first scan only reports
+        actual changes and devices gone in the meantime still exit once exit_threshold passed.
+        """
+        names = state.get('names', {})
+        for mac, seen in state.get('tracked', {}).items():
+            try:
+                key = pack_mac(mac)
+            except ValueError:
+                continue
+            self.tracked[key] = seen
+            user = User(names[mac], format_mac(key)) if mac in names else self.index.get(key)
+            if user is not None:
+                self.users[key] = user
+        # carry on with the schedule instead of scanning right away
+        next_wake = state.get('next_wake')
+        if self.tracked and next_wake is not None:
+            self.scheduler.next_wake = max(time(), next_wake)
+
+    async def run(self) -> None:
+        e_bus.emit('tracker.wifi.initialized', InfoEvent('tracker.wifi.initialized'))
+
+        # a restored schedule is kept, otherwise the first scan starts right away
+        if self.scheduler.next_wake is not None and await self.scheduler.wait(self.terminate):
+            return
+
+        while not self.terminate.is_set():
+            index = self.index
+            backend = type(self.scanner).__name__
+
+            # look for currently connected devices
+            begin = perf_counter()
+            try:
+                macs = await self.scanner.scan(index.macs)
+            except ScanError as e:
+                SCAN_FAILURES.labels(backend).inc()
+                interval = self.scheduler.scan_failed()
+                LOG.error(f'Presence scan failed, retrying in {interval:.1f}s: {e}')
+                await self.scheduler.wait(self.terminate)
+                continue
+
+            if macs is None:
+                # shutdown requested while scanning
+                break
+            SCAN_SECONDS.labels(backend).observe(perf_counter() - begin)
+
+            # update tracked macs, devices nobody tracks are of no interest
+            curr_time = time()
+            present = index.keys.intersection(pack_macs(macs))
+
+            enter = present.difference(self.tracked)
+            for key in present:
+                self.tracked[key] = curr_time
+
+            leave = {key for key, seen in self.tracked.items()
+                     if curr_time - seen >= self.exit_threshold and key not in present}
+            # devices removed from to_track leave right away
+            leave.update(self.tracked.keys() - index.keys)
+            for key in leave:
+                del self.tracked[key]
+
+            DEVICES.labels('seen').set(len(macs))
+            DEVICES.labels('tracked').set(len(index))
+            DEVICES.labels('present').set(len(self.tracked))
+
+            for key in enter:
+                user = self.users[key] = index.get(key)
+                LOG.info(f'User {user.name} ({user.mac}) entered', extra={'user': user.name})
+                e_bus.emit('tracking.event.user_enter', TrackingEvent(User(user.name, user.mac)))
+
+            for key in leave:
+                user = self.users.pop(key, None) or index.get(key)
+                if user:
+                    LOG.info(f'User {user.name} ({user.mac}) left', extra={'user': user.name})
+                    e_bus.emit('tracking.event.user_exit', TrackingEvent(User(user.name, user.mac)))
+
+            # now wait for next round
+            self.scheduler.scan_succeeded(self.tracked, curr_time)
+            if await self.scheduler.wait(self.terminate):
+                break
+
+
+async def main(shutdown_signal: asyncio.Event) -> None:
+    settings = live_config.register(MODULE_NAME, CONFIG_FIELDS)
+
+    global watcher
+    watcher = Watcher(shutdown_signal, make_scanner(settings, shutdown_signal), make_scheduler(settings),
+                      exit_threshold=settings.exit_threshold, to_track=settings.to_track)
+    state = snapshot.restore(MODULE_NAME)
+    if state is not None:
+        watcher.restore(state)
+    snapshot.register(MODULE_NAME, watcher.snapshot)
+
+    def on_config_changed(event: ConfigChangedEvent) -> None:
+        watcher.apply_settings(live_config.get(MODULE_NAME), event.keys)
+
+    e_bus.on(f'config.changed.{MODULE_NAME}', on_config_changed)
+
+    await watcher.run()
+    await shutdown_signal.wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
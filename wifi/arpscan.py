@@ -0,0 +1,103 @@
+import asyncio
+import re
+from typing import Iterable, Iterator, Optional, Sequence, Set
+
+from wifi.scanner import Scanner, ScanError
+
+ARP_SCAN_COMMAND = ('arp-scan', '-l')
+
+# arp-scan output looks like this, only the host lines are of interest:
+#     Interface: enp6s0, datalink type: EN10MB (Ethernet)
+#     Starting arp-scan 1.9.5 with 256 hosts (https://github.com/royhills/arp-scan)
+#     192.168.141.1   cc:ce:1e:6c:d0:0a       (Unknown)
+#     192.168.141.43  b8:27:eb:d8:94:5f       Raspberry Pi Foundation
+#     192.168.141.48  b8:27:eb:1c:0a:af       Raspberry Pi Foundation
+#     192.168.141.48  b8:27:eb:1c:0a:af       Raspberry Pi Foundation (DUP: 2)
+#
+#     8 packets received by filter, 0 packets dropped by kernel
+#     Ending arp-scan 1.9.5: 256 hosts scanned in 2.455 seconds (104.28 hosts/sec). 8 responded
+_line_re = re.compile(r'^\s*(?P<ip>\d+\.\d+\.\d+\.\d+)\s+(?P<mac>[0-9a-fA-F]{2}(?::[0-9a-fA-F]{2}){5})(\s|$)')
+
+
+def parse_arp_scan_line(line: str) -> Optional[str]:
+    """Return the lower case mac address of a single arp-scan host line, None for header and summary lines."""
+    match = _line_re.match(line)
+    if match:
+        return match.group('mac').lower()
+    return None
+
+
+def parse_arp_scan(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Yield the mac addresses found in arp-scan output, duplicates included.
+    Args:
+        lines (Iterable[str]): output lines, e.g. a recorded scan split on newlines
+    """
+    for line in lines:
+        mac = parse_arp_scan_line(line)
+        if mac is not None:
+            yield mac
+
+
+async def arp_scan(terminate: asyncio.Event, timeout: float = 20,
+                   command: Sequence[str] = ARP_SCAN_COMMAND) -> Optional[Set[str]]:
+    """
+    Run arp-scan as a subprocess, parsing its output line by line while it runs.
+    Args:
+        terminate (asyncio.Event): shutdown signal, aborts the scan when set
+        timeout (float): seconds after which the scan is killed
+        command (Sequence[str]): arp-scan invocation
+    Returns:
+        the set of responding macs, or None if the scan was aborted by the shutdown signal
+    Raises:
+        ScanError: arp-scan could not be run, failed or timed out
+    """
+    try:
+        proc = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.DEVNULL)
+    except OSError as e:
+        raise ScanError(f'could not run {command[0]}: {e}') from e
+
+    macs = set()
+
+    async def _read() -> int:
+        async for line in proc.stdout:
+            mac = parse_arp_scan_line(line.decode('ascii', errors='replace'))
+            if mac is not None:
+                macs.add(mac)
+        return await proc.wait()
+
+    reader = asyncio.ensure_future(_read())
+    stopper = asyncio.ensure_future(terminate.wait())
+    try:
+        done, _ = await asyncio.wait({reader, stopper}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stopper.cancel()
+        if not reader.done():
+            reader.cancel()
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+
+    if reader in done:
+        returncode = reader.result()
+        if returncode != 0:
+            raise ScanError(f'{command[0]} exited with status {returncode}')
+        return macs
+    if stopper in done:
+        return None
+    raise ScanError(f'{command[0]} did not finish within {timeout}s')
+
+
+class ArpScanner(Scanner):
+    """Actively sweeps the local network with arp-scan."""
+
+    def __init__(self, terminate: asyncio.Event, timeout: float = 20, command: Sequence[str] = ARP_SCAN_COMMAND):
+        self.terminate = terminate
+        self.timeout = timeout
+        self.command = command
+
+    async def scan(self, targets: Iterable[str]) -> Optional[Set[str]]:
+        return await arp_scan(self.terminate, timeout=self.timeout, command=self.command)
@@ -0,0 +1,59 @@
+import string
+from typing import Dict, FrozenSet, Iterable, Iterator, Optional, Sequence, Tuple
+
+from common import User
+from log import LOG
+
+_HEX_DIGITS = frozenset(string.hexdigits)
+_SEPARATORS = str.maketrans('', '', ':-. ')
+
+
+def pack_mac(mac: str) -> int:
+    """
+    Pack a mac address into a 48 bit integer key.
+    Case and separators do not matter, 'B8:27:EB:1C:0A:AF', 'b8-27-eb-1c-0a-af' and 'b827.eb1c.0aaf' all give the
+    same key.
+    Raises:
+        ValueError: not a mac address
+    """
+    digits = mac.translate(_SEPARATORS)
+    if len(digits) != 12 or not _HEX_DIGITS.issuperset(digits):
+        raise ValueError(f'invalid mac address {mac!r}')
+    return int(digits, 16)
+
+
+def format_mac(key: int) -> str:
+    """Format a packed mac key the way arp-scan and the kernel print it, e.g. 'b8:27:eb:1c:0a:af'."""
+    digits = f'{key:012x}'
+    return ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+def pack_macs(macs: Iterable[str]) -> Iterator[int]:
+    """Pack all valid macs, silently skipping anything that does not parse."""
+    for mac in macs:
+        try:
+            yield pack_mac(mac)
+        except ValueError:
+            continue
+
+
+class MacIndex:
+    """Lookup from packed mac keys to the tracked users, built once from the wifi 'to_track' config."""
+
+    def __init__(self, to_track: Sequence[Tuple[str, str]] = ()):
+        self.users: Dict[int, User] = {}
+        for name, mac in to_track:
+            try:
+                key = pack_mac(mac)
+            except ValueError:
+                LOG.error(f'Ignoring invalid mac {mac!r} of tracked user {name}')
+                continue
+            self.users[key] = User(name, format_mac(key))
+        self.keys: FrozenSet[int] = frozenset(self.users)
+        self.macs: Tuple[str, ...] = tuple(user.mac for user in self.users.values())
+
+    def get(self, key: int) -> Optional[User]:
+        return self.users.get(key)
+
+    def __len__(self) -> int:
+        return len(self.users)
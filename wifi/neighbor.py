@@ -0,0 +1,212 @@
+import asyncio
+import socket
+import struct
+from typing import Dict, Iterable, Iterator, NamedTuple, Optional, Set
+
+from log import LOG
+from wifi.scanner import Scanner, ScanError
+
+PROC_NET_ARP = '/proc/net/arp'
+
+# neighbor states as defined in linux/neighbour.h
+NUD_INCOMPLETE = 0x01
+NUD_REACHABLE = 0x02
+NUD_STALE = 0x04
+NUD_DELAY = 0x08
+NUD_PROBE = 0x10
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+NUD_PERMANENT = 0x80
+
+# states in which the kernel holds a usable link layer address of a real host
+NUD_VALID = NUD_REACHABLE | NUD_STALE | NUD_DELAY | NUD_PROBE | NUD_PERMANENT
+# states in which the host is known to be there, the others only mean the kernel did not revalidate the entry yet
+NUD_CONFIRMED = NUD_REACHABLE | NUD_PERMANENT
+
+_NO_MAC = '00:00:00:00:00:00'
+
+# /proc/net/arp flags, see linux/if_arp.h
+ATF_COM = 0x02
+ATF_PERM = 0x04
+
+# rtnetlink constants, see linux/netlink.h and linux/rtnetlink.h
+_NETLINK_ROUTE = 0
+_RTM_NEWNEIGH = 28
+_RTM_GETNEIGH = 30
+_NLM_F_REQUEST = 0x01
+_NLM_F_DUMP = 0x300
+_NLMSG_ERROR = 2
+_NLMSG_DONE = 3
+_NDA_DST = 1
+_NDA_LLADDR = 2
+
+_nlmsghdr = struct.Struct('=LHHLL')
+_ndmsg = struct.Struct('=BxxxiHBB')
+_rtattr = struct.Struct('=HH')
+
+# udp discard port, the payload never matters as we only want the kernel to resolve the address
+_PROBE_PORT = 9
+
+
+class Neighbor(NamedTuple):
+    ip: str
+    mac: str
+    state: int
+
+
+def parse_proc_net_arp(lines: Iterable[str]) -> Iterator[Neighbor]:
+    """
+    Parse the contents of /proc/net/arp.
+    The proc interface does not tell reachable and stale entries apart, so every complete entry is reported as
+    stale and permanent entries as permanent.
+    """
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 6 or fields[0] == 'IP':
+            continue
+        try:
+            flags = int(fields[2], 16)
+        except ValueError:
+            continue
+        if flags & ATF_PERM:
+            state = NUD_PERMANENT
+        elif flags & ATF_COM:
+            state = NUD_STALE
+        else:
+            state = NUD_INCOMPLETE
+        yield Neighbor(fields[0], fields[3].lower(), state)
+
+
+def parse_neigh_dump(data: bytes) -> Iterator[Neighbor]:
+    """Parse RTM_NEWNEIGH messages of an rtnetlink neighbor dump."""
+    offset = 0
+    while offset + _nlmsghdr.size <= len(data):
+        length, msg_type, _, _, _ = _nlmsghdr.unpack_from(data, offset)
+        if length < _nlmsghdr.size:
+            break
+        end = offset + length
+        if msg_type == _RTM_NEWNEIGH:
+            family, _, state, _, _ = _ndmsg.unpack_from(data, offset + _nlmsghdr.size)
+            ip, mac = None, None
+            attr = offset + _nlmsghdr.size + _ndmsg.size
+            while attr + _rtattr.size <= end:
+                attr_len, attr_type = _rtattr.unpack_from(data, attr)
+                if attr_len < _rtattr.size:
+                    break
+                value = data[attr + _rtattr.size:attr + attr_len]
+                if attr_type == _NDA_DST and family == socket.AF_INET:
+                    ip = socket.inet_ntop(socket.AF_INET, value)
+                elif attr_type == _NDA_LLADDR and len(value) == 6:
+                    mac = ':'.join(f'{b:02x}' for b in value)
+                attr += (attr_len + 3) & ~3
+            if ip and mac:
+                yield Neighbor(ip, mac, state)
+        offset += (length + 3) & ~3
+
+
+def _is_done(data: bytes) -> bool:
+    offset = 0
+    while offset + _nlmsghdr.size <= len(data):
+        length, msg_type, _, _, _ = _nlmsghdr.unpack_from(data, offset)
+        if msg_type == _NLMSG_DONE:
+            return True
+        if msg_type == _NLMSG_ERROR:
+            raise OSError('rtnetlink neighbor dump failed')
+        if length < _nlmsghdr.size:
+            break
+        offset += (length + 3) & ~3
+    return False
+
+
+def read_netlink_neighbors() -> Iterator[Neighbor]:
+    """Dump the IPv4 neighbor table through rtnetlink."""
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+        request = _ndmsg.pack(socket.AF_INET, 0, 0, 0, 0)
+        sock.send(_nlmsghdr.pack(_nlmsghdr.size + len(request), _RTM_GETNEIGH,
+                                 _NLM_F_REQUEST | _NLM_F_DUMP, 1, 0) + request)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            chunks.append(chunk)
+            if not chunk or _is_done(chunk):
+                break
+    return parse_neigh_dump(b''.join(chunks))
+
+
+def read_proc_neighbors(path: str = PROC_NET_ARP) -> Iterator[Neighbor]:
+    with open(path) as f:
+        return parse_proc_net_arp(f.readlines())
+
+
+class NeighborScanner(Scanner):
+    """
+    Passive presence backend reading the kernel neighbor table instead of sweeping the network.
+    Only tracked macs whose entries are stale or gone are probed, by sending a single datagram to their last known
+    address which makes the kernel revalidate the entry. Departed devices then fail out of the table and returning
+    devices reappear, without any broadcast sweep.
+    Only confirmed (reachable or permanent) entries count as present. A probed entry still in the delay or probe state
+    after `probe_wait` is unknown and left out of the scan, the watcher only exits a device that was not seen for
+    exit_threshold. The kernel waits delay_first_probe_time (5s by default) before it sends its own probe, a shorter
+    `probe_wait` confirms present devices in one of the later scans instead.
+    /proc/net/arp does not tell confirmed entries apart, with the proc fallback every complete entry after the probe
+    counts as present. A departed device is then reported until the kernel failed its entry, usually one more scan.
+    """
+
+    def __init__(self, terminate: asyncio.Event, probe_wait: float = 6, use_netlink: bool = True):
+        self.terminate = terminate
+        self.probe_wait = probe_wait
+        self.use_netlink = use_netlink and hasattr(socket, 'AF_NETLINK')
+        self.last_ip: Dict[str, str] = {}
+
+    def read_table(self) -> Dict[str, Neighbor]:
+        if self.use_netlink:
+            try:
+                return {n.mac: n for n in read_netlink_neighbors()}
+            except OSError as e:
+                LOG.warning(f'rtnetlink unavailable, falling back to {PROC_NET_ARP}: {e}')
+                self.use_netlink = False
+        try:
+            return {n.mac: n for n in read_proc_neighbors()}
+        except OSError as e:
+            raise ScanError(f'could not read neighbor table: {e}') from e
+
+    def probe(self, ips: Iterable[str]) -> None:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            for ip in ips:
+                try:
+                    sock.sendto(b'', (ip, _PROBE_PORT))
+                except OSError:
+                    pass
+
+    async def scan(self, targets: Iterable[str]) -> Optional[Set[str]]:
+        table = self.read_table()
+        targets = set(targets)
+        # confirmed now, whatever state the entries are in after waiting for the probes
+        present = {mac for mac, entry in table.items() if entry.state & NUD_CONFIRMED}
+
+        to_probe = []
+        for mac in targets:
+            entry = table.get(mac)
+            if entry is not None and entry.state & NUD_VALID:
+                self.last_ip[mac] = entry.ip
+            if entry is None or not entry.state & NUD_REACHABLE:
+                ip = self.last_ip.get(mac)
+                if ip is not None:
+                    to_probe.append(ip)
+
+        if to_probe:
+            self.probe(to_probe)
+            try:
+                await asyncio.wait_for(self.terminate.wait(), self.probe_wait)
+                return None
+            except asyncio.TimeoutError:
+                pass
+            table = self.read_table()
+
+        # the proc fallback only knows complete entries, see above
+        states = NUD_CONFIRMED if self.use_netlink else NUD_VALID
+        present.update(mac for mac, entry in table.items() if entry.state & states)
+        present.discard(_NO_MAC)
+        return present
@@ -0,0 +1,22 @@
+from typing import Iterable, Optional, Set
+
+
+class ScanError(Exception):
+    """A presence scan failed, e.g. arp-scan exited with an error or did not finish in time."""
+    pass
+
+
+class Scanner:
+    """Presence backend used by the wifi Watcher to find the macs currently on the network."""
+
+    async def scan(self, targets: Iterable[str]) -> Optional[Set[str]]:
+        """
+        Look for devices on the network.
+        Args:
+            targets (Iterable[str]): macs we are interested in, backends may use them to probe selectively
+        Returns:
+            the set of present macs, or None if the scan was aborted by the shutdown signal
+        Raises:
+            ScanError: the scan failed
+        """
+        raise NotImplementedError()
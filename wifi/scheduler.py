@@ -0,0 +1,83 @@
+import asyncio
+import random
+from time import time
+from typing import Dict, Optional
+
+MODE_IDLE = 'idle'
+MODE_NORMAL = 'normal'
+MODE_FAST = 'fast'
+MODE_BACKOFF = 'backoff'
+
+
+class ScanScheduler:
+    """
+    Decides how long the wifi Watcher sleeps between scans.
+    Polls fast while a tracked device has not been seen for almost exit_threshold, so its exit (or its return) is
+    noticed in time, slowly while nobody tracked is present and backs off exponentially with jitter while scans fail.
+    """
+
+    def __init__(self, exit_threshold=600, interval=30, fast_interval=5, idle_interval=60, near_exit_margin=60,
+                 backoff_base=5, backoff_max=300):
+        self.exit_threshold = exit_threshold
+        self.normal_interval = interval
+        self.fast_interval = fast_interval
+        self.idle_interval = idle_interval
+        self.near_exit_margin = near_exit_margin
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.interval = interval
+        self.mode = MODE_NORMAL
+        self.next_wake: Optional[float] = None
+        self.failures = 0
+
+    def _schedule(self, mode: str, interval: float) -> float:
+        self.mode = mode
+        self.interval = interval
+        self.next_wake = time() + interval
+        return interval
+
+    def scan_succeeded(self, tracked: Dict[int, float], now: float) -> float:
+        """
+        Pick the next interval after a successful scan.
+        Args:
+            tracked (Dict[int, float]): last seen time of every tracked device currently present
+            now (float): time of the scan
+        Returns:
+            the interval in seconds
+        """
+        self.failures = 0
+        if not tracked:
+            return self._schedule(MODE_IDLE, self.idle_interval)
+
+        fast_after = self.exit_threshold - self.near_exit_margin
+        if any(now - seen >= fast_after for seen in tracked.values()):
+            return self._schedule(MODE_FAST, self.fast_interval)
+        return self._schedule(MODE_NORMAL, self.normal_interval)
+
+    def scan_failed(self) -> float:
+        """Pick the next interval after a failed scan, doubling the backoff with every consecutive failure."""
+        self.failures += 1
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (self.failures - 1))
+        return self._schedule(MODE_BACKOFF, random.uniform(delay / 2, delay))
+
+    async def wait(self, terminate: asyncio.Event) -> bool:
+        """
+        Sleep until the next scan is due.
+        Returns:
+            True if the shutdown signal was set in the meantime
+        """
+        timeout = 0 if self.next_wake is None else max(0.0, self.next_wake - time())
+        try:
+            await asyncio.wait_for(terminate.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def serialize(self) -> Dict:
+        return {
+            'mode': self.mode,
+            'interval': self.interval,
+            'next_wake': self.next_wake,
+            'failures': self.failures
+        }